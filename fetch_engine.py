@@ -0,0 +1,354 @@
+# Minet asynchronous HTTP fetch engine
+
+# Import modules
+import os
+import time
+import random
+import asyncio
+import threading
+import requests
+from collections import deque
+from functools import partial
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+# Import scripts
+from http_cache import cached_get, offline_miss
+
+# Status codes that are final answers (404 means that an entry does not exist)
+FINAL_STATUS = set([200, 404])
+
+# Define classes
+class ConcurrencyController():
+    """
+    Adapts the number of in-flight requests to a server (AIMD).
+
+    Each request that completes while all slots are in use raises the limit
+    by 1/limit, i.e. by about one request per round of requests; requests
+    that complete below the limit leave it unchanged, so the limit does not
+    grow past the concurrency that is actually used. Failed requests, and
+    requests that take more than latency_factor times the baseline latency,
+    cut the limit by the decrease factor, at most once per round trip. The controller is
+    thread-safe; threads wait in acquire() for a free slot, while
+    coroutines use try_acquire() and are woken by listeners (see
+    add_listener) when a slot is released.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, decrease=0.5,
+        latency_factor=3.0, latency_floor=0.05, backoff=1.0, max_backoff=60.0,
+        window=10.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.latency_floor = latency_floor
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.window = window
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = None
+        self.base_latency = None
+        self.last_decrease = 0
+        self.completed = deque()
+        self.listeners = []
+        self.cond = threading.Condition()
+
+    def try_acquire(self):
+        """Takes a request slot if one is free. Returns True on success."""
+        with self.cond:
+            if self.in_flight < max(self.minimum, int(self.limit)):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self):
+        """Waits for and takes a request slot."""
+        with self.cond:
+            while self.in_flight >= max(self.minimum, int(self.limit)):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, ok=True):
+        """
+        Returns a request slot, adapting the limit to the outcome. latency is
+        the request time in seconds, or None for requests that did not reach
+        the server (e.g. cached responses), which leave the limit unchanged.
+        """
+        with self.cond:
+            saturated = self.in_flight >= max(self.minimum, int(self.limit))
+            self.in_flight -= 1
+            if latency is not None:
+                self.update(latency, ok, saturated)
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+        for callback in listeners:
+            callback()
+
+    def add_listener(self, callback):
+        """
+        Calls callback() whenever a slot is released, from the releasing
+        thread.
+        """
+        with self.cond:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Stops calling a callback added with add_listener."""
+        with self.cond:
+            self.listeners.remove(callback)
+
+    def update(self, latency, ok, saturated=True):
+        """
+        Records a request outcome and adjusts the limit. Successes only
+        raise the limit if saturated, i.e. all slots were in use.
+        """
+        now = time.time()
+        self.requests += 1
+        self.completed.append((now, ok))
+        while self.completed[0][0] < now - self.window:
+            self.completed.popleft()
+        if ok:
+            if self.latency is None:
+                self.latency = self.base_latency = latency
+            self.latency = 0.8 * self.latency + 0.2 * latency
+            # The baseline follows lasting slowdowns, but slowly
+            self.base_latency = min(latency, self.base_latency * 1.01)
+            slow = latency > self.latency_factor * \
+            max(self.base_latency, self.latency_floor)
+        else:
+            self.errors += 1
+            slow = False
+        if not ok or slow:
+            if now - self.last_decrease > (self.latency or self.backoff):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = now
+        elif saturated:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def backoff_delay(self, attempt):
+        """Jittered exponential backoff delay (seconds) before a retry."""
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+    def metrics(self):
+        """
+        Live metrics: current limit, requests in flight, total requests and
+        errors, and throughput (requests/s), error rate and mean latency (s)
+        over the last window seconds.
+        """
+        with self.cond:
+            now = time.time()
+            recent = [ok for t, ok in self.completed if t >= now - self.window]
+            return {
+                'limit':int(self.limit), 'in_flight':self.in_flight,
+                'requests':self.requests, 'errors':self.errors,
+                'throughput':len(recent) / self.window,
+                'error_rate':recent.count(False) / max(1, len(recent)),
+                'latency':self.latency
+            }
+
+    def status(self):
+        """Short metrics string for progress output."""
+        m = self.metrics()
+        return "%3d/%-3d conn %6.1f req/s %5.1f%% err" % (
+            m['in_flight'], m['limit'], m['throughput'], 100 * m['error_rate']
+        )
+
+
+class AsyncFetcher():
+    """
+    Fetches URLs from coroutines over a pooled keep-alive HTTP session.
+
+    Blocking requests run on a small thread pool sized to the connection
+    pool, so at most max_connections requests are in flight. Within this
+    bound, the shared ConcurrencyController of each host (see
+    host_controller) sets the number of requests in flight to the host;
+    per_host optionally caps it further (by default, only the maximum of the
+    controller does). Failed requests are retried with jittered
+    exponential backoff without blocking other requests. CPU-bound parsing
+    is handed off to a separate executor with parse().
+
+    Create the fetcher inside the event loop that uses it (see run_fetch).
+    """
+
+    def __init__(self, max_connections=16, per_host=None, retries=5,
+        timeout=60, parse_executor=None):
+        self.retries = retries
+        self.timeout = timeout
+        self.per_host = per_host
+        self.loop = asyncio.get_event_loop()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=max_connections
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.io_executor = ThreadPoolExecutor(max_connections)
+        self.slots = asyncio.Semaphore(max_connections)
+        self.host_slots = {}
+        self.slot_freed = asyncio.Event()
+        self.controllers = []
+        self.own_parse_executor = parse_executor is None
+        if parse_executor is None:
+            parse_executor = ThreadPoolExecutor(2)
+        self.parse_executor = parse_executor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Shuts down the executors and the HTTP session."""
+        for controller in self.controllers:
+            controller.remove_listener(self.wake)
+        self.io_executor.shutdown()
+        if self.own_parse_executor:
+            self.parse_executor.shutdown()
+        self.session.close()
+
+    def wake(self):
+        """
+        Wakes the coroutines waiting for a request slot. Controllers call
+        this from any thread when a slot is released, also by other fetchers
+        and by threads.
+        """
+        try:
+            self.loop.call_soon_threadsafe(self.slot_freed.set)
+        except RuntimeError:
+            pass # The event loop is closed
+
+    async def request(self, url):
+        """Performs one GET request, returning None on connection errors."""
+        host = urlparse(url).netloc
+        controller = host_controller(url)
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(
+                self.per_host or controller.maximum
+            )
+        if controller not in self.controllers:
+            controller.add_listener(self.wake)
+            self.controllers.append(controller)
+        async with self.host_slots[host]:
+            async with self.slots:
+                # Wait for a slot, trying again after each release
+                while True:
+                    self.slot_freed.clear()
+                    if controller.try_acquire():
+                        break
+                    await self.slot_freed.wait()
+                start = time.time()
+                try:
+                    r = await self.loop.run_in_executor(
+                        self.io_executor, partial(
+                            cached_get, url, session=self.session,
+                            timeout=self.timeout
+                        )
+                    )
+                except requests.RequestException:
+                    r = None
+                if getattr(r, 'from_cache', False) or offline_miss(r):
+                    controller.release()
+                else:
+                    controller.release(
+                        time.time() - start,
+                        r is not None and r.status_code in FINAL_STATUS
+                    )
+                return r
+
+    async def get(self, url):
+        """
+        Downloads a URL, retrying with backoff until the server gives a
+        final answer (200 or 404). Returns the last response, or None if the
+        server could not be reached.
+        """
+        for attempt in range(self.retries):
+            r = await self.request(url)
+            if r is not None:
+                if r.status_code in FINAL_STATUS or offline_miss(r):
+                    return r
+            if attempt < self.retries - 1:
+                await asyncio.sleep(
+                    host_controller(url).backoff_delay(attempt)
+                )
+        return r
+
+    async def parse(self, func, *args):
+        """Runs func(*args) on the parse executor."""
+        return await self.loop.run_in_executor(
+            self.parse_executor, partial(func, *args)
+        )
+
+
+# Shared controllers, one per host
+CONTROLLERS = {}
+CONTROLLERS_LOCK = threading.Lock()
+
+# Event loop and fetcher shared by synchronous calls, one per process
+SHARED = {'pid':None, 'loop':None, 'fetcher':None}
+SHARED_LOCK = threading.Lock()
+
+# Define functions
+def host_controller(url, **options):
+    """
+    The shared ConcurrencyController for the host of url, created with
+    options on first use.
+    """
+    host = urlparse(url).netloc
+    with CONTROLLERS_LOCK:
+        if host not in CONTROLLERS:
+            CONTROLLERS[host] = ConcurrencyController(**options)
+        return CONTROLLERS[host]
+
+
+def run_fetch(fetch, *args, **fetcher_options):
+    """
+    Runs the coroutine function fetch(fetcher, *args) to completion in a new
+    event loop, with a new AsyncFetcher configured by fetcher_options.
+    Synchronous code calls the asynchronous fetch functions through this.
+    """
+    async def main():
+        with AsyncFetcher(**fetcher_options) as fetcher:
+            return await fetch(fetcher, *args)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+
+def shared_fetcher():
+    """
+    The event loop and AsyncFetcher shared by synchronous calls in this
+    process, created on first use. The loop runs in a background thread.
+    """
+    with SHARED_LOCK:
+        if SHARED['pid'] != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            async def create():
+                return AsyncFetcher()
+            SHARED['fetcher'] = asyncio.run_coroutine_threadsafe(
+                create(), loop
+            ).result()
+            SHARED['loop'] = loop
+            SHARED['pid'] = os.getpid()
+        return (SHARED['loop'], SHARED['fetcher'])
+
+
+def run_shared_fetch(fetch, *args):
+    """
+    Runs the coroutine function fetch(fetcher, *args) to completion with the
+    shared fetcher (see shared_fetcher). Unlike run_fetch, calls reuse the
+    session and its keep-alive connections, so synchronous code fetching
+    single entries calls through this. Thread-safe.
+    """
+    loop, fetcher = shared_fetcher()
+    return asyncio.run_coroutine_threadsafe(
+        fetch(fetcher, *args), loop
+    ).result()
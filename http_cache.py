@@ -0,0 +1,153 @@
+# Minet on-disk HTTP response cache
+
+# Import modules
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+import requests
+
+# Cache settings, shared by all KEGG and MINE access functions
+CACHE = {'dir':None, 'max_age':None, 'offline':False}
+
+# Status codes worth keeping (404 means that a KEGG entry does not exist)
+CACHED_STATUS = set([200, 404])
+
+# Define functions
+def configure_cache(cache_dir=None, max_age=None, offline=False):
+    """
+    Sets up the response cache for KEGG and MINE requests.
+
+    ARGUMENTS
+
+    cache_dir : string
+        Directory holding the cached responses; None disables the cache.
+    max_age : int, float
+        Maximum age in days of a cached response; older responses are
+        downloaded again. None keeps responses indefinitely.
+    offline : bool
+        Answer from the cache only. Requests that are not in the cache get
+        a '504 Not in response cache' response without contacting the server.
+    """
+    if offline and cache_dir is None:
+        raise ValueError("Offline mode requires a cache directory.")
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    CACHE['dir'] = cache_dir
+    CACHE['max_age'] = max_age
+    CACHE['offline'] = offline
+
+
+def request_key(method, url, body=None):
+    """Content address (SHA-256 hex digest) of a request."""
+    h = hashlib.sha256()
+    h.update(method.upper().encode())
+    h.update(b"\n")
+    h.update(url.encode())
+    h.update(b"\n")
+    if body is not None:
+        h.update(body if isinstance(body, bytes) else body.encode())
+    return h.hexdigest()
+
+
+def cache_path(key):
+    """Path to the compressed response file of a request key."""
+    return os.path.join(CACHE['dir'], key[0:2], key + ".gz")
+
+
+def make_response(url, status_code, content, reason="", headers={}):
+    """Constructs a requests Response object."""
+    r = requests.models.Response()
+    r.url = url
+    r.status_code = status_code
+    r.reason = reason
+    r.headers.update(headers)
+    r.encoding = 'utf-8'
+    r._content = content
+    return r
+
+
+def load_response(key):
+    """
+    Reads a cached response. Returns None if the response is missing or
+    older than the maximum age.
+    """
+    path = cache_path(key)
+    try:
+        if CACHE['max_age'] is not None and not CACHE['offline']:
+            if time.time() - os.path.getmtime(path) > CACHE['max_age']*86400:
+                return None
+        with gzip.open(path, 'rb') as f:
+            meta = json.loads(f.readline().decode())
+            content = f.read()
+    except (OSError, EOFError, ValueError):
+        # Missing, truncated or corrupt files count as misses
+        return None
+    r = make_response(
+        meta['url'], meta['status_code'], content,
+        meta['reason'], meta['headers']
+    )
+    r.from_cache = True
+    return r
+
+
+def store_response(key, r):
+    """Writes a response to the cache, replacing the file atomically."""
+    path = cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    meta = {
+        'url':r.url, 'status_code':r.status_code, 'reason':r.reason,
+        'headers':{k:v for k, v in r.headers.items() if k.lower() in \
+        ['content-type']}
+    }
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(meta).encode() + b"\n")
+        f.write(r.content)
+    os.replace(tmp_path, path)
+
+
+def cached_request(method, url, key_data=None, session=None, **kwargs):
+    """
+    Performs an HTTP request through the response cache. The request is
+    identified by method, URL and key_data (defaults to the request body);
+    key_data should leave out anything that changes between identical
+    requests, such as JSON-RPC call IDs. The request is sent over session
+    (a requests Session) if given. Other arguments are passed on to requests.
+    """
+    if session is None:
+        session = requests
+    if CACHE['dir'] is None:
+        return session.request(method, url, **kwargs)
+    if key_data is None:
+        key_data = kwargs.get('data')
+    key = request_key(method, url, key_data)
+    r = load_response(key)
+    if r is not None:
+        return r
+    if CACHE['offline']:
+        r = make_response(url, 504, b"", "Not in response cache")
+        r.offline_miss = True
+        return r
+    r = session.request(method, url, **kwargs)
+    if r.status_code in CACHED_STATUS:
+        store_response(key, r)
+    r.from_cache = False
+    return r
+
+
+def cached_get(url, **kwargs):
+    """HTTP GET through the response cache."""
+    return cached_request('GET', url, **kwargs)
+
+
+def cached_post(url, key_data=None, **kwargs):
+    """HTTP POST through the response cache."""
+    return cached_request('POST', url, key_data, **kwargs)
+
+
+def offline_miss(r):
+    """True if the response stands in for a request missing in offline mode."""
+    return getattr(r, 'offline_miss', False)
@@ -8,6 +8,9 @@ import pandas as pd
 import collections
 import itertools
 import argparse
+import zipfile
+import time
+import multiprocessing as mp
 
 # Import scripts
 import pykegg
@@ -230,6 +233,14 @@ def mdf_A(S, net_rxns = []):
     return np.matrix(A)
 
 
+def mdf_A_network(A, S, net_rxns = []):
+    """Copy of an MDF A matrix with the MDF column set for a network (NEM)"""
+    A = A.copy()
+    net_rxns = set(net_rxns)
+    A[:S.shape[1], -1] = np.array([[0 if R in net_rxns else 1] for R in S.columns])
+    return A
+
+
 def mdf_b(S, drGs, constraints, x_max_default=0.01, x_min_default=0.000001, T=298.15, R=8.31e-3):
     """Constructs the MDF b vector."""
     # Use the stoichiometric matrix to find the order of compounds and reactions
@@ -315,7 +326,290 @@ def mdf_b_eq(ratio_constraints):
     return b_eq
 
 
-def mdf(c, A, b, A_eq = None, b_eq = None):
+def mdf_presolve(A, b, A_eq=None, b_eq=None, tol=1e-9):
+    """Reduce an MDF linear programming problem before optimization
+
+    Concentration bound rows are turned into variable bounds, fixed
+    concentrations (x_min == x_max) are substituted into the reaction rows, and
+    one variable per ratio equality is eliminated. Reaction rows that no longer
+    depend on any concentration are either dropped (network reactions) or
+    turned into an upper bound on the MDF variable (pathway reactions).
+
+    ARGUMENTS
+
+    A : numpy.matrix
+        The linear programming standard form A matrix (see mdf_A).
+    b : numpy.array
+        The linear programming standard form b vector (see mdf_b).
+    A_eq : numpy.matrix, optional
+        Equality constraints matrix for concentration ratios (see mdf_A_eq).
+    b_eq : numpy.array, optional
+        Equality constraints vector for concentration ratios (see mdf_b_eq).
+    tol : float, optional
+        Absolute tolerance used when comparing bounds and equalities.
+
+    RETURNS
+
+    dict or None
+        None if the problem cannot be presolved (equality rows that are not
+        simple ratios). Otherwise a dictionary with the reduced problem:
+        'A' and 'b' : numpy.array
+            Reduced inequality constraints (A may have zero rows).
+        'bounds' : list of tuples
+            Lower and upper bounds for each reduced variable.
+        'M' and 't' : numpy.array
+            Postsolve mapping; the full variable vector is M @ y + t, where y
+            is the reduced variable vector.
+        'infeasible' : bool
+            True if presolve proved that the problem has no solution.
+    """
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float).flatten()
+    n = A.shape[1]
+
+    infeasible = {
+        'A':None, 'b':None, 'bounds':None, 'M':None, 't':None,
+        'infeasible':True
+    }
+
+    # Union-find with offsets; x[i] = x[parent[i]] + offset[i]
+    parent = list(range(n))
+    offset = [0.0]*n
+
+    def find(i):
+        o = 0.0
+        while parent[i] != i:
+            o += offset[i]
+            i = parent[i]
+        return (i, o)
+
+    # Equality rows either fix a variable or tie two variables together
+    fixes = []
+    if A_eq is not None and b_eq is not None and np.size(A_eq):
+        A_eq = np.asarray(A_eq, dtype=float)
+        b_eq = np.asarray(b_eq, dtype=float).flatten()
+        for row, rhs in zip(A_eq, b_eq):
+            nz = np.flatnonzero(row)
+            if len(nz) == 1:
+                fixes.append((nz[0], rhs / row[nz[0]]))
+            elif len(nz) == 2 and row[nz[0]] == -row[nz[1]]:
+                # x_i - x_j = rhs / a_i
+                i, j = nz
+                d = rhs / row[i]
+                ri, oi = find(i)
+                rj, oj = find(j)
+                if ri == rj:
+                    if abs(oi - oj - d) > tol:
+                        return infeasible
+                    continue
+                parent[ri] = rj
+                offset[ri] = oj + d - oi
+            else:
+                # Not a ratio constraint; leave the problem untouched
+                return None
+
+    # Resolve every variable to its representative and offset
+    rep = [find(i) for i in range(n)]
+
+    # Collect bounds for representatives from single variable rows
+    lb = np.full(n, -np.inf)
+    ub = np.full(n, np.inf)
+
+    def add_bound(r, a, rhs):
+        # a * x_r <= rhs
+        if a > 0:
+            ub[r] = min(ub[r], rhs / a)
+        else:
+            lb[r] = max(lb[r], rhs / a)
+
+    general_rows = []
+    for k in range(A.shape[0]):
+        nz = np.flatnonzero(A[k])
+        if len(nz) == 0:
+            if b[k] < -tol:
+                return infeasible
+        elif len(nz) == 1:
+            r, o = rep[nz[0]]
+            add_bound(r, A[k, nz[0]], b[k] - A[k, nz[0]] * o)
+        else:
+            general_rows.append(k)
+
+    # Equality-fixed representatives
+    fixed = {}
+    for i, v in fixes:
+        r, o = rep[i]
+        if r in fixed and abs(fixed[r] - (v - o)) > tol:
+            return infeasible
+        fixed[r] = v - o
+
+    # Bound-fixed representatives (x_min == x_max)
+    for r in set(r for r, o in rep):
+        if lb[r] > ub[r] + tol:
+            return infeasible
+        if r in fixed:
+            if fixed[r] < lb[r] - tol or fixed[r] > ub[r] + tol:
+                return infeasible
+        elif ub[r] - lb[r] <= tol:
+            fixed[r] = lb[r]
+
+    def mapping():
+        # Construct x = M @ y + t for the current set of free representatives
+        free = sorted(set(r for r, o in rep if r not in fixed))
+        col = dict(zip(free, range(len(free))))
+        M = np.zeros((n, len(free)))
+        t = np.zeros(n)
+        for i, (r, o) in enumerate(rep):
+            if r in fixed:
+                t[i] = fixed[r] + o
+            else:
+                M[i, col[r]] = 1
+                t[i] = o
+        return (free, M, t)
+
+    # Substitute into the remaining rows and drop those that became constant;
+    # rows that depend on a single variable are turned into bounds, which may
+    # in turn fix further variables
+    rows = general_rows
+    while True:
+        free, M, t = mapping()
+        A_r = A[rows].dot(M)
+        b_r = b[rows] - A[rows].dot(t)
+        keep = []
+        new_fixed = False
+        for k in range(len(rows)):
+            nz = np.flatnonzero(np.abs(A_r[k]) > tol)
+            if len(nz) == 0:
+                if b_r[k] < -tol:
+                    return infeasible
+            elif len(nz) == 1:
+                r = free[nz[0]]
+                add_bound(r, A_r[k, nz[0]], b_r[k])
+                if lb[r] > ub[r] + tol:
+                    return infeasible
+                if ub[r] - lb[r] <= tol:
+                    fixed[r] = lb[r]
+                    new_fixed = True
+            else:
+                keep.append(k)
+        rows = [rows[k] for k in keep]
+        if not new_fixed:
+            A_r = A_r[keep]
+            b_r = b_r[keep]
+            break
+
+    return {
+        'A':A_r, 'b':b_r, 'bounds':[(
+            None if np.isinf(lb[r]) else lb[r],
+            None if np.isinf(ub[r]) else ub[r]
+        ) for r in free],
+        'M':M, 't':t, 'infeasible':False
+    }
+
+
+# LP solver backends for solve_lp; 'scipy' uses the linprog default method
+LP_SOLVERS = ['scipy', 'highs', 'highs-ds', 'highs-ipm', 'cbc']
+
+
+def solve_lp(c, A_ub=None, b_ub=None, A_eq=None, b_eq=None, bounds=(None,None),
+             solver='scipy'):
+    """Minimize c x subject to A_ub x <= b_ub and A_eq x == b_eq
+
+    ARGUMENTS
+
+    c : numpy.array
+        Objective vector.
+    A_ub, b_ub : numpy.matrix and numpy.array, optional
+        Inequality constraints.
+    A_eq, b_eq : numpy.matrix and numpy.array, optional
+        Equality constraints.
+    bounds : tuple or list of tuples, optional
+        Lower and upper bound (None for unbounded) for all variables, or one
+        pair per variable.
+    solver : string, optional
+        One of LP_SOLVERS. 'scipy' is scipy.optimize.linprog with its default
+        method, 'highs', 'highs-ds' (dual simplex) and 'highs-ipm' (interior
+        point) are the HiGHS methods of linprog (SciPy >= 1.6), and 'cbc' is
+        CBC through PuLP.
+
+    RETURNS
+
+    scipy.optimize.OptimizeResult
+        x : numpy.ndarray
+            The solution. Only meaningful if success is True.
+        fun : float
+            The objective value. Only meaningful if success is True.
+        success : bool
+            True if an optimal solution was found.
+        status : int
+            0 (optimal), 1 (iteration limit), 2 (infeasible), 3 (unbounded)
+            or 4 (numerical difficulties or other failure).
+        message : string
+            Solver status description.
+    """
+    if solver == 'cbc':
+        return solve_lp_pulp(c, A_ub, b_ub, A_eq, b_eq, bounds)
+    if solver not in LP_SOLVERS:
+        raise ValueError("Unknown LP solver '%s'; use one of: %s" % (
+            solver, ", ".join(LP_SOLVERS)
+        ))
+    if solver == 'scipy':
+        result = optimize.linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq,
+                                  bounds=bounds)
+    else:
+        result = optimize.linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq,
+                                  bounds=bounds, method=solver)
+    return result
+
+
+def solve_lp_pulp(c, A_ub=None, b_ub=None, A_eq=None, b_eq=None,
+                  bounds=(None,None)):
+    """solve_lp with the PuLP default solver (CBC)"""
+    import pulp
+
+    c = np.asarray(c, dtype=float).flatten()
+    n = len(c)
+    if len(bounds) == 2 and not isinstance(bounds[0], (tuple, list)):
+        bounds = [bounds]*n
+
+    # Set up variables and objective
+    problem = pulp.LpProblem('lp', pulp.LpMinimize)
+    x = [
+        pulp.LpVariable('x%d' % i, lowBound=lb, upBound=ub)
+        for i, (lb, ub) in enumerate(bounds)
+    ]
+    problem += pulp.lpSum(c[i]*x[i] for i in np.flatnonzero(c))
+
+    # Add constraints using the non-zero coefficients only
+    def add_rows(M, v, sense):
+        if M is None or v is None or not np.size(M):
+            return
+        M = np.asarray(M, dtype=float)
+        v = np.asarray(v, dtype=float).flatten()
+        for row, value in zip(M, v):
+            expression = pulp.LpAffineExpression(
+                [(x[i], row[i]) for i in np.flatnonzero(row)]
+            )
+            problem.addConstraint(pulp.LpConstraint(expression, sense, rhs=value))
+    add_rows(A_ub, b_ub, pulp.LpConstraintLE)
+    add_rows(A_eq, b_eq, pulp.LpConstraintEQ)
+
+    # Solve and translate the status to the linprog convention
+    problem.solve(pulp.PULP_CBC_CMD(msg=False))
+    status = {
+        pulp.LpStatusOptimal:0, pulp.LpStatusInfeasible:2,
+        pulp.LpStatusUnbounded:3
+    }.get(problem.status, 4)
+    result = optimize.OptimizeResult(
+        x=None, fun=None, success=status == 0, status=status, nit=0,
+        message=pulp.LpStatus[problem.status]
+    )
+    if status == 0:
+        result.x = np.array([v.varValue or 0.0 for v in x])
+        result.fun = c.dot(result.x)
+    return result
+
+
+def mdf(c, A, b, A_eq = None, b_eq = None, presolve = False, solver = 'scipy'):
     """Perform MDF optimization using the simplex algorithm
 
     ARGUMENTS
@@ -338,6 +632,11 @@ def mdf(c, A, b, A_eq = None, b_eq = None):
     b_eq : numpy.array, optional
         Equality constraints vector corresponding to the natural logarithms of
         the ratios between compounds specified by A_eq.
+    presolve : bool, optional
+        Set to True to reduce the problem with mdf_presolve before optimization.
+        The solution is mapped back to the full concentration vector.
+    solver : string, optional
+        LP solver backend (see solve_lp).
 
     RETURNS
 
@@ -347,8 +646,398 @@ def mdf(c, A, b, A_eq = None, b_eq = None):
             of the vector is the MDF in units of RT. Multiply with RT to get the
             value in kJ/mol.
     """
-    return optimize.linprog(-c, A_ub=A, b_ub=b, A_eq=A_eq, b_eq=b_eq,
-                                  bounds=(None,None))
+    if presolve:
+        P = mdf_presolve(A, b, A_eq, b_eq)
+        if P is not None:
+            return mdf_postsolve(c, P, solver)
+    return solve_lp(-c, A_ub=A, b_ub=b, A_eq=A_eq, b_eq=b_eq,
+                    bounds=(None,None), solver=solver)
+
+
+def mdf_postsolve(c, P, solver='scipy'):
+    """Solve a presolved MDF problem and map the result to the full problem"""
+    if P['infeasible']:
+        return optimize.OptimizeResult(
+            x=None, fun=None, success=False, status=2, nit=0,
+            message='The problem was found to be infeasible in presolve.'
+        )
+    c = np.asarray(c, dtype=float)
+    c_r = P['M'].T.dot(c)
+    if P['M'].shape[1] == 0:
+        # Everything was fixed in presolve
+        return optimize.OptimizeResult(
+            x=P['t'], fun=-c.dot(P['t']), success=True, status=0, nit=0,
+            message='The problem was solved in presolve.'
+        )
+    if P['A'].shape[0]:
+        A_r, b_r = P['A'], P['b']
+    else:
+        A_r, b_r = None, None
+    result = solve_lp(-c_r, A_ub=A_r, b_ub=b_r, bounds=P['bounds'],
+                      solver=solver)
+    if result.success:
+        result.x = P['M'].dot(result.x) + P['t']
+        result.fun = -c.dot(result.x)
+    return result
+
+
+def mdf_sensitivity(c, A, b, x, A_eq=None, b_eq=None, tol=1e-5):
+    """Shadow prices and allowable right hand side ranges of an MDF solution
+
+    ARGUMENTS
+
+    c : numpy.array
+        The MDF c vector (see mdf_c).
+    A : numpy.matrix
+        The MDF A matrix (see mdf_A).
+    b : numpy.array
+        The MDF b vector (see mdf_b).
+    x : numpy.array
+        An optimal solution of the MDF problem (the x of the result of mdf).
+    A_eq : numpy.matrix, optional
+        Equality constraints matrix for concentration ratios.
+    b_eq : numpy.array, optional
+        Equality constraints vector for concentration ratios.
+    tol : float, optional
+        Absolute tolerance for active constraints and linear independence.
+
+    RETURNS
+
+    dict
+        'shadow_ub' and 'shadow_eq' : numpy.array
+            The change in MDF (RT units) per unit increase of each element of
+            b and b_eq, respectively.
+        'range_ub' and 'range_eq' : numpy.array
+            Two column arrays with the lowest and highest value of each element
+            of b and b_eq for which the optimal basis, and thereby the shadow
+            prices, stay the same. NaN if no optimal basis could be identified.
+
+    NOTES
+
+    Interior point solutions are first moved along the optimal face to a
+    vertex, so the result does not depend on the LP method.
+    """
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float).flatten()
+    c = np.asarray(c, dtype=float).flatten()
+    n_var = A.shape[1]
+    if A_eq is not None and b_eq is not None and np.size(A_eq):
+        E = np.asarray(A_eq, dtype=float)
+        e = np.asarray(b_eq, dtype=float).flatten()
+    else:
+        E = np.zeros((0, n_var))
+        e = np.zeros(0)
+    n_eq = E.shape[0]
+
+    # Equality rows first, then inequality rows
+    G = np.concatenate((E, A), axis=0)
+    h = np.append(e, b)
+    z = np.array(x, dtype=float)
+
+    def slacks(z):
+        s = h - G.dot(z)
+        s[:n_eq] = 0
+        return s
+
+    def independent_rows(candidates):
+        # Greedy Gram-Schmidt selection of linearly independent rows
+        Q = []
+        selected = []
+        for i in candidates:
+            r = G[i] - sum(q * q.dot(G[i]) for q in Q)
+            if np.linalg.norm(r) > tol * max(1, np.linalg.norm(G[i])):
+                Q.append(r / np.linalg.norm(r))
+                selected.append(i)
+            if len(selected) == n_var:
+                break
+        return selected
+
+    nan_result = {
+        'shadow_ub':np.full(len(b), np.nan), 'shadow_eq':np.full(n_eq, np.nan),
+        'range_ub':np.full((len(b), 2), np.nan),
+        'range_eq':np.full((n_eq, 2), np.nan)
+    }
+
+    # Move along the optimal face until the solution is a vertex
+    for iteration in range(n_var + 1):
+        s = slacks(z)
+        active = list(np.flatnonzero(s <= tol))
+        if active and np.linalg.matrix_rank(G[active], tol) == n_var:
+            break
+        # Directions that keep the active rows and the objective unchanged
+        M = np.concatenate((G[active], c.reshape(1, -1)), axis=0)
+        U, sv, Vt = np.linalg.svd(M)
+        rank = int(np.sum(sv > tol * max(1, sv[0])))
+        if rank == n_var:
+            return nan_result
+        d = Vt[rank]
+        step = None
+        for d in (d, -d):
+            Gd = G.dot(d)
+            blocking = [i for i in range(len(h)) if s[i] > tol and Gd[i] > tol]
+            if blocking:
+                step = min(s[i] / Gd[i] for i in blocking)
+                break
+        if step is None:
+            return nan_result
+        z = z + step * d
+    else:
+        return nan_result
+
+    # Find non-negative duals on the active set (free duals for equalities)
+    s = slacks(z)
+    active = list(np.flatnonzero(s <= tol))
+    active_eq = [i for i in active if i < n_eq]
+    active_ub = [i for i in active if i >= n_eq]
+    N = np.concatenate(
+        (G[active_eq].T, -G[active_eq].T, G[active_ub].T), axis=1
+    )
+    y_nn, residual = optimize.nnls(N, c)
+    if residual > tol * max(1, np.linalg.norm(c)):
+        return nan_result
+    k = len(active_eq)
+    y_active = np.append(y_nn[:k] - y_nn[k:2*k], y_nn[2*k:])
+    support = [i for i, y in zip(active, y_active) if abs(y) > tol]
+    support.sort(key=lambda i: -abs(y_active[active.index(i)]))
+
+    # Select an optimal basis, preferring equalities and rows with duals
+    order = active_eq + [i for i in support if i >= n_eq] + \
+            sorted(active_ub, key=lambda i: s[i])
+    basis = independent_rows(list(collections.OrderedDict.fromkeys(order)))
+    if len(basis) < n_var:
+        return nan_result
+    A_B = G[basis]
+    A_B_inv = np.linalg.inv(A_B)
+    y = np.zeros(len(h))
+    y[basis] = np.linalg.solve(A_B.T, c)
+
+    # Allowable right hand side ranges
+    z = A_B_inv.dot(h[basis])
+    s = h - G.dot(z)
+    non_basic = [i for i in range(len(h)) if i not in set(basis)]
+    ranges = np.zeros((len(h), 2))
+    for i in non_basic:
+        ranges[i] = [h[i] - max(s[i], 0), np.inf] if i >= n_eq else [h[i]]*2
+    for p, i in enumerate(basis):
+        Gd = G[non_basic].dot(A_B_inv[:,p])
+        lo, hi = -np.inf, np.inf
+        for j, g in zip(non_basic, Gd):
+            if abs(g) <= tol:
+                continue
+            if j < n_eq:
+                lo, hi = max(lo, 0), min(hi, 0)
+            elif g > 0:
+                hi = min(hi, max(s[j], 0) / g)
+            else:
+                lo = max(lo, max(s[j], 0) / g)
+        ranges[i] = [h[i] + lo, h[i] + hi]
+
+    return {
+        'shadow_ub':y[n_eq:], 'shadow_eq':y[:n_eq],
+        'range_ub':ranges[n_eq:], 'range_eq':ranges[:n_eq]
+    }
+
+
+def sensitivity_table(S, sensitivity, ratio_constraints=None,
+                      T=298.15, R=8.31e-3):
+    """Express MDF sensitivity results per reaction, compound and ratio
+
+    ARGUMENTS
+
+    S : pandas.DataFrame
+        The stoichiometric matrix used to construct the MDF problem.
+    sensitivity : dict
+        Output of mdf_sensitivity.
+    ratio_constraints : pandas.DataFrame, optional
+        The ratio constraints used to construct A_eq and b_eq.
+    T : float
+        Temperature (K).
+    R : float
+        Universal gas constant (kJ/(mol*K)).
+
+    RETURNS
+
+    pandas.DataFrame
+        One row per constraint with the columns:
+        constraint : string
+            'drG' for reaction standard Gibbs energies, 'xmax' and 'xmin' for
+            concentration bounds and 'ratio' for concentration ratios.
+        id : string
+            Reaction ID, compound ID or 'numerator_denominator' compound IDs.
+        shadow_price : float
+            Change in MDF (kJ/mol) per kJ/mol for 'drG', and per unit natural
+            logarithm of the concentration or ratio for the other constraints.
+        lower, upper : float
+            Allowable range of the standard Gibbs energy (kJ/mol),
+            concentration (M) or ratio within which the shadow price holds.
+    """
+    RT = R*T
+    n_rxn = S.shape[1]
+    n_cpd = S.shape[0]
+    y = sensitivity['shadow_ub']
+    r = sensitivity['range_ub']
+    # Reaction rows; b = -drG/RT
+    rows = [
+        ['drG', rxn_id, -y[j], -r[j,1]*RT, -r[j,0]*RT]
+        for j, rxn_id in enumerate(S.columns)
+    ]
+    # Upper concentration bound rows; b = ln(x_max)
+    rows.extend([
+        ['xmax', cpd_id, y[n_rxn+i]*RT, np.exp(r[n_rxn+i,0]),
+         np.exp(r[n_rxn+i,1])]
+        for i, cpd_id in enumerate(S.index)
+    ])
+    # Lower concentration bound rows; b = -ln(x_min)
+    rows.extend([
+        ['xmin', cpd_id, -y[n_rxn+n_cpd+i]*RT, np.exp(-r[n_rxn+n_cpd+i,1]),
+         np.exp(-r[n_rxn+n_cpd+i,0])]
+        for i, cpd_id in enumerate(S.index)
+    ])
+    # Ratio rows; b_eq = ln(ratio)
+    if ratio_constraints is not None and len(sensitivity['shadow_eq']):
+        u = sensitivity['shadow_eq']
+        q = sensitivity['range_eq']
+        rows.extend([
+            ['ratio', num + '_' + den, u[k]*RT, np.exp(q[k,0]), np.exp(q[k,1])]
+            for k, (num, den) in enumerate(zip(
+                ratio_constraints['cpd_id_num'], ratio_constraints['cpd_id_den']
+            ))
+        ])
+    return pd.DataFrame(rows, columns = [
+        'constraint', 'id', 'shadow_price', 'lower', 'upper'
+    ])
+
+
+def mdf_direction_search(c, A, b, A_eq=None, b_eq=None, find_all=False,
+                         presolve=False, tol=1e-9, solver='scipy'):
+    """Search reaction directions with branch-and-bound instead of enumeration
+
+    ARGUMENTS
+
+    c : numpy.array
+        The MDF c vector (see mdf_c).
+    A : numpy.matrix
+        The MDF A matrix for the reactions in their forward direction
+        (see mdf_A).
+    b : numpy.array
+        The MDF b vector for the reactions in their forward direction
+        (see mdf_b).
+    A_eq : numpy.matrix, optional
+        Equality constraints matrix for concentration ratios.
+    b_eq : numpy.array, optional
+        Equality constraints vector for concentration ratios.
+    find_all : bool, optional
+        Set to True to return all directions with a positive MDF rather than
+        only the direction with the highest MDF.
+    presolve : bool, optional
+        Set to True to presolve each optimization (see mdf_presolve).
+    tol : float, optional
+        Absolute tolerance in units of RT.
+    solver : string, optional
+        LP solver backend (see solve_lp).
+
+    RETURNS
+
+    list of tuples
+        One (direction, scipy.optimize.OptimizeResult) tuple per reported
+        direction, where direction is a list of 1 (forward) and -1 (reverse)
+        for each reaction. The list is empty if no direction is feasible.
+
+    NOTES
+
+    A node of the search tree fixes the direction of a subset of reactions. The
+    MDF problem with only the fixed reaction rows is a relaxation of every
+    direction below that node, so its optimum is an upper bound that is used
+    to prune the tree. Reactions whose reaction Gibbs energy has the same sign
+    at every concentration within the bounds are fixed before the search.
+    """
+    A = np.asarray(A, dtype=float)
+    b = np.asarray(b, dtype=float).flatten()
+    m = A.shape[1] - 1
+    n_rxn = A.shape[0] - 2*m
+
+    # Reaction Gibbs energies (RT units) are g = S^T x - b; split off the rows
+    S_T = A[:n_rxn,:m]
+    w = A[:n_rxn,m]
+    x_hi = b[n_rxn:n_rxn+m]
+    x_lo = -b[n_rxn+m:]
+    g_min = np.where(S_T > 0, S_T * x_lo, S_T * x_hi).sum(axis=1) - b[:n_rxn]
+    g_max = np.where(S_T > 0, S_T * x_hi, S_T * x_lo).sum(axis=1) - b[:n_rxn]
+
+    # Fix directions that are forced by the concentration bounds
+    fixed = {}
+    for j in range(n_rxn):
+        if g_max[j] < -tol:
+            fixed[j] = 1
+        elif g_min[j] > tol:
+            fixed[j] = -1
+
+    # The MDF can never exceed the best possible driving force of any pathway
+    # reaction; this bound keeps relaxations without pathway reactions finite
+    f_max = np.where(g_max < -tol, -g_min, np.maximum(-g_min, g_max))
+    B_cap = min([f_max[j] for j in range(n_rxn) if w[j]] + [np.inf])
+
+    def relaxation(fixed):
+        rows = sorted(fixed)
+        d = np.array([fixed[j] for j in rows])
+        A_node = np.column_stack((S_T[rows] * d[:,None], w[rows]))
+        b_node = b[rows] * d
+        A_node = np.concatenate((A_node, A[n_rxn:]), axis=0)
+        b_node = np.append(b_node, b[n_rxn:])
+        if np.isfinite(B_cap) and not any(w[rows]):
+            A_node = np.concatenate((A_node, [[0]*m + [1]]), axis=0)
+            b_node = np.append(b_node, B_cap)
+        return mdf(c, A_node, b_node, A_eq, b_eq, presolve, solver)
+
+    # Depth-first search with an explicit stack, as the tree is as deep as
+    # there are reactions. The stack holds the depth of each node and the
+    # direction it fixes; path holds the directions fixed below the root.
+    found = []
+    incumbent = -np.inf
+    root = fixed
+    path = []
+    stack = [(0, None, None)]
+    while stack:
+        depth, j, d = stack.pop()
+        del path[depth:]
+        if j is not None:
+            path.append((j, d))
+        fixed = dict(root)
+        fixed.update(path)
+        result = relaxation(fixed)
+        if not result.success:
+            continue
+        bound = result.x[-1]
+        if find_all and bound <= tol:
+            continue
+        if not find_all and bound <= incumbent + tol:
+            continue
+        free = [j for j in range(n_rxn) if j not in fixed]
+        if not free:
+            if find_all:
+                found.append((list(d for j, d in sorted(fixed.items())), result))
+            else:
+                found[:] = [(list(d for j, d in sorted(fixed.items())), result)]
+                incumbent = bound
+            continue
+        # Orient each free reaction along its driving force in the relaxation
+        g = S_T[free].dot(result.x[:-1]) - b[free]
+        slack = np.abs(g) - w[free] * bound
+        if not find_all and np.all(slack >= -tol):
+            # The relaxed solution is feasible for this completion; optimal
+            direction = dict(fixed)
+            direction.update(zip(free, [1 if x <= 0 else -1 for x in g]))
+            found[:] = [(list(d for j, d in sorted(direction.items())), result)]
+            incumbent = bound
+            continue
+        # Branch on the most violated (or most ambiguous) reaction first, in
+        # the preferred direction first
+        k = int(np.argmin(slack))
+        preferred = 1 if g[k] <= 0 else -1
+        for d in (-preferred, preferred):
+            stack.append((len(path), free[k], d))
+
+    return found
 
 
 def ratio_range(row):
@@ -425,30 +1114,28 @@ def ratio_iter(ratio_constraints):
     # For each possible ratio combination, yield a ratio_constraints DataFrame
     # that is expected by mdf_A_eq and mdf_b_eq
     for ratio_col in ratio_col_iter:
-        rats = pd.DataFrame(
-            [
-                list(ratio_constraints['cpd_id_num']),
-                list(ratio_constraints['cpd_id_den']),
-                list(ratio_col)
-            ],
-            index = list(ratio_constraints.columns[:3])
-        ).T
-        rats.ratio = rats.ratio.astype('float')
-        yield rats
+        yield ratio_frame(ratio_constraints, ratio_col)
+
+
+def ratio_frame(ratio_constraints, ratio_col):
+    """Construct the DataFrame expected by mdf_A_eq and mdf_b_eq"""
+    rats = pd.DataFrame(
+        [
+            list(ratio_constraints['cpd_id_num']),
+            list(ratio_constraints['cpd_id_den']),
+            list(ratio_col)
+        ],
+        index = list(ratio_constraints.columns[:3])
+    ).T
+    rats.ratio = rats.ratio.astype('float')
+    return rats
 
 
 def con_iter(constraints):
     """Iterator for constructing DataFrames expected by mdf_A and mdf_b"""
 
     # Go through the rows and identify those that should not have a range
-    non_range_rows = []
-    range_rows = []
-    for row_n in range(constraints.shape[0]):
-        row = constraints.iloc[row_n,]
-        if con_range(row) is None:
-            non_range_rows.append(row_n)
-        else:
-            range_rows.append(row_n)
+    range_rows = con_range_rows(constraints)
 
     # Construct concentration column iterator (all possible conc. combinations)
     col_iter = itertools.product(
@@ -458,18 +1145,187 @@ def con_iter(constraints):
     # For each possible conc. combination, yield a constraints DataFrame
     # that is expected by mdf_A and mdf_b
     for col in col_iter:
-        cons = pd.DataFrame(
-            [
-                list(constraints.iloc[range_rows,]['cpd_id']),
-                list(col), # x_min == x_max
-                list(col)  # x_max == x_min
-            ],
-            index = list(constraints.columns[:3])
-        ).T
-        cons = cons.append(constraints.iloc[non_range_rows,:3])
-        cons.x_min = cons.x_min.astype('float')
-        cons.x_max = cons.x_max.astype('float')
-        yield cons
+        yield con_frame(constraints, col)
+
+
+def con_range_rows(constraints):
+    """List the row numbers of constraints that have a concentration range"""
+    return [
+        row_n for row_n in range(constraints.shape[0])
+        if con_range(constraints.iloc[row_n,]) is not None
+    ]
+
+
+def con_frame(constraints, col):
+    """Construct the DataFrame expected by mdf_A and mdf_b
+
+    The concentrations in col are used as fixed concentrations for the ranged
+    rows of constraints, in order.
+    """
+    range_rows = con_range_rows(constraints)
+    non_range_rows = [
+        row_n for row_n in range(constraints.shape[0])
+        if row_n not in range_rows
+    ]
+    cons = pd.DataFrame(
+        [
+            list(constraints.iloc[range_rows,]['cpd_id']),
+            list(col), # x_min == x_max
+            list(col)  # x_max == x_min
+        ],
+        index = list(constraints.columns[:3])
+    ).T
+    cons = cons.append(constraints.iloc[non_range_rows,:3])
+    cons.x_min = cons.x_min.astype('float')
+    cons.x_max = cons.x_max.astype('float')
+    return cons
+
+
+def sweep_sizes(ratio_constraints, constraints):
+    """Number of grid points per ratio and ranged concentration constraint"""
+    sizes = []
+    if ratio_constraints is not None:
+        sizes.extend([
+            len(ratio_range(row)) for i, row in ratio_constraints.iterrows()
+        ])
+    sizes.extend([
+        len(con_range(constraints.iloc[row_n,]))
+        for row_n in con_range_rows(constraints)
+    ])
+    return sizes
+
+
+def sweep_frames(ratio_constraints, constraints, point):
+    """Ratio and concentration DataFrames for one point of a sweep grid
+
+    ARGUMENTS
+
+    ratio_constraints : pandas.DataFrame or None
+        Ratio constraints (see read_ratio_constraints).
+    constraints : pandas.DataFrame
+        Concentration constraints (see read_constraints).
+    point : tuple of int
+        Grid index for each ratio constraint followed by each ranged
+        concentration constraint (see sweep_sizes).
+
+    RETURNS
+
+    tuple
+        The DataFrames expected by mdf_A_eq and mdf_b_eq (None if there are no
+        ratio constraints) and by mdf_A and mdf_b, respectively.
+    """
+    if ratio_constraints is not None:
+        n_rats = ratio_constraints.shape[0]
+        rats = ratio_frame(ratio_constraints, [
+            ratio_range(row)[i] for i, (j, row) in
+            zip(point[:n_rats], ratio_constraints.iterrows())
+        ])
+    else:
+        n_rats = 0
+        rats = None
+    cons = con_frame(constraints, [
+        con_range(constraints.iloc[row_n,])[i] for i, row_n in
+        zip(point[n_rats:], con_range_rows(constraints))
+    ])
+    return rats, cons
+
+
+def adaptive_sweep(evaluate, differ, sizes, n_coarse=3):
+    """Evaluate a grid, refining only where neighbouring results differ
+
+    ARGUMENTS
+
+    evaluate : function
+        Takes a tuple of grid indices and returns a result.
+    differ : function
+        Takes two results and returns True if they are considered different.
+    sizes : list of int
+        Number of grid points in each dimension.
+    n_coarse : int, optional
+        Number of evenly spaced grid points per dimension to start from.
+
+    RETURNS
+
+    dict
+        Results of the evaluated grid points, keyed by their grid indices.
+
+    NOTES
+
+    The grid is divided into boxes between the coarse grid points. A box is
+    bisected along each dimension in which the results at the ends of one of
+    its edges differ, until neighbouring grid points are reached. Dimensions
+    along which the corner results agree are not evaluated further.
+    """
+    results = {}
+
+    def result(point):
+        if point not in results:
+            results[point] = evaluate(point)
+        return results[point]
+
+    # Set up the boxes of the coarse grid
+    coarse = [
+        sorted(set(np.linspace(0, n - 1, min(n, n_coarse)).round().astype(int)))
+        for n in sizes
+    ]
+    intervals = [
+        list(zip(c[:-1], c[1:])) if len(c) > 1 else [(c[0], c[0])]
+        for c in coarse
+    ]
+    boxes = list(itertools.product(*intervals))
+
+    # Bisect boxes along the edges with differing corner results, until the
+    # corners agree or the edges cannot be split further
+    while boxes:
+        box = boxes.pop()
+        corners = [
+            (point, result(point)) for point in
+            itertools.product(*[sorted(set(interval)) for interval in box])
+        ]
+        halves = []
+        for k, (lo, hi) in enumerate(box):
+            split = hi - lo > 1 and any(
+                differ(value, results[point[:k] + (hi,) + point[k+1:]])
+                for point, value in corners if point[k] == lo
+            )
+            if split:
+                halves.append([(lo, (lo + hi) // 2), ((lo + hi) // 2, hi)])
+            else:
+                halves.append([(lo, hi)])
+        if all(len(half) == 1 for half in halves):
+            continue
+        boxes.extend(itertools.product(*halves))
+
+    return results
+
+
+def mdf_signature(mdf_rows, pw_rxns, tol=1e-3):
+    """Directions, success and bottleneck reactions of multi_mdf output rows
+
+    Bottleneck reactions are pathway reactions with a driving force within
+    tol (kJ/mol) of the MDF. For batch NEM rows, pw_rxns is a dictionary
+    with the pathway reactions of each pathway.
+    """
+    signature = []
+    for mdf_row in mdf_rows:
+        row = mdf_row.iloc[0,:]
+        if isinstance(pw_rxns, dict):
+            rxn_ids = [
+                x for x in pw_rxns[row['pathway']] if 'drGopt_' + x in row.index
+            ]
+        else:
+            rxn_ids = pw_rxns
+        directions = tuple(
+            row[label] for label in mdf_row.columns if label.startswith('dir_')
+        )
+        if not row['success']:
+            signature.append((directions, 0, frozenset()))
+            continue
+        signature.append((directions, 1, frozenset(
+            rxn_id for rxn_id in rxn_ids
+            if -row['drGopt_' + rxn_id] <= row['MDF'] + tol
+        )))
+    return signature
 
 
 def calc_drGs(S, drGs_std, log_conc, T=298.15, R=8.31e-3):
@@ -482,9 +1338,406 @@ def calc_drGs(S, drGs_std, log_conc, T=298.15, R=8.31e-3):
     return drGs
 
 
+def mdf_column_labels(S, conditions, ratio_labels, sensitivity=False,
+                      sens_ratio_labels=None):
+    """Column labels of multi_mdf rows for a stoichiometric matrix
+
+    The sensitivity labels include those of sens_ratio_labels, by default of
+    all ratio_labels.
+    """
+    labels = [
+        *conditions,
+        *['drGstd_' + rxn_id for rxn_id in list(S.columns)],
+        *ratio_labels,
+        *['dir_' + rxn_id for rxn_id in list(S.columns)],
+        *['c_' + cpd_id for cpd_id in list(S.index)],
+        *['drGopt_' + rxn_id for rxn_id in list(S.columns)],
+        'success',
+        'MDF'
+    ]
+
+    # Add shadow price and allowable range labels
+    if sensitivity:
+        if sens_ratio_labels is None:
+            sens_ratio_labels = ratio_labels
+        sens_ids = [
+            *['drG_' + rxn_id for rxn_id in list(S.columns)],
+            *['xmax_' + cpd_id for cpd_id in list(S.index)],
+            *['xmin_' + cpd_id for cpd_id in list(S.index)],
+            *sens_ratio_labels
+        ]
+        labels.extend([
+            prefix + sens_id for prefix in ['sp_', 'lo_', 'hi_']
+            for sens_id in sens_ids
+        ])
+    return labels
+
+
+def mdf_networks(S, ratio_constraints=None, net_rxns=[], pathways=None):
+    """Networks of the MDF runs of each multi_mdf sweep point
+
+    Returns one (pathway ID, background network reactions, reaction indices,
+    compound indices, ratio indices) tuple per run. Without pathways, there
+    is one run of S, with all ratios (ratio indices None). With pathways,
+    the background network is net_rxns, or by default the model without the
+    reactions of any pathway (see pathway_background), and each run holds
+    the background network and the reactions of one pathway, and the
+    compounds of these reactions and those in ratios with them.
+    """
+    if pathways is None:
+        return [(
+            None, net_rxns, list(range(S.shape[1])), list(range(S.shape[0])),
+            None
+        )]
+    if net_rxns:
+        bg_rxns = list(net_rxns)
+    else:
+        bg_rxns = pathway_background(S, pathways)
+    networks = []
+    for pw_id, pw_rxns in pathways.items():
+        rxn_idx = [
+            j for j, x in enumerate(S.columns)
+            if x in set(bg_rxns) or x in set(pw_rxns)
+        ]
+        run_cpds = set(S.index[(S.iloc[:,rxn_idx] != 0).any(axis=1)])
+        ratio_idx = []
+        while ratio_constraints is not None:
+            ratio_idx = [
+                k for k in range(ratio_constraints.shape[0])
+                if run_cpds & set(ratio_constraints.iloc[k,:2])
+            ]
+            linked = set(ratio_constraints.iloc[ratio_idx,:2].values.flat)
+            if linked <= run_cpds:
+                break
+            run_cpds |= linked
+        cpd_idx = [i for i, x in enumerate(S.index) if x in run_cpds]
+        networks.append((pw_id, bg_rxns, rxn_idx, cpd_idx, ratio_idx))
+    return networks
+
+
+class NetworkMDF(object):
+    """MDF optimization of multi_mdf sweep points in each network
+
+    Calling the object with the condition (a row of all_drGs condition
+    identifiers, or None), direction (None to search it), ratio and
+    concentration constraints of a sweep point optimizes it in each network
+    (see mdf_networks) and returns the output rows (see mdf_output_row),
+    with the columns of S. The other arguments are those of multi_mdf.
+    """
+
+    def __init__(self, S, all_drGs, ratio_constraints=None, net_rxns=[],
+                 pathways=None, x_max=0.01, x_min=0.000001, T=298.15,
+                 R=8.31e-3, presolve=False, direction_search=None,
+                 sensitivity=False, solver='scipy'):
+        self.S = S
+        self.all_drGs = all_drGs
+        self.x_max = x_max
+        self.x_min = x_min
+        self.T = T
+        self.R = R
+        self.presolve = presolve
+        self.direction_search = direction_search
+        self.sensitivity = sensitivity
+        self.solver = solver
+        self.conditions = list(all_drGs.columns[1:-1])
+        if ratio_constraints is not None:
+            self.ratio_labels = [
+                'ratio_' + ratio_constraints.iloc[row,:]['cpd_id_num'] + \
+                '_' + ratio_constraints.iloc[row,:]['cpd_id_den'] \
+                for row in range(ratio_constraints.shape[0])
+            ]
+        else:
+            self.ratio_labels = []
+        self.column_labels = mdf_column_labels(
+            S, self.conditions, self.ratio_labels, sensitivity
+        )
+
+        # Networks with the output labels of their runs
+        self.networks = []
+        for network in mdf_networks(S, ratio_constraints, net_rxns, pathways):
+            pw_id, pw_net_rxns, rxn_idx, cpd_idx, ratio_idx = network
+            if ratio_idx is None:
+                run_labels = self.column_labels
+            else:
+                run_labels = mdf_column_labels(
+                    S.iloc[cpd_idx,rxn_idx], self.conditions,
+                    self.ratio_labels, sensitivity,
+                    [self.ratio_labels[k] for k in ratio_idx]
+                )
+            self.networks.append((*network, run_labels))
+
+    def problem(self, direction):
+        """Problem of the current sweep point for a direction"""
+        if tuple(direction) not in self.problems:
+            # Obtain standard reaction Gibbs energies with correct sign
+            drGs = self.drGs_std.copy()
+            drGs.loc[:,['drG']] = drGs['drG'] * direction
+            # Modify direction (sign) of reactions in the stoichiometric
+            # matrix
+            S_mod = self.S * direction
+            self.problems[tuple(direction)] = (
+                drGs, S_mod, mdf_c(S_mod), mdf_A(S_mod),
+                mdf_b(S_mod, drGs, self.constraints_mod, self.x_max,
+                      self.x_min, self.T, self.R)
+            )
+        return self.problems[tuple(direction)]
+
+    def run_problem(self, direction, pw_net_rxns, rxn_idx, cpd_idx):
+        """Problem with only the reactions and compounds of a run"""
+        drGs, S_mod, c, A, b = self.problem(direction)
+        n_rxn, m = S_mod.shape[1], S_mod.shape[0]
+        S_run = S_mod.iloc[cpd_idx,rxn_idx]
+        rows = rxn_idx + [n_rxn + i for i in cpd_idx] + \
+               [n_rxn + m + i for i in cpd_idx]
+        A = mdf_A_network(A[np.ix_(rows, cpd_idx + [m])], S_run, pw_net_rxns)
+        return drGs, S_run, c[cpd_idx + [m]], A, b[rows]
+
+    def __call__(self, condition, direction, rats, constraints_mod):
+        S = self.S
+        n_rxn = S.shape[1]
+        T, R = self.T, self.R
+
+        # Extract specific condition
+        if condition is not None:
+            condition = pd.DataFrame(condition[1]).T
+
+        # Obtain specific standard reaction Gibbs energies
+        if condition is not None:
+            drGs_std = pd.merge(condition, self.all_drGs)
+        else:
+            drGs_std = self.all_drGs.copy()
+        drGs_std.is_copy = False
+
+        # Build the problem for each direction once; the networks only
+        # differ in their rows and columns, and in the MDF column of A
+        self.drGs_std = drGs_std
+        self.constraints_mod = constraints_mod
+        self.problems = {}
+
+        mdf_rows = []
+        for pw_id, pw_net_rxns, rxn_idx, cpd_idx, ratio_idx, run_labels \
+        in self.networks:
+
+            # Use equality (ratio) constraints if they were specified; only
+            # the ratios of run compounds apply to the run
+            run_rats = rats
+            if rats is not None and ratio_idx is not None:
+                run_rats = rats.iloc[ratio_idx,:] if ratio_idx else None
+            A_eq = None
+            b_eq = None
+            if run_rats is not None:
+                A_eq = mdf_A_eq(S.iloc[cpd_idx,rxn_idx], run_rats)
+                b_eq = mdf_b_eq(run_rats)
+                # If the ratio constraints have been filtered out, set to None
+                if not A_eq.size or not b_eq.size:
+                    A_eq = None
+                    b_eq = None
+
+            # Reactions of other pathways keep their forward direction
+            if direction is not None and \
+            any(direction[j] != 1 for j in set(range(n_rxn)) - set(rxn_idx)):
+                continue
+
+            # Search for the directions to report, or use the given direction
+            if direction is None:
+                drGs, S_run, c, A, b = self.run_problem(
+                    [1]*n_rxn, pw_net_rxns, rxn_idx, cpd_idx
+                )
+                dir_results = []
+                for run_dir, mdf_result in mdf_direction_search(
+                    c, A, b, A_eq, b_eq, self.direction_search == 'feasible',
+                    self.presolve, solver=self.solver
+                ):
+                    full_dir = [1]*n_rxn
+                    for j, d in zip(rxn_idx, run_dir):
+                        full_dir[j] = d
+                    dir_results.append((full_dir, mdf_result))
+                if not dir_results:
+                    # No feasible direction; report a failure for the given one
+                    dir_results = [(
+                        [1]*n_rxn,
+                        optimize.OptimizeResult(x=None, success=False, status=2)
+                    )]
+            else:
+                dir_results = [(direction, None)]
+
+            for dir_result, mdf_result in dir_results:
+
+                # Perform MDF unless the direction search already did
+                drGs, S_run, c, A, b = self.run_problem(
+                    dir_result, pw_net_rxns, rxn_idx, cpd_idx
+                )
+                if mdf_result is None:
+                    mdf_result = mdf(
+                        c, A, b, A_eq, b_eq, self.presolve, self.solver
+                    )
+
+                # Calculate shadow prices and allowable ranges
+                sens_table = None
+                if self.sensitivity and mdf_result.success:
+                    sens_table = sensitivity_table(
+                        S_run,
+                        mdf_sensitivity(c, A, b, mdf_result.x, A_eq, b_eq),
+                        run_rats if A_eq is not None else None, T, R
+                    )
+
+                # Reactions and compounds that are not part of the run are
+                # left empty, and the reactions have direction 0
+                mdf_row = mdf_output_row(
+                    S_run, drGs, condition, rats,
+                    [dir_result[j] for j in rxn_idx], mdf_result,
+                    run_labels, T, R, self.sensitivity, sens_table
+                )
+                if run_labels is not self.column_labels:
+                    mdf_row = mdf_row.reindex(columns=self.column_labels)
+                    for j in set(range(n_rxn)) - set(rxn_idx):
+                        mdf_row['dir_' + S.columns[j]] = 0
+                if pw_id is not None:
+                    mdf_row.insert(0, 'pathway', pw_id)
+                mdf_rows.append(mdf_row)
+        return mdf_rows
+
+
+def mdf_rows_differ(rows_1, rows_2, pw_rxns, tol):
+    """
+    Whether the multi_mdf rows of two sweep points differ in their
+    signature (see mdf_signature) or by more than tol (kJ/mol) in an MDF.
+    """
+    return mdf_signature(rows_1, pw_rxns, tol) != \
+           mdf_signature(rows_2, pw_rxns, tol) or any(
+        abs(r_1.MDF.iloc[0] - r_2.MDF.iloc[0]) > tol
+        for r_1, r_2 in zip(rows_1, rows_2) if r_1.success.iloc[0]
+    )
+
+
+def adaptive_mdf_rows(run, condition, direction, ratio_constraints,
+                      constraints, pw_rxns, tol):
+    """Rows of an adaptive sweep of the ratio and concentration grid
+
+    The grid of ratio_constraints and constraints (see sweep_sizes) is
+    evaluated with run (see NetworkMDF) for a condition and direction,
+    refining it where the results change by more than tol (see
+    adaptive_sweep and mdf_rows_differ). Returns the rows in grid order.
+    """
+    def evaluate(point):
+        rats, constraints_mod = sweep_frames(
+            ratio_constraints, constraints, point
+        )
+        return run(condition, direction, rats, constraints_mod)
+    results = adaptive_sweep(
+        evaluate,
+        lambda rows_1, rows_2: mdf_rows_differ(rows_1, rows_2, pw_rxns, tol),
+        sweep_sizes(ratio_constraints, constraints)
+    )
+    return [mdf_row for point in sorted(results) for mdf_row in results[point]]
+
+
+class MDFTableWriter(object):
+    """Collects multi_mdf rows in chunks
+
+    Rows are added with add(mdf_row, sweep_n), and chunks of up to
+    chunk_size rows are passed to chunk_writer (see ColumnarWriter) as they
+    fill up, or appended to a table with table_labels. With a shard, each
+    chunk starts with a 'point' column with the sweep point numbers of the
+    rows (see merge_shards). close() writes the last chunk and returns the
+    table, or None with a chunk_writer.
+    """
+
+    def __init__(self, table_labels, shard=None, chunk_writer=None,
+                 chunk_size=10000):
+        if shard is not None:
+            table_labels = ['point'] + table_labels
+        self.table = pd.DataFrame(columns = table_labels)
+        self.shard = shard
+        self.chunk_writer = chunk_writer
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.any_rows = False
+
+    def add(self, mdf_row, sweep_n):
+        self.rows.append((mdf_row, sweep_n))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        chunk = pd.concat([mdf_row for mdf_row, sweep_n in self.rows])
+        # Identify the sweep point of each row in shards (see merge_shards)
+        if self.shard is not None:
+            chunk.insert(0, 'point', [sweep_n for mdf_row, sweep_n in self.rows])
+        del self.rows[:]
+        if self.chunk_writer is not None:
+            self.chunk_writer(chunk)
+            self.any_rows = True
+        else:
+            self.table = self.table.append(chunk)
+
+    def close(self):
+        self.flush()
+        if self.chunk_writer is not None:
+            # Without rows, still write the column labels
+            if not self.any_rows:
+                self.chunk_writer(self.table)
+            return None
+        return self.table
+
+
+def mdf_sweep(all_drGs, n_rxn, all_directions=False, direction_search=None,
+              sizes=None, shard=None):
+    """Sweep points of multi_mdf
+
+    Returns an iterator of (sweep point number, (condition, direction,
+    grid point)) tuples, and the number of points it holds. Conditions are
+    rows of the condition identifiers of all_drGs (or None), directions are
+    None if they are searched, and grid points are tuples of indices in the
+    grid of sizes (see sweep_sizes), or left out if sizes is None. With a
+    shard, only every Nth point is included, starting at the ith.
+    """
+    conditions = list(all_drGs.columns[1:-1])
+
+    # Set up conditions iterator
+    if len(conditions):
+        condition_rows = all_drGs[conditions].drop_duplicates()
+        cond_iter = condition_rows.iterrows()
+        n_points = condition_rows.shape[0]
+    else:
+        cond_iter = [None]
+        n_points = 1
+
+    # Set up directions iterator
+    if direction_search:
+        dir_iter = [None] # Directions are searched per combination
+    elif not all_directions:
+        dir_iter = [[1]*n_rxn]
+    else:
+        dir_iter = itertools.product([1,-1], repeat=n_rxn)
+        n_points *= 2**n_rxn
+
+    # Set up the ratio and concentration grid points iterator; the
+    # DataFrames are only built for the points that are optimized (see
+    # sweep_frames)
+    if sizes is None:
+        points = enumerate(itertools.product(cond_iter, dir_iter))
+    else:
+        point_iter = itertools.product(*[range(size) for size in sizes])
+        points = enumerate(itertools.product(cond_iter, dir_iter, point_iter))
+        for size in sizes:
+            n_points *= size
+
+    # Select the sweep points of this shard by index
+    if shard is not None:
+        points = itertools.islice(points, shard[0], None, shard[1])
+        n_points = len(range(shard[0], n_points, shard[1]))
+    return points, n_points
+
+
 def multi_mdf(S, all_drGs, constraints, ratio_constraints=None, net_rxns=[],
               all_directions=False, x_max=0.01, x_min=0.000001,
-              T=298.15, R=8.31e-3):
+              T=298.15, R=8.31e-3, presolve=False, direction_search=None,
+              sensitivity=False, adaptive_tol=None, shard=None,
+              chunk_writer=None, chunk_size=10000, pathways=None,
+              solver='scipy'):
     """Run MDF optimization for all condition combinations
 
     ARGUMENTS
@@ -512,7 +1765,8 @@ def multi_mdf(S, all_drGs, constraints, ratio_constraints=None, net_rxns=[],
         network-embedded MDF analysis (NEM). The reactions should be in S.
     all_directions : bool, optional
         Set to True to calculate MDF for all possible reaction direction
-        combinations. Not recommended for sets of reactions >20.
+        combinations. Not recommended for sets of reactions >20; use
+        direction_search for larger sets.
     x_max : float
         Maximum default metabolite concentration (M).
     x_min : float
@@ -521,11 +1775,51 @@ def multi_mdf(S, all_drGs, constraints, ratio_constraints=None, net_rxns=[],
         Temperature (K).
     R : float
         Universal gas constant (kJ/(mol*K)).
+    presolve : bool, optional
+        Set to True to eliminate fixed concentrations and ratio-coupled
+        concentrations before each optimization (see mdf_presolve).
+    direction_search : string, optional
+        Set to 'best' to find the reaction directions with the highest MDF, or
+        to 'feasible' to find all reaction directions with a positive MDF,
+        using branch-and-bound (see mdf_direction_search). Takes precedence
+        over all_directions.
+    sensitivity : bool, optional
+        Set to True to add shadow prices and allowable ranges for all
+        constraints to the output (see mdf_sensitivity and sensitivity_table).
+    adaptive_tol : float, optional
+        MDF tolerance (kJ/mol) for an adaptive sweep of the ratio and
+        concentration ranges. The full grid is only evaluated where the MDF,
+        success or bottleneck reactions change between neighbouring grid
+        points (see adaptive_sweep). By default the full grid is evaluated.
+    shard : tuple of int, optional
+        Shard index i and number of shards N. Only every Nth combination of
+        conditions, directions, ratios and concentrations is optimized,
+        starting at the ith (or every Nth combination of conditions and
+        directions with adaptive_tol). The output then starts with a 'point'
+        column that identifies the combination (see merge_shards).
+    chunk_writer : function, optional
+        Called with DataFrames of up to chunk_size rows, in sweep order, as
+        they are solved (see ColumnarWriter). Nothing is returned and the
+        rows are not kept in memory.
+    chunk_size : int, optional
+        Number of rows per chunk.
+    pathways : dict, optional
+        Pathway identifiers and lists of pathway reaction IDs for batch NEM.
+        Each combination is optimized for every pathway, in a network of the
+        pathway reactions and the background network reactions, and the
+        output starts with a 'pathway' column. The background network is
+        net_rxns, or by default the reactions in S that are in no pathway.
+        Only the compounds of these reactions, and those in ratios with them,
+        are part of the run. Other reactions and compounds have no results in
+        the pathway rows, and the reactions have direction 0.
+    solver : string, optional
+        LP solver backend (see solve_lp).
 
     RETURNS
 
     mdf_table : pandas.DataFrame
-        A Pandas DataFrame containing all MDF results for a single pathway. Each
+        A Pandas DataFrame containing all MDF results for a single pathway, or
+        None if chunk_writer is specified. Each
         row corresponds to one individual MDF optimization, with the parameters
         described in the columns:
         v0 ... : string
@@ -547,169 +1841,435 @@ def multi_mdf(S, all_drGs, constraints, ratio_constraints=None, net_rxns=[],
         MDF : float
             The Max-min Driving Force determined through linear optimization
             (kJ/mol).
+        sp_[constraint]_[id], lo_[constraint]_[id], hi_[constraint]_[id] : float
+            Only if sensitivity is True. Shadow price and allowable range for
+            each reaction standard Gibbs energy ('drG'), upper ('xmax') and
+            lower ('xmin') concentration bound and ratio ('ratio'), in the
+            units described for sensitivity_table.
     """
     # All drGs
     # ->  All ratio combinations
     #     ->  All directions
 
-    # Number of reactions
-    n_rxn = S.shape[1]
-
-    # List the condition identifiers
-    conditions = list(all_drGs.columns[1:-1])
-
-    # Create column labels for output DataFrame
-    if ratio_constraints is not None:
-        ratio_labels = [
-            'ratio_' + ratio_constraints.iloc[row,:]['cpd_id_num'] + \
-            '_' + ratio_constraints.iloc[row,:]['cpd_id_den'] \
-            for row in range(ratio_constraints.shape[0])
-        ]
-    else:
-        ratio_labels = []
-
-    column_labels = [
-        *conditions,
-        *['drGstd_' + rxn_id for rxn_id in list(S.columns)],
-        *ratio_labels,
-        *['dir_' + rxn_id for rxn_id in list(S.columns)],
-        *['c_' + cpd_id for cpd_id in list(S.index)],
-        *['drGopt_' + rxn_id for rxn_id in list(S.columns)],
-        'success',
-        'MDF'
-    ]
+    # Set up the networks of each sweep point
+    run = NetworkMDF(
+        S, all_drGs, ratio_constraints, net_rxns, pathways, x_max, x_min, T,
+        R, presolve, direction_search, sensitivity, solver
+    )
 
     # Also create labels for sorting (conditions, ratios and directions)
     sort_labels = [
-        *conditions,
-        *ratio_labels,
+        *run.conditions,
+        *run.ratio_labels,
         *['dir_' + rxn_id for rxn_id in list(S.columns)]
     ]
 
-    # Iterator preparation
-    def prep_iter():
+    # Set up output DataFrame or chunk_writer
+    table_labels = run.column_labels
+    if pathways is not None:
+        table_labels = ['pathway'] + table_labels
+        sort_labels = ['pathway'] + sort_labels
+    writer = MDFTableWriter(table_labels, shard, chunk_writer, chunk_size)
 
-        # Set up conditions iterator
-        if len(conditions):
-            cond_iter = all_drGs[conditions].drop_duplicates().iterrows()
+    # Adaptive sweeps choose ratios and concentrations themselves
+    if adaptive_tol is None:
+        sizes = sweep_sizes(ratio_constraints, constraints)
+    else:
+        sizes = None
+        if pathways is not None:
+            pw_rxns = pathways
         else:
-            cond_iter = [None]
+            pw_rxns = [
+                rxn_id for rxn_id in S.columns if rxn_id not in set(net_rxns)
+            ]
 
-        # Set up directions iterator
-        if not all_directions:
-            dir_iter = [[1]*n_rxn]
-        else:
-            dir_iter = itertools.product([1,-1], repeat=n_rxn)
+    # Iterate over all combinations of conditions, directions and ratios
+    sweep_points, M = mdf_sweep(
+        all_drGs, S.shape[1], all_directions, direction_search, sizes, shard
+    )
+    n = 0
 
-        # Set up ratios iterator
-        if ratio_constraints is not None:
-            rats_iter = ratio_iter(ratio_constraints)
+    for sweep_n, params in sweep_points:
+        n += 1
+        progress = float(n / M * 100)
+        sWrite("\rPerforming MDF optimization... %0.1f%%" % progress)
+
+        if adaptive_tol is None:
+            rats, constraints_mod = sweep_frames(
+                ratio_constraints, constraints, params[2]
+            )
+            mdf_rows = run(*params[:2], rats, constraints_mod)
         else:
-            rats_iter = [None]
+            # Refine the ratio and concentration grid where the results change
+            mdf_rows = adaptive_mdf_rows(
+                run, *params, ratio_constraints, constraints, pw_rxns,
+                adaptive_tol
+            )
+        for mdf_row in mdf_rows:
+            writer.add(mdf_row, sweep_n)
+
+    mdf_table = writer.close()
+    if mdf_table is None:
+        return None
 
-        # Set up fixed concentration range constraints iterator
-        cons_iter = con_iter(constraints)
+    # Sort stably, so that ties keep the sweep order
+    return mdf_table.sort_values(sort_labels, kind='mergesort')
 
-        return itertools.product(cond_iter, dir_iter, rats_iter, cons_iter)
 
-    # Set up output DataFrame
-    mdf_table = pd.DataFrame(columns = column_labels)
+def parse_shard(shard_text):
+    """Parse a shard specification 'i/N' into a tuple (i, N), with 0 <= i < N"""
+    try:
+        i, N = [int(x) for x in shard_text.split("/")]
+    except ValueError:
+        raise ValueError("Shard should be specified as 'i/N': %s" % shard_text)
+    if not 0 <= i < N:
+        raise ValueError("Shard index should be in the range 0 to N-1: %s" % \
+                         shard_text)
+    return i, N
 
-    # Determine number of rows that will be produced
-    M = 0
-    for i in prep_iter():
-        M += 1
 
-    # Iterate over all combinations of conditions, directions and ratios
-    n = 0
+def pathway_background(S, pathways):
+    """Reactions in S that are in none of the pathways (see multi_mdf)"""
+    pw_rxns_all = set(x for pw_rxns in pathways.values() for x in pw_rxns)
+    return [x for x in S.columns if x not in pw_rxns_all]
 
-    for params in prep_iter():
-        n += 1
-        progress = float(n / M * 100)
-        sWrite("\rPerforming MDF optimization... %0.1f%%" % progress)
-        # Extract specific condition, direction and ratio constraints
-        if params[0] is not None:
-            condition = pd.DataFrame(params[0][1]).T
-        else:
-            condition = None
-        direction = params[1]
-        rats = params[2]
-        constraints_mod = params[3]
 
-        # Obtain specific standard reaction Gibbs energies with correct sign
-        if condition is not None:
-            drGs = pd.merge(condition, all_drGs)
-        else:
-            drGs = all_drGs
-        drGs.is_copy = False
-        drGs.loc[:,['drG']] = drGs['drG'] * direction
-
-        # Modify direction (sign) of reactions in the stoichiometric matrix
-        S_mod = S * direction
-
-        # Set up MDF inputs
-        c = mdf_c(S_mod)
-        A = mdf_A(S_mod, net_rxns)
-        b = mdf_b(S_mod, drGs, constraints_mod, x_max, x_min, T, R)
-
-        # Use equality (ratio) constraints if they were specified
-        if rats is not None:
-            A_eq = mdf_A_eq(S_mod, rats)
-            b_eq = mdf_b_eq(rats)
-            # If the ratio constraints have been filtered out, set to None
-            if not A_eq.size or not b_eq.size:
-                A_eq = None
-                b_eq = None
-        else:
-            A_eq = None
-            b_eq = None
+def read_pathway_lists(pathways_path):
+    """Read pathway reaction lists for batch NEM
+
+    ARGUMENTS
 
-        # Perform MDF
-        mdf_result = mdf(c, A, b, A_eq, b_eq)
+    pathways_path : string
+        Either a directory with one pathway reactions file (one reaction ID
+        per line) per pathway, named after the pathway, or a file in which
+        each pathway reaction list starts with a '>' line with the pathway
+        name.
 
-        # Prepare conditions list
-        if condition is not None:
-            conditions_list = list(condition.iloc[0,:])
-        else:
-            conditions_list = []
+    RETURNS
+
+    collections.OrderedDict
+        Pathway names and lists of pathway reaction IDs.
+    """
+    pathways = collections.OrderedDict()
+    if os.path.isdir(pathways_path):
+        for file_name in sorted(os.listdir(pathways_path)):
+            file_path = os.path.join(pathways_path, file_name)
+            if file_name.startswith('.') or not os.path.isfile(file_path):
+                continue
+            pathways[os.path.splitext(file_name)[0]] = list(filter(None,
+                [x.strip() for x in open(file_path, 'r').readlines()]))
+        return pathways
+    pw_id = None
+    for line in open(pathways_path, 'r').readlines():
+        line = line.strip()
+        if line.startswith('>'):
+            pw_id = line[1:].strip()
+            pathways[pw_id] = []
+        elif line:
+            if pw_id is None:
+                raise ValueError("Pathway reactions should follow a '>' line.")
+            pathways[pw_id].append(line)
+    return pathways
+
+
+def mdf_table_labels(columns):
+    """Condition and sort labels of multi_mdf output columns
+
+    RETURNS
+
+    tuple of lists
+        The condition identifier columns, and the columns multi_mdf sorts by
+        (conditions, ratios and directions).
+    """
+    columns = [x for x in columns if x != 'point']
+    first_drG = [x.startswith('drGstd_') for x in columns].index(True)
+    conditions = columns[:first_drG]
+    return conditions, conditions + [
+        x for x in columns if x.startswith(('ratio_', 'dir_'))
+    ]
+
+
+class ColumnarWriter(object):
+    """Stream multi_mdf output chunks to a compressed file of column arrays
+
+    The file is a zip archive in the numpy .npz format. Each chunk adds one
+    array per column, so only one chunk is held in memory. Use as the
+    chunk_writer of multi_mdf, call close when done, and read the result
+    with read_columnar or convert it with columnar_to_csv.
+    """
+
+    def __init__(self, outfile_name):
+        self.zip_file = zipfile.ZipFile(
+            outfile_name, 'w', zipfile.ZIP_DEFLATED, allowZip64=True
+        )
+        self.columns = None
+        self.n_chunks = 0
+
+    def write_array(self, name, array):
+        with self.zip_file.open(name + '.npy', 'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    def __call__(self, chunk):
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            self.conditions = mdf_table_labels(self.columns)[0]
+            self.write_array('columns', np.array(self.columns))
+        for k, label in enumerate(self.columns):
+            if label in self.conditions:
+                array = np.array(chunk[label], dtype=str)
+            elif label in ['point', 'success'] or label.startswith('dir_'):
+                array = np.array(chunk[label], dtype=np.int64)
+            else:
+                array = np.array(chunk[label], dtype=np.float64)
+            self.write_array('%d/%06d' % (k, self.n_chunks), array)
+        self.n_chunks += 1
+
+    def close(self):
+        self.zip_file.close()
+
+
+def read_columnar(infile_name):
+    """Read a file written by ColumnarWriter into a DataFrame"""
+    with np.load(infile_name, allow_pickle=False) as npz:
+        if 'columns' not in npz.files:
+            return pd.DataFrame()
+        columns = list(npz['columns'])
+        n_chunks = len([x for x in npz.files if x.startswith('0/')])
+        return pd.DataFrame(collections.OrderedDict(
+            (label, np.concatenate([
+                npz['%d/%06d' % (k, chunk_n)] for chunk_n in range(n_chunks)
+            ])) for k, label in enumerate(columns)
+        ))
+
+
+def columnar_to_csv(infile_name, outfile_name, chunk_size=10000):
+    """Convert a ColumnarWriter file to the csv file main would write
+
+    Rows are sorted like those of multi_mdf and written in chunks. A file
+    without rows gives a csv file with only the header, or an empty csv
+    file if it has no column labels either.
+    """
+    mdf_table = read_columnar(infile_name)
+    if mdf_table.shape[1] == 0:
+        sWrite("No MDF results in %s.\n" % infile_name)
+        open(outfile_name, 'w').close()
+        return
+    sort_labels = mdf_table_labels(mdf_table.columns)[1]
+    if 'point' in mdf_table.columns:
+        sort_labels.append('point')
+    mdf_table = mdf_table.sort_values(sort_labels, kind='mergesort')
+    with open(outfile_name, 'w') as outfile:
+        # The first chunk writes the header, also without rows
+        for start in range(0, max(mdf_table.shape[0], 1), chunk_size):
+            mdf_table.iloc[start:start + chunk_size,:].to_csv(
+                outfile, header=(start == 0), na_rep='NA', index=False,
+                float_format='%.10f'
+            )
+
+
+def merge_shards(shard_files, outfile_name):
+    """Combine shard result files into the table of a single MDF run
+
+    ARGUMENTS
 
-        # Prepare ratios list
-        if rats is not None:
-            rats_list = list(rats.ratio)
+    shard_files : list of strings
+        Paths to csv files written by main with shard specified, for all
+        shards of one sweep.
+    outfile_name : string
+        Path of the combined csv file.
+
+    NOTES
+
+    The rows are sorted like those of multi_mdf, with ties in sweep order,
+    and all values are copied verbatim. Shards without rows only have a
+    header, and empty shard files are skipped.
+    """
+    # Read everything as text to write the values back unchanged
+    tables = []
+    for shard_file in shard_files:
+        if os.path.getsize(shard_file) == 0:
+            sWrite("Skipping empty shard %s.\n" % shard_file)
+            continue
+        tables.append(
+            pd.read_csv(shard_file, dtype=str, keep_default_na=False)
+        )
+    if not tables:
+        sWrite("No MDF results in the shards.\n")
+        open(outfile_name, 'w').close()
+        return
+    mdf_table = pd.concat(tables, ignore_index=True)
+
+    # Sort by conditions, ratios and directions, then by sweep point
+    columns = list(mdf_table.columns[1:])
+    conditions, sort_labels = mdf_table_labels(columns)
+    sort_table = mdf_table[conditions].copy()
+    for label in sort_labels[len(conditions):] + ['point']:
+        sort_table[label] = pd.to_numeric(mdf_table[label])
+    order = sort_table.sort_values(
+        sort_labels + ['point'], kind='mergesort'
+    ).index
+    mdf_table = mdf_table.loc[order, columns]
+
+    mdf_table.to_csv(outfile_name, index=False)
+
+
+def mdf_output_row(S_mod, drGs, condition, rats, direction, mdf_result,
+                   column_labels, T=298.15, R=8.31e-3, sensitivity=False,
+                   sens_table=None):
+    """Format one MDF result as a single row DataFrame for multi_mdf"""
+    # Prepare conditions list
+    if condition is not None:
+        conditions_list = list(condition.iloc[0,:])
+    else:
+        conditions_list = []
+
+    # Prepare ratios list
+    if rats is not None:
+        rats_list = list(rats.ratio)
+    else:
+        rats_list = []
+
+    # Format results row
+    mdf_row = [
+        *conditions_list,
+        *[float(drGs[drGs.rxn_id == rxn_id]['drG']) for rxn_id in S_mod.columns],
+        *rats_list,
+        *direction,
+    ]
+    if mdf_result.success:
+        mdf_row.extend([
+            *np.exp(mdf_result.x[:-1]), # Concentrations
+            *calc_drGs(S_mod, drGs, mdf_result.x[:-1], T, R), # Reaction Gibbs energies
+            1, # Success
+            mdf_result.x[-1]*R*T # MDF value
+        ])
+    else:
+        mdf_row.extend([
+            *[np.nan]*S_mod.shape[0], # Concentrations
+            *[np.nan]*S_mod.shape[1], # Reaction Gibbs energies
+            0, # Failure
+            np.nan # No MDF value
+        ])
+    if sensitivity:
+        n_sens = len(column_labels) - len(mdf_row)
+        if sens_table is None:
+            # No sensitivity results for failed optimizations
+            mdf_row.extend([np.nan]*n_sens)
+        elif 3*sens_table.shape[0] != n_sens:
+            raise ValueError(
+                "Sensitivity table has %d rows, but %d columns are expected" % \
+                (sens_table.shape[0], n_sens)
+            )
         else:
-            rats_list = []
-
-        # Format results row
-        mdf_row = [
-            *conditions_list,
-            *[float(drGs[drGs.rxn_id == rxn_id]['drG']) for rxn_id in S_mod.columns],
-            *rats_list,
-            *direction,
+            for column in ['shadow_price', 'lower', 'upper']:
+                mdf_row.extend(list(sens_table[column]))
+    return pd.DataFrame([mdf_row], columns = column_labels)
+
+
+def benchmark_solvers(example_dir='examples', models=['E_coli', 'Synechocystis'],
+                      solvers=LP_SOLVERS, repeats=3, T=298.15, R=8.31e-3,
+                      seed=0):
+    """Time the LP solver backends on the example models
+
+    ARGUMENTS
+
+    example_dir : string, optional
+        Directory with the '<model>.model.tab', '<model>.concentrations.tab',
+        '<model>.Lys_opt_ratios.tab' and '<model>.Lys_pathway.txt' files.
+    models : list of strings, optional
+        Model names.
+    solvers : list of strings, optional
+        LP solver backends (see solve_lp).
+    repeats : int, optional
+        Number of timed optimizations per problem and solver; the fastest is
+        reported.
+    T : float
+        Temperature (K).
+    R : float
+        Universal gas constant (kJ/(mol*K)).
+    seed : int, optional
+        Seed for the standard reaction Gibbs energies.
+
+    RETURNS
+
+    pandas.DataFrame
+        One row per model, problem ('MDF' or 'NEM' with the lysine pathway
+        embedded in the rest of the model) and solver, with the fastest time
+        (s), the status and the MDF value (kJ/mol).
+
+    NOTES
+
+    The examples do not include standard reaction Gibbs energies, so
+    reproducible values are drawn that make every reaction at least 25 kJ/mol
+    favourable at the midpoint of the (log) concentration bounds, with the
+    ratios applied.
+    """
+    x_max = 0.1
+    x_min = 0.0000001
+    rows = []
+    for model in models:
+        path = os.path.join(example_dir, model)
+        S = read_reactions(open(path + '.model.tab', 'r').read())
+        constraints = read_constraints(
+            open(path + '.concentrations.tab', 'r').read()
+        )
+        ratio_constraints = read_ratio_constraints(
+            open(path + '.Lys_opt_ratios.tab', 'r').read()
+        )
+        ratio_constraints = ratio_constraints[
+            ratio_constraints['cpd_id_num'].isin(S.index) & \
+            ratio_constraints['cpd_id_den'].isin(S.index)
         ]
-        if mdf_result.success:
-            mdf_row.extend([
-                *np.exp(mdf_result.x[:-1]), # Concentrations
-                *calc_drGs(S_mod, drGs, mdf_result.x[:-1]), # Reaction Gibbs energies
-                1, # Success
-                mdf_result.x[-1]*R*T # MDF value
-            ])
-        else:
-            mdf_row.extend([
-                *[np.nan]*S_mod.shape[0], # Concentrations
-                *[np.nan]*S_mod.shape[1], # Reaction Gibbs energies
-                0, # Failure
-                np.nan # No MDF value
-            ])
-        # Append row to expected result
-        mdf_table = mdf_table.append(pd.DataFrame([mdf_row], columns = column_labels))
+        pw_rxns = list(filter(None,
+                       [x.strip() for x in open(path + '.Lys_pathway.txt', 'r')]))
+
+        # Draw standard reaction Gibbs energies feasible at the midpoint
+        bounds = constraints.set_index('cpd_id')
+        x_mid = np.array([
+            np.log(bounds.loc[cpd, ['x_min', 'x_max']].astype(float)).mean()
+            if cpd in bounds.index else np.log([x_min, x_max]).mean()
+            for cpd in S.index
+        ])
+        for row in ratio_constraints.index:
+            x_mid[S.index.get_loc(ratio_constraints.loc[row, 'cpd_id_num'])] = \
+                x_mid[S.index.get_loc(ratio_constraints.loc[row, 'cpd_id_den'])] + \
+                np.log(ratio_constraints.loc[row, 'ratio'])
+        std_drG = -R*T*S.T.dot(x_mid).values - \
+                  np.random.RandomState(seed).uniform(25, 40, S.shape[1])
+        drGs = pd.DataFrame({'rxn_id':S.columns, 'drG':std_drG})
+
+        c = mdf_c(S)
+        b = mdf_b(S, drGs, constraints, x_max, x_min, T, R)
+        A_eq = mdf_A_eq(S, ratio_constraints)
+        b_eq = mdf_b_eq(ratio_constraints)
+        net_rxns = [rxn for rxn in S.columns if rxn not in pw_rxns]
+        for problem, A in [('MDF', mdf_A(S)), ('NEM', mdf_A(S, net_rxns))]:
+            for solver in solvers:
+                times = []
+                for i in range(repeats):
+                    start = time.time()
+                    result = mdf(c, A, b, A_eq, b_eq, solver=solver)
+                    times.append(time.time() - start)
+                rows.append([
+                    model, problem, solver, min(times), result.status,
+                    result.x[-1]*R*T if result.success else np.nan
+                ])
+    return pd.DataFrame(rows, columns=[
+        'model', 'problem', 'solver', 'seconds', 'status', 'mdf'
+    ])
 
-    return mdf_table.sort_values(sort_labels)
+
+def multi_mdf_group(mdf_args):
+    """Run multi_mdf on a tuple of arguments, for Pool.imap"""
+    return multi_mdf(*mdf_args)
 
 
 # Main code block
 def main(reaction_file, std_drG_file, outfile_name, cons_file, ratio_cons_file,
          pw_rxn_file, all_directions, T=298.15, R=8.31e-3, proton_name='C00080',
-         x_max_default=0.01, x_min_default=0.000001):
+         x_max_default=0.01, x_min_default=0.000001, presolve=False,
+         direction_search=None, sensitivity=False, adaptive_tol=None,
+         shard=None, pathways_path=None, n_procs=1, solver='scipy'):
 
     # Load stoichiometric matrix
     sWrite("\nLoading stoichiometric matrix...")
@@ -752,12 +2312,73 @@ def main(reaction_file, std_drG_file, outfile_name, cons_file, ratio_cons_file,
         sWrite(" Done.\n")
     else:
         net_rxns = []
+    if pathways_path:
+        sWrite("Reading pathway reactions for batch NEM...")
+        pathways = read_pathway_lists(pathways_path)
+        sWrite(" Done.\n")
+    else:
+        pathways = None
+
+    # Stream results to a columnar file if the outfile name ends with .npz
+    if outfile_name.endswith('.npz'):
+        chunk_writer = ColumnarWriter(outfile_name)
+    else:
+        chunk_writer = None
 
     sWrite("Performing MDF optimization...")
-    mdf_table = multi_mdf(S, std_drGs, constraints, ratio_constraints, net_rxns,
-                          all_directions, x_max_default, x_min_default, T, R)
+    mdf_args = (
+        S, std_drGs, constraints, ratio_constraints, net_rxns, all_directions,
+        x_max_default, x_min_default, T, R, presolve, direction_search,
+        sensitivity, adaptive_tol, shard
+    )
+    if pathways and n_procs > 1:
+        # Divide the pathways into consecutive groups, several per process,
+        # so that only the tables of the groups being written are held in
+        # memory
+        pw_items = sorted(pathways.items())
+        group_size = -(-len(pw_items) // (4*n_procs))
+        pw_groups = [
+            collections.OrderedDict(pw_items[i:i + group_size])
+            for i in range(0, len(pw_items), group_size)
+        ]
+        # Each group has the background network of all pathways
+        group_args = list(mdf_args)
+        group_args[4] = net_rxns or pathway_background(S, pathways)
+        # The output is sorted by pathway name first, so the group tables
+        # are written in order as they are returned
+        header = True
+        with mp.Pool(min(n_procs, len(pw_groups))) as pool:
+            for group_table in pool.imap(multi_mdf_group, [
+                tuple(group_args) + (None, 10000, pw_group, solver)
+                for pw_group in pw_groups
+            ]):
+                if chunk_writer is not None:
+                    # The first chunk writes the labels, also without rows
+                    for start in range(0, max(group_table.shape[0], 1), 10000):
+                        chunk_writer(group_table.iloc[start:start + 10000,:])
+                else:
+                    group_table.to_csv(
+                        outfile_name, mode='w' if header else 'a',
+                        header=header, na_rep='NA', index=False,
+                        float_format='%.10f'
+                    )
+                    header = False
+        sWrite("\n")
+        if chunk_writer is not None:
+            chunk_writer.close()
+        sWrite("MDF results saved to %s.\n" % outfile_name)
+        return
+    else:
+        mdf_table = multi_mdf(
+            *mdf_args, chunk_writer, 10000, pathways, solver
+        )
     sWrite("\n")
 
+    if mdf_table is None:
+        chunk_writer.close()
+        sWrite("MDF results saved to %s.\n" % outfile_name)
+        return
+
     # Write MDF results to outfile
     sWrite("Saving MDF results to csv...")
     mdf_table.to_csv(outfile_name, na_rep='NA', index=False, float_format='%.10f')
@@ -765,6 +2386,59 @@ def main(reaction_file, std_drG_file, outfile_name, cons_file, ratio_cons_file,
 
 
 if __name__ == "__main__":
+    # Merge shard result files into one MDF table
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        parser = argparse.ArgumentParser(prog='mdf.py merge')
+        parser.add_argument(
+            'outfile', type=str,
+            help='Write combined MDF table in csv format.'
+            )
+        parser.add_argument(
+            'shards', type=str, nargs='+',
+            help='Load MDF tables written with --shard.'
+            )
+        args = parser.parse_args(sys.argv[2:])
+        merge_shards(args.shards, args.outfile)
+        sys.exit()
+
+    # Convert a columnar (.npz) MDF table to csv
+    if len(sys.argv) > 1 and sys.argv[1] == 'csv':
+        parser = argparse.ArgumentParser(prog='mdf.py csv')
+        parser.add_argument(
+            'infile', type=str,
+            help='Load MDF table in columnar (.npz) format.'
+            )
+        parser.add_argument(
+            'outfile', type=str,
+            help='Write MDF table in csv format.'
+            )
+        args = parser.parse_args(sys.argv[2:])
+        columnar_to_csv(args.infile, args.outfile)
+        sys.exit()
+
+    # Time the LP solver backends on the example models
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        parser = argparse.ArgumentParser(prog='mdf.py benchmark')
+        parser.add_argument(
+            '--examples', type=str, default=os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'examples'
+            ),
+            help='Directory with the example models.'
+            )
+        parser.add_argument(
+            '--solvers', type=str, nargs='+', default=LP_SOLVERS,
+            choices=LP_SOLVERS, help='LP solver backends to time.'
+            )
+        parser.add_argument(
+            '--repeats', type=int, default=3,
+            help='Number of timed optimizations per problem and solver.'
+            )
+        args = parser.parse_args(sys.argv[2:])
+        benchmark_solvers(
+            args.examples, solvers=args.solvers, repeats=args.repeats
+        ).to_csv(sys.stdout, sep='\t', index=False, float_format='%.4f')
+        sys.exit()
+
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'reactions', type=str,
@@ -776,7 +2450,8 @@ if __name__ == "__main__":
         )
     parser.add_argument(
         'outfile', type=str,
-        help='Write MDF table in csv format.'
+        help='Write MDF table in csv format, or stream it to a ' + \
+             'columnar file if the name ends with .npz ("mdf.py csv").'
         )
     parser.add_argument(
         '--constraints', type=str,
@@ -790,6 +2465,15 @@ if __name__ == "__main__":
         '--pathway', type=str,
         help='Specify pathway reactions for NEM.'
         )
+    parser.add_argument(
+        '--pathways', type=str,
+        help='Specify a directory or file of pathway reaction lists for ' + \
+             'batch NEM.'
+        )
+    parser.add_argument(
+        '-p', '--processes', type=int, default=1,
+        help='Number of parallel processes to run for batch NEM.'
+        )
     parser.add_argument(
         '--all_directions', action='store_true',
         help='Analyze MDF for all reaction directions.'
@@ -814,9 +2498,36 @@ if __name__ == "__main__":
         '--max_conc', type=float, default=0.01,
         help='Default maximum concentration (M).'
         )
+    parser.add_argument(
+        '--presolve', action='store_true',
+        help='Eliminate fixed and ratio-coupled concentrations before solving.'
+        )
+    parser.add_argument(
+        '--direction_search', choices=['best', 'feasible'],
+        help='Search for the best or all feasible reaction directions.'
+        )
+    parser.add_argument(
+        '--sensitivity', action='store_true',
+        help='Report shadow prices and allowable ranges for all constraints.'
+        )
+    parser.add_argument(
+        '--adaptive', type=float, default=None, metavar='TOL',
+        help='Refine ratio and concentration ranges only where the MDF ' + \
+             'changes by more than TOL (kJ/mol).'
+        )
+    parser.add_argument(
+        '--shard', type=parse_shard, default=None, metavar='i/N',
+        help='Only run shard i of N (0 <= i < N); combine with "mdf.py merge".'
+        )
+    parser.add_argument(
+        '--solver', choices=LP_SOLVERS, default='scipy',
+        help='LP solver backend; time them with "mdf.py benchmark".'
+        )
     args = parser.parse_args()
     main(
         args.reactions, args.std_drG, args.outfile, args.constraints,
         args.ratios, args.pathway, args.all_directions, args.T, args.R,
-        args.proton_name, args.max_conc, args.min_conc
+        args.proton_name, args.max_conc, args.min_conc, args.presolve,
+        args.direction_search, args.sensitivity, args.adaptive, args.shard,
+        args.pathways, args.processes, args.solver
     )
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# Minet local MINE database dump
+
+# Import modules
+import os
+import re
+import json
+import gzip
+import zlib
+import pickle
+import struct
+import sqlite3
+import argparse
+import threading
+
+# Import scripts
+from poppy_helpers import *
+
+# Compound fields returned by quick_search, as by the MINE server
+QUICK_SEARCH_FIELDS = [
+    '_id', 'MINE_id', 'Names', 'Formula', 'Inchikey', 'SMILES', 'Generation'
+]
+
+# Define classes
+class MineDump(object):
+    """Local MINE database, answering from an index of a database dump
+
+    Stands in for mineclient3.mineDatabaseServices, with the same results
+    for get_comps, get_rxns and quick_search. The index (see build) is an
+    SQLite database of the compound and reaction records, keyed by '_id',
+    and of the compound KEGG IDs, MINE IDs, InChIKeys and names that quick
+    searches look up. A dump holds a single database, so the db argument of
+    the calls is ignored. Each thread opens its own connection.
+    """
+
+    tables = [
+        "compounds (id TEXT PRIMARY KEY, record BLOB)",
+        "reactions (id TEXT PRIMARY KEY, record BLOB)",
+        "search (field TEXT, key TEXT, id TEXT)"
+    ]
+
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.timeout = timeout
+        self.url = "file://" + os.path.abspath(path)
+        self._local = threading.local()
+        self.connection()
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        with con:
+            for table in self.tables:
+                con.execute("CREATE TABLE IF NOT EXISTS " + table)
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS search_key ON search (field, key)"
+            )
+        return con
+
+    def connection(self):
+        # Connections can not be shared with other threads or processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self._local.con = self._connect()
+            self._local.pid = os.getpid()
+        return self._local.con
+
+    def build(self, compound_files, reaction_files, batch_size=10000):
+        """
+        Indexes dumps (see read_dump) of the compound and reaction
+        collections of a MINE database, replacing the current index.
+        """
+        con = self.connection()
+        with con:
+            con.execute("DELETE FROM compounds")
+            con.execute("DELETE FROM reactions")
+            con.execute("DELETE FROM search")
+            # Rebuilding the search index once is faster than updating it
+            con.execute("DROP INDEX IF EXISTS search_key")
+
+        def store(table, records, keys):
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO %s VALUES (?,?)" % table, records
+                )
+                con.executemany("INSERT INTO search VALUES (?,?,?)", keys)
+
+        for table, filenames in [('compounds', compound_files), \
+        ('reactions', reaction_files)]:
+            records = []
+            keys = []
+            n = 0
+            for filename in filenames:
+                for record in read_dump(filename):
+                    if '_id' not in record:
+                        s_err("Warning: MINE record lacks an ID.\n")
+                        continue
+                    _id = str(record['_id'])
+                    records.append((_id, pack_record(record)))
+                    if table == 'compounds':
+                        keys.extend(
+                            (field, key, _id) for field, key in \
+                            search_keys(record)
+                        )
+                    n += 1
+                    if len(records) == batch_size:
+                        store(table, records, keys)
+                        records = []
+                        keys = []
+                        s_out("\rIndexing MINE %s... %d" % (table, n))
+            store(table, records, keys)
+            s_out("\rIndexing MINE %s... %d Done.\n" % (table, n))
+
+        with con:
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS search_key ON search (field, key)"
+            )
+
+    def get_records(self, table, ids):
+        """The records of a table with the IDs that are present, in order."""
+        ids = list(ids)
+        records = {}
+        con = self.connection()
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            records.update(con.execute(
+                "SELECT id, record FROM %s WHERE id IN (%s)"
+                % (table, ",".join("?"*len(batch))), batch
+            ).fetchall())
+        return [unpack_record(records[_id]) for _id in ids if _id in records]
+
+    def get_comps(self, db, ids):
+        """Compound records of the IDs; IDs that are not found are left out."""
+        return self.get_records('compounds', ids)
+
+    def get_rxns(self, db, ids):
+        """Reaction records of the IDs; IDs that are not found are left out."""
+        return self.get_records('reactions', ids)
+
+    def quick_search(self, db, query):
+        """
+        Compounds with a KEGG ID (e.g. 'C00001'), MINE ID (digits), InChIKey
+        or name (ignoring case) equal to the query, with the fields of
+        QUICK_SEARCH_FIELDS.
+        """
+        field, key = search_key(query)
+        ids = [row[0] for row in self.connection().execute(
+            "SELECT DISTINCT id FROM search WHERE field=? AND key=? "
+            "ORDER BY id", [field, key]
+        ).fetchall()]
+        return [
+            {k:comp[k] for k in QUICK_SEARCH_FIELDS if k in comp} \
+            for comp in self.get_comps(db, ids)
+        ]
+
+    def __getstate__(self):
+        return {'path':self.path, 'timeout':self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['timeout'])
+
+
+# Define functions
+def pack_record(record):
+    """Compressed pickle of a record."""
+    return zlib.compress(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_record(data):
+    """Record from a compressed pickle (see pack_record)."""
+    return pickle.loads(zlib.decompress(data))
+
+
+def search_key(query):
+    """The field and key that a quick search query looks up."""
+    if re.fullmatch("^C[0-9]{5}$", query):
+        return ('KEGG', query)
+    if re.fullmatch("^[0-9]+$", query):
+        return ('MINE_id', query)
+    if re.fullmatch("^[A-Z]{14}-[A-Z]{10}-[A-Z]$", query):
+        return ('Inchikey', query)
+    return ('Name', query.lower())
+
+
+def search_keys(comp):
+    """The quick search fields and keys of a compound record."""
+    keys = []
+    try:
+        keys.extend(('KEGG', kegg_id) for kegg_id in comp['DB_links']['KEGG'])
+    except (KeyError, TypeError):
+        pass
+    if comp.get('MINE_id') is not None:
+        keys.append(('MINE_id', str(comp['MINE_id'])))
+    if comp.get('Inchikey'):
+        keys.append(('Inchikey', comp['Inchikey']))
+    for name in comp.get('Names') or []:
+        keys.append(('Name', str(name).lower()))
+    return keys
+
+
+def extended_json(obj):
+    """JSON object hook converting MongoDB extended JSON values."""
+    if len(obj) == 1:
+        key, value = next(iter(obj.items()))
+        if key == "$oid":
+            return value
+        if key in ("$numberInt", "$numberLong"):
+            return int(value)
+        if key == "$numberDouble":
+            return float(value)
+    return obj
+
+
+def read_json_lines(f):
+    """Reads documents from a JSON-lines file (e.g. from mongoexport)."""
+    for line in f:
+        if line.strip():
+            yield json.loads(line, object_hook=extended_json)
+
+
+def bson_document(data, i=0):
+    """
+    Decodes the BSON document at offset i of data. Returns the document and
+    the offset following it. ObjectIds are decoded as hexadecimal strings,
+    and dates as milliseconds since the epoch.
+    """
+    end = i + struct.unpack_from("<i", data, i)[0]
+    i += 4
+    doc = {}
+    while data[i] != 0:
+        kind = data[i]
+        j = data.index(b"\x00", i + 1)
+        key = data[i + 1:j].decode()
+        i = j + 1
+        if kind == 0x01:
+            value = struct.unpack_from("<d", data, i)[0]
+            i += 8
+        elif kind == 0x02:
+            n = struct.unpack_from("<i", data, i)[0]
+            value = data[i + 4:i + 3 + n].decode()
+            i += 4 + n
+        elif kind in (0x03, 0x04):
+            value, i = bson_document(data, i)
+            if kind == 0x04:
+                value = list(value.values())
+        elif kind == 0x05:
+            n = struct.unpack_from("<i", data, i)[0]
+            value = data[i + 5:i + 5 + n]
+            i += 5 + n
+        elif kind == 0x07:
+            value = data[i:i + 12].hex()
+            i += 12
+        elif kind == 0x08:
+            value = data[i] == 1
+            i += 1
+        elif kind in (0x09, 0x12):
+            value = struct.unpack_from("<q", data, i)[0]
+            i += 8
+        elif kind == 0x0A:
+            value = None
+        elif kind == 0x10:
+            value = struct.unpack_from("<i", data, i)[0]
+            i += 4
+        elif kind == 0x11:
+            value = struct.unpack_from("<Q", data, i)[0]
+            i += 8
+        else:
+            raise ValueError("Unsupported BSON type 0x%02x." % kind)
+        doc[key] = value
+    return (doc, end)
+
+
+def read_bson(f):
+    """Reads documents from a BSON file (e.g. from mongodump)."""
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            break
+        data = head + f.read(struct.unpack("<i", head)[0] - 4)
+        yield bson_document(data)[0]
+
+
+def read_dump(filename):
+    """
+    Reads the documents of a MongoDB collection dump, either BSON ('.bson')
+    or JSON lines (any other extension). Gzipped files are recognized by
+    their '.gz' extension.
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    if re.search("\\.bson(\\.gz)?$", filename):
+        with opener(filename, 'rb') as f:
+            yield from read_bson(f)
+    else:
+        with opener(filename, 'rt') as f:
+            yield from read_json_lines(f)
+
+
+# Main code block
+def main(index_file, compound_files, reaction_files):
+    MineDump(index_file).build(compound_files, reaction_files)
+
+
+if __name__ == "__main__":
+    # Read arguments from the commandline
+    parser = argparse.ArgumentParser(
+        description='Index a MINE database dump for offline network creation.'
+    )
+    parser.add_argument(
+        'index',
+        help='Write the index to this SQLite file.'
+    )
+    parser.add_argument(
+        '-c', '--compounds', nargs='+', required=True,
+        help='Compound collection dump files (JSON lines or BSON).'
+    )
+    parser.add_argument(
+        '-r', '--reactions', nargs='+', required=True,
+        help='Reaction collection dump files (JSON lines or BSON).'
+    )
+
+    args = parser.parse_args()
+
+    main(args.index, args.compounds, args.reactions)
@@ -20,6 +20,9 @@ import random as _random
 import base64 as _base64
 from configparser import ConfigParser as _ConfigParser # Edited /JAS
 import os as _os
+from http_cache import cached_post as _cached_post # Edited /JAS
+from fetch_engine import host_controller as _host_controller # Edited /JAS
+import time as _time # Edited /JAS
 
 _CT = 'content-type'
 _AJ = 'application/json'
@@ -139,6 +142,11 @@ class mineDatabaseServices(object):
                         authdata['user_id'], authdata['password'])
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
+        # Reuse connections across calls and threads # Edited /JAS
+        self._session = _requests.Session()
+        adapter = _requests.adapters.HTTPAdapter(pool_maxsize=32)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
     def _call(self, method, params):
         arg_hash = {'method': method,
@@ -148,9 +156,31 @@ class mineDatabaseServices(object):
                     }
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(self.url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        # Identify cached responses by method and parameters only # Edited /JAS
+        key_data = _json.dumps([method, params], cls=_JSONObjectEncoder,
+                               sort_keys=True)
+        # Adapt the number of concurrent calls to the server # Edited /JAS
+        controller = _host_controller(self.url)
+        controller.acquire()
+        start = _time.time()
+        ret = None
+        try:
+            ret = _cached_post(self.url, key_data, session=self._session,
+                               data=body, headers=self._headers,
+                               timeout=self.timeout,
+                               verify=not self.trust_all_ssl_certificates)
+        finally:
+            if getattr(ret, 'from_cache', False) or \
+               getattr(ret, 'offline_miss', False):
+                controller.release()
+            else:
+                # JSON-RPC errors are answers, not signs of overload
+                controller.release(_time.time() - start, ret is not None and
+                                   (ret.status_code < 500 or
+                                    ret.headers.get(_CT) == _AJ))
+        if getattr(ret, 'offline_miss', False): # Edited /JAS
+            raise ServerError('OfflineCacheMiss', ret.status_code,
+                              method + ' is not in the response cache')
         if ret.status_code == _requests.codes.server_error:
             if _CT in ret.headers and ret.headers[_CT] == _AJ:
                 err = _json.loads(ret.text)
@@ -1,16 +1,19 @@
 # Minet KEGG access functions
 
 # Import modules
+import os
 import re
 import sys
-import time
-import queue
-import threading
+import gzip
+import asyncio
+import multiprocessing as mp
+from functools import partial
 from requests import get as rget
 from rdkit import Chem
 
 # Import scripts
 from poppy_helpers import *
+from fetch_engine import run_fetch, run_shared_fetch, host_controller
 from progress import Progress
 
 # Define functions
@@ -19,34 +22,113 @@ def get_KEGG_text(kegg_id, krest="http://rest.kegg.jp"):
     Downloads the raw text entry for the provided KEGG compound or reaction ID,
     via the KEGG rest API @ http://rest.kegg.jp/
     """
+    return run_shared_fetch(fetch_KEGG_text, kegg_id, krest)
 
-    # Check ID and construct query
-    if re.fullmatch("^R[0-9]{5}$", kegg_id):
-        # KEGG reactions
-        krest = "/".join([krest,"get","rn:"+kegg_id])
-    elif re.fullmatch("^C[0-9]{5}$", kegg_id):
-        # KEGG compounds
-        krest = "/".join([krest,"get","cpd:"+kegg_id])
-    else:
-        # Invalid ID
-        s_err("Warning: '" + str(kegg_id) + \
-        "' is not a valid KEGG reaction or compound ID.\n")
+
+async def fetch_KEGG_text(fetcher, kegg_id, krest="http://rest.kegg.jp"):
+    """Asynchronous get_KEGG_text using an AsyncFetcher."""
+    query_id = KEGG_query_ids([kegg_id])[0]
+    if query_id is None:
         return None
+    r = await fetcher.get("/".join([krest, "get", query_id]))
+    if r is not None and r.status_code == 200:
+        return r.text
+    s_err("Warning: Unable to download KEGG data for '" + \
+    str(kegg_id) + "'.\n")
+    return None
+
+
+def KEGG_query_ids(kegg_ids):
+    """Prefixed query IDs for KEGG compound and reaction IDs (None if invalid)"""
+    query_ids = []
+    for kegg_id in kegg_ids:
+        if re.fullmatch("^R[0-9]{5}$", kegg_id):
+            query_ids.append("rn:" + kegg_id)
+        elif re.fullmatch("^C[0-9]{5}$", kegg_id):
+            query_ids.append("cpd:" + kegg_id)
+        else:
+            s_err("Warning: '" + str(kegg_id) + \
+            "' is not a valid KEGG reaction or compound ID.\n")
+            query_ids.append(None)
+    return query_ids
 
-    n = 0
 
-    while True:
-        r = rget(krest)
-        if r.status_code == 200:
-            return r.text
-        else:
-            # Server not returning a result, try again
-            n += 1
-            if n >= 5:
+def get_KEGG_bulk(query_ids, option=None, krest="http://rest.kegg.jp"):
+    """
+    Downloads several KEGG entries with one request to the KEGG rest API.
+    Returns the response text, or None if no entry was found or the server
+    failed to respond.
+    """
+    return run_fetch(fetch_KEGG_bulk, query_ids, option, krest)
+
+
+async def fetch_KEGG_bulk(fetcher, query_ids, option=None,
+    krest="http://rest.kegg.jp"):
+    """Asynchronous get_KEGG_bulk using an AsyncFetcher."""
+    krest = "/".join([krest, "get", "+".join(query_ids)])
+    if option:
+        krest = "/".join([krest, option])
+    r = await fetcher.get(krest)
+    if r is not None and r.status_code == 200:
+        return r.text
+    # None of the entries exist, or the server failed to respond
+    return None
+
+
+def KEGG_records(bulk_text):
+    """
+    Splits concatenated KEGG text records, identifying them by their ENTRY.
+    Returns a dictionary of IDs and text records.
+    """
+    records = {}
+    for record in re.split("^///$\n?", bulk_text, flags=re.M):
+        if not record.strip():
+            continue
+        entry = re.search("^ENTRY +(\\S+)", record, flags=re.M)
+        if entry is None:
+            s_err("Warning: KEGG text record lacks an ENTRY line.\n")
+            continue
+        records[entry.group(1)] = record + "///\n"
+    return records
+
+
+def get_KEGG_texts(kegg_ids, krest="http://rest.kegg.jp", batch_size=10):
+    """
+    Downloads the raw text entries for several KEGG compound or reaction IDs,
+    requesting up to batch_size entries at a time (the KEGG maximum is 10).
+    Returns a dictionary of IDs and text records; IDs that could not be
+    downloaded are left out.
+    """
+    return run_fetch(fetch_KEGG_texts, kegg_ids, krest, batch_size)
+
+
+async def fetch_KEGG_texts(fetcher, kegg_ids, krest="http://rest.kegg.jp",
+    batch_size=10):
+    """Asynchronous get_KEGG_texts using an AsyncFetcher."""
+    query_ids = [q for q in KEGG_query_ids(kegg_ids) if q]
+    texts = {}
+
+    async def fetch(batch):
+        bulk_text = await fetch_KEGG_bulk(fetcher, batch, krest=krest)
+        if bulk_text is None and len(batch) > 1:
+            # Fall back to single entries for a failed batch
+            for query_id, kegg_text in zip(batch, await asyncio.gather(*[
+                fetch_KEGG_text(fetcher, q.split(":")[1], krest) for q in batch
+            ])):
+                if kegg_text is not None:
+                    texts[query_id.split(":")[1]] = kegg_text
+            return
+        texts.update(KEGG_records(bulk_text or ""))
+        for query_id in batch:
+            if query_id.split(":")[1] not in texts:
                 s_err("Warning: Unable to download KEGG data for '" + \
-                str(kegg_id) + "'.\n")
-                return None
-            time.sleep(2)
+                query_id.split(":")[1] + "'.\n")
+
+    await asyncio.gather(*[
+        fetch(query_ids[i:i + batch_size])
+        for i in range(0, len(query_ids), batch_size)
+    ])
+    return texts
 
 
 def KEGG_rest_dict(kegg_text):
@@ -160,41 +242,104 @@ def format_KEGG_reaction(kegg_text):
     }
 
 
+def mol_to_smiles(kegg_id, mol_text):
+    """Converts a KEGG molecule text to SMILES."""
+    try:
+        mol = Chem.MolFromMolBlock(mol_text)
+        smiles = Chem.MolToSmiles(mol)
+        return smiles
+    except:
+        s_err("\nWarning: SMILES could not be produced for" + \
+        " KEGG ID '%s'.\n" % str(kegg_id))
+        return None
+
+
+def KEGG_mol_blocks(bulk_text):
+    """Splits concatenated KEGG molecule files into a list of mol blocks."""
+    mols = []
+    # Each molecule ends with 'M  END', possibly followed by '$$$$'
+    for k, m in enumerate(re.split("^M  END$", bulk_text, flags=re.M)[:-1]):
+        if k:
+            m = re.sub("\\A\n(\\$\\$\\$\\$\n)?", "", m)
+        mols.append(m + "M  END\n")
+    return mols
+
+
+def get_KEGG_mol_smiles_bulk(kegg_ids, krest="http://rest.kegg.jp",
+    batch_size=10):
+    """
+    Downloads KEGG compound molecule objects up to batch_size at a time and
+    converts them to SMILES. Returns a dictionary of IDs and SMILES; IDs
+    without a molecule are left out.
+
+    The molecule files do not contain the compound ID, so they are assigned
+    by their order. If the number of files does not match the number of
+    requested compounds, the batch is split in halves until it does.
+    """
+    return run_fetch(fetch_KEGG_mol_smiles_bulk, kegg_ids, krest, batch_size)
+
+
+async def fetch_KEGG_mol_smiles_bulk(fetcher, kegg_ids,
+    krest="http://rest.kegg.jp", batch_size=10):
+    """Asynchronous get_KEGG_mol_smiles_bulk using an AsyncFetcher."""
+    query_ids = []
+    for kegg_id in kegg_ids:
+        if not re.fullmatch("^C[0-9]{5}$", kegg_id):
+            s_err("\nWarning: '" + str(kegg_id) + \
+            "' is not a valid KEGG compound ID.\n")
+            continue
+        query_ids.append("cpd:" + kegg_id)
+
+    smiles = {}
+    async def fetch(batch):
+        bulk_text = await fetch_KEGG_bulk(fetcher, batch, "mol", krest)
+        mols = KEGG_mol_blocks(bulk_text or "")
+        if len(mols) == len(batch):
+            kegg_ids = [query_id.split(":")[1] for query_id in batch]
+            smiles.update(zip(kegg_ids, await fetcher.parse(
+                lambda: list(map(mol_to_smiles, kegg_ids, mols))
+            )))
+        elif len(batch) == 1:
+            s_err("\nWarning: Unable to download molecule data for" + \
+            " '%s'.\n" % batch[0].split(":")[1])
+        else:
+            await asyncio.gather(
+                fetch(batch[:len(batch)//2]), fetch(batch[len(batch)//2:])
+            )
+
+    await asyncio.gather(*[
+        fetch(query_ids[i:i + batch_size])
+        for i in range(0, len(query_ids), batch_size)
+    ])
+    return {k:v for k, v in smiles.items() if v is not None}
+
+
 def get_KEGG_mol_smiles(kegg_id, krest="http://rest.kegg.jp"):
     """Downloads a KEGG compound molecule object and converts it to SMILES."""
+    return run_shared_fetch(fetch_KEGG_mol_smiles, kegg_id, krest)
+
+
+async def fetch_KEGG_mol_smiles(fetcher, kegg_id, krest="http://rest.kegg.jp"):
+    """Asynchronous get_KEGG_mol_smiles using an AsyncFetcher."""
 
     if not re.fullmatch("^C[0-9]{5}$", kegg_id):
         s_err("\nWarning: '" + str(kegg_id) + "' is not a valid KEGG compound ID.\n")
         return None
 
-    # Set up the query
-    krest = "/".join([krest,"get","cpd:"+kegg_id,"mol"])
-
-    # Contact server (several times if necessary)
-    n = 0
-    while True:
-        r = rget(krest)
-        if r.status_code == 200:
-            try:
-                mol = Chem.MolFromMolBlock(r.text)
-                smiles = Chem.MolToSmiles(mol)
-                return smiles
-            except:
-                s_err("\nWarning: SMILES could not be produced for" + \
-                " KEGG ID '%s'.\n" % str(kegg_id))
-                return None
-        else:
-            # Server not returning a result, try again
-            n += 1
-            if n >= 5:
-                s_err("\nWarning: Unable to download molecule data for" + \
-                " '%s'.\n" % str(kegg_id))
-                return None
-            time.sleep(2)
+    r = await fetcher.get("/".join([krest,"get","cpd:"+kegg_id,"mol"]))
+    if r is not None and r.status_code == 200:
+        return await fetcher.parse(mol_to_smiles, kegg_id, r.text)
+    s_err("\nWarning: Unable to download molecule data for" + \
+    " '%s'.\n" % str(kegg_id))
+    return None
 
 
-def format_KEGG_compound(kegg_text):
-    """Formats a compound KEGG rest text record in the MINE database format."""
+def format_KEGG_compound(kegg_text, smiles_dict=None):
+    """
+    Formats a compound KEGG rest text record in the MINE database format. The
+    SMILES is downloaded unless a dictionary of IDs and SMILES is supplied
+    (see get_KEGG_mol_smiles_bulk).
+    """
     kegg_dict = KEGG_rest_dict(kegg_text)
 
     # Ensure that the kegg_dict is a dictionary
@@ -224,7 +369,10 @@ def format_KEGG_compound(kegg_text):
     compound['DB_links'] = {'KEGG':[compound['_id']]}
 
     # Add SMILES if possible
-    smiles = get_KEGG_mol_smiles(compound['_id'])
+    if smiles_dict is None:
+        smiles = get_KEGG_mol_smiles(compound['_id'])
+    else:
+        smiles = smiles_dict.get(compound['_id'])
     if smiles:
         compound['SMILES'] = smiles
 
@@ -255,132 +403,188 @@ def format_KEGG_compound(kegg_text):
     return compound
 
 
-def get_KEGG_comps(comp_id_list, num_workers=128):
+async def fetch_KEGG_entries(fetcher, id_list, fetch_batch, batch_size=10,
+    krest="http://rest.kegg.jp"):
     """
-    Threaded implementation of get_KEGG_text and format_KEGG_compound,
-    taking a list of KEGG compound ids as input.
+    Awaits the coroutine function fetch_batch on all batches of up to
+    batch_size IDs concurrently, reporting progress and the metrics of the
+    krest server. fetch_batch returns a list with one result (or None) per
+    ID; the results that are not None are returned.
     """
-    def worker():
-        while True:
-            comp_id = work.get()
-            try:
-                if comp_id is None:
-                    work.task_done()
-                    break
-                kegg_text = get_KEGG_text(comp_id)
-                if not kegg_text is None:
-                    kegg_comp = format_KEGG_compound(kegg_text)
-                    output.put(kegg_comp)
-                else:
-                    output.put(None)
-                work.task_done()
-            except:
-                work.put(comp_id)
-                work.task_done()
-
-    work = queue.Queue()
-    output = queue.Queue()
-
-    threads = []
-
-    for i in range(num_workers):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-
-    for comp_id in comp_id_list:
-        work.put(comp_id)
-
-    # Report progress
-    M = len(comp_id_list)
-    p = Progress(design='pbct', max_val=M)
-    while M - output.qsize():
-        n = output.qsize()
-        p.write(n)
-        time.sleep(1)
-    n = output.qsize()
-    p.write(n)
+    done = [0]
+    async def fetch(batch):
+        results = await fetch_batch(batch)
+        done[0] += len(batch)
+        return results
+
+    task = asyncio.ensure_future(asyncio.gather(*[
+        fetch(id_list[i:i + batch_size])
+        for i in range(0, len(id_list), batch_size)
+    ]))
+
+    # Report progress and server metrics
+    controller = host_controller(krest)
+    p = Progress(design='pct', max_val=len(id_list))
+    while True:
+        s_out("\r%s %s" % (p.to_string(done[0]), controller.status()))
+        if task.done():
+            break
+        await asyncio.wait([task], timeout=1)
     print("")
 
-    # Block until all work is done
-    work.join()
-
-    # Stop workers
-    for i in range(num_workers):
-        work.put(None)
-    for t in threads:
-        t.join()
+    return [r for results in task.result() for r in results if r]
 
-    # Get the results
-    comps = []
 
+async def fetch_KEGG_comps(fetcher, comp_id_list, batch_size=10,
+    krest="http://rest.kegg.jp"):
+    """Asynchronous get_KEGG_comps using an AsyncFetcher."""
+    async def fetch_batch(batch):
+        texts = await fetch_KEGG_texts(fetcher, batch, krest, batch_size)
+        smiles = await fetch_KEGG_mol_smiles_bulk(
+            fetcher, list(texts), krest, batch_size
+        )
+        return await fetcher.parse(lambda: [
+            format_KEGG_compound(texts[comp_id], smiles) \
+            if comp_id in texts else None for comp_id in batch
+        ])
+    return await fetch_KEGG_entries(
+        fetcher, comp_id_list, fetch_batch, batch_size, krest
+    )
 
-    while not output.empty():
-        comps.append(output.get())
 
-    return list(filter(None, comps))
+def get_KEGG_comps(comp_id_list, max_connections=16, batch_size=10,
+    krest="http://rest.kegg.jp"):
+    """
+    Concurrent implementation of get_KEGG_texts, get_KEGG_mol_smiles_bulk and
+    format_KEGG_compound, taking a list of KEGG compound ids as input.
+    Downloads over at most max_connections pooled connections.
+    """
+    return run_fetch(
+        fetch_KEGG_comps, comp_id_list, batch_size, krest,
+        max_connections=max_connections
+    )
+
+
+async def fetch_KEGG_rxns(fetcher, rxn_id_list, batch_size=10,
+    krest="http://rest.kegg.jp"):
+    """Asynchronous get_KEGG_rxns using an AsyncFetcher."""
+    async def fetch_batch(batch):
+        texts = await fetch_KEGG_texts(fetcher, batch, krest, batch_size)
+        return await fetcher.parse(lambda: [
+            format_KEGG_reaction(texts[rxn_id]) \
+            if rxn_id in texts else None for rxn_id in batch
+        ])
+    return await fetch_KEGG_entries(
+        fetcher, rxn_id_list, fetch_batch, batch_size, krest
+    )
+
+
+def get_KEGG_rxns(rxn_id_list, max_connections=16, batch_size=10,
+    krest="http://rest.kegg.jp"):
+    """
+    Concurrent implementation of get_KEGG_texts and format_KEGG_reaction,
+    taking a list of KEGG reaction ids as input. Downloads over at most
+    max_connections pooled connections.
+    """
+    return run_fetch(
+        fetch_KEGG_rxns, rxn_id_list, batch_size, krest,
+        max_connections=max_connections
+    )
 
 
-def get_KEGG_rxns(rxn_id_list, num_workers=128):
+def KEGG_flat_records(filename):
     """
-    Threaded implementation of get_KEGG_text and format_KEGG_reaction,
-    taking a list of KEGG reaction ids as input.
+    Reads the text records of a KEGG flat file (e.g. ligand/compound/compound
+    or ligand/reaction/reaction) one at a time. Gzipped files are recognized
+    by their '.gz' extension.
     """
-    def worker():
-        while True:
-            rxn_id = work.get()
-            try:
-                if rxn_id is None:
-                    work.task_done()
-                    break
-                kegg_text = get_KEGG_text(rxn_id)
-                if not kegg_text is None:
-                    kegg_rxn = format_KEGG_reaction(kegg_text)
-                    output.put(kegg_rxn)
-                else:
-                    output.put(None)
-                work.task_done()
-            except:
-                work.put(rxn_id)
-                work.task_done()
-
-    work = queue.Queue()
-    output = queue.Queue()
-
-    threads = []
-
-    for i in range(num_workers):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-
-    for rxn_id in rxn_id_list:
-        work.put(rxn_id)
-
-    # Report progress
-    M = len(rxn_id_list)
-    p = Progress(design='pbct', max_val=M)
-    while M - output.qsize():
-        n = output.qsize()
-        p.write(n)
-        time.sleep(1)
-    n = output.qsize()
-    p.write(n)
-    print("")
+    opener = gzip.open if filename.endswith(".gz") else open
+    record = []
+    with opener(filename, 'rt') as f:
+        for line in f:
+            record.append(line)
+            if line.rstrip("\n") == "///":
+                yield "".join(record)
+                record = []
+    if "".join(record).strip():
+        # Catch a trailing record without a terminator
+        yield "".join(record)
+
+
+def KEGG_mol_file_smiles(kegg_id, mol_dir):
+    """
+    Converts the molecule file of a KEGG compound (e.g. ligand/compound/mol/
+    C00001.mol) to SMILES. Returns None if the compound has no molecule file.
+    """
+    try:
+        with open(os.path.join(mol_dir, kegg_id + ".mol")) as f:
+            mol_text = f.read()
+    except OSError:
+        return None
+    return mol_to_smiles(kegg_id, mol_text)
 
-    # Block until all work is done
-    work.join()
 
-    # Stop workers
-    for i in range(num_workers):
-        work.put(None)
-    for t in threads:
-        t.join()
+def format_KEGG_compound_file(kegg_text, mol_dir=None):
+    """
+    Formats a compound KEGG flat file record in the MINE database format,
+    taking the SMILES from the molecule file in mol_dir, if given.
+    """
+    smiles_dict = {}
+    entry = re.search("^ENTRY +(\\S+)", kegg_text, flags=re.M)
+    if entry is not None and mol_dir is not None:
+        smiles = KEGG_mol_file_smiles(entry.group(1), mol_dir)
+        if smiles:
+            smiles_dict[entry.group(1)] = smiles
+    return format_KEGG_compound(kegg_text, smiles_dict)
 
-    # Get the results
-    rxns = []
 
-    while not output.empty():
-        rxns.append(output.get())
+def parse_KEGG_flat_file(filename, format_record, n_procs=1, chunk_size=100,
+    label="records"):
+    """
+    Applies format_record (e.g. format_KEGG_reaction) to the records of a
+    KEGG flat file in n_procs processes, reading the file as a stream.
+    Returns the formatted records that are not None, in file order.
+    """
+    records = KEGG_flat_records(filename)
+    if n_procs > 1:
+        pool = mp.Pool(n_procs)
+        results = pool.imap(format_record, records, chunk_size)
+    else:
+        pool = None
+        results = map(format_record, records)
+    try:
+        output = []
+        for n, record in enumerate(results, 1):
+            if record is not None:
+                output.append(record)
+            if n % 1000 == 0:
+                s_out("\rParsing KEGG %s... %d" % (label, n))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    s_out("\rParsing KEGG %s... Done. \n" % label)
+    return output
+
+
+def read_KEGG_comps(compound_file, mol_dir=None, n_procs=1, chunk_size=100):
+    """
+    Offline alternative to get_KEGG_comps, reading all compounds from the
+    KEGG compound flat file and their SMILES from the molecule files in
+    mol_dir. Records are parsed, and molecules converted with RDKit, in
+    n_procs processes.
+    """
+    return parse_KEGG_flat_file(
+        compound_file, partial(format_KEGG_compound_file, mol_dir=mol_dir),
+        n_procs, chunk_size, "compounds"
+    )
+
 
-    return list(filter(None, rxns))
+def read_KEGG_rxns(reaction_file, n_procs=1, chunk_size=100):
+    """
+    Offline alternative to get_KEGG_rxns, reading all reactions from the
+    KEGG reaction flat file in n_procs processes.
+    """
+    return parse_KEGG_flat_file(
+        reaction_file, format_KEGG_reaction, n_procs, chunk_size, "reactions"
+    )
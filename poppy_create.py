@@ -7,10 +7,14 @@ import sys
 import os
 import argparse
 import pickle
+import sqlite3
 import time
 import queue
 import threading
 import multiprocessing as mp
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from requests import get as rget
 from rdkit import Chem
 from copy import deepcopy
@@ -21,12 +25,21 @@ import mineclient3 as mc
 from poppy_helpers import *
 from poppy_origin_helpers import *
 from poppy_KEGG_helpers import *
+from http_cache import configure_cache, cached_get
+from mine_dump import MineDump
+from fetch_engine import host_controller
 from progress import Progress
 
 # Specify path to repository
 global repo_dir
 repo_dir = os.path.dirname(__file__)
 
+# MINE data source, shared by all MINE access functions
+MINE = {
+    'url':"http://modelseed.org/services/mine-database", 'db':"KEGGexp2",
+    'dump':None
+}
+
 # Define functions
 def allow_reaction_listing(kegg_comp, kegg_rxn):
     """Determine whether to allow the compound to list the reaction"""
@@ -137,22 +150,140 @@ def sort_KEGG_reactions(kegg_comp_dict, kegg_rxn_dict, verbose=False):
                             ['Product_of'] = [rxn["_id"]]
 
 
+class CrawlStore(object):
+    """Durable store of downloaded KEGG and MINE records
+
+    Records are appended to an SQLite database as they are downloaded, keyed
+    by kind (e.g. 'MINE_comp') and ID, so that an interrupted crawl can be
+    resumed without downloading them again. Records that could not be
+    downloaded (None) are not stored, as the download may have failed for a
+    transient reason (e.g. a server error or an offline cache miss), so they
+    are downloaded again on resume. Other crawl state, such as the KEGG ID
+    lists, is stored by key. Unless resume is True, the store starts empty.
+    """
+
+    tables = [
+        "records (kind TEXT, id TEXT, record BLOB, PRIMARY KEY (kind, id))",
+        "state (key TEXT PRIMARY KEY, value BLOB)"
+    ]
+
+    def __init__(self, path, resume=False, timeout=600):
+        self.path = path
+        self.con = sqlite3.connect(path, timeout=timeout)
+        try:
+            self.con.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
+            # Not supported on some network file systems; use the default
+            pass
+        with self.con:
+            for table in self.tables:
+                self.con.execute("CREATE TABLE IF NOT EXISTS " + table)
+            if not resume:
+                self.con.execute("DELETE FROM records")
+                self.con.execute("DELETE FROM state")
+
+    def get(self, kind, ids=None):
+        """
+        Return a dictionary with the stored records of a kind. None records
+        of older stores are left out, so that they are downloaded again.
+        """
+        if ids is None:
+            rows = self.con.execute(
+                "SELECT id, record FROM records WHERE kind=?", [kind]
+            ).fetchall()
+        else:
+            ids = list(ids)
+            rows = []
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                rows.extend(self.con.execute(
+                    "SELECT id, record FROM records WHERE kind=? AND id IN (%s)"
+                    % ",".join("?"*len(batch)), [kind] + batch
+                ).fetchall())
+        records = {_id:pickle.loads(record) for _id, record in rows}
+        return {_id:r for _id, r in records.items() if r is not None}
+
+    def put(self, kind, records):
+        """Store a dictionary of IDs and records of a kind, except None"""
+        with self.con:
+            self.con.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?,?,?)",
+                [(kind, _id, pickle.dumps(record, pickle.HIGHEST_PROTOCOL)) \
+                for _id, record in records.items() if record is not None]
+            )
+
+    def get_state(self, key, default=None):
+        """Return a stored state value"""
+        row = self.con.execute(
+            "SELECT value FROM state WHERE key=?", [key]
+        ).fetchone()
+        return default if row is None else pickle.loads(row[0])
+
+    def put_state(self, key, value):
+        """Store a state value"""
+        with self.con:
+            self.con.execute(
+                "INSERT OR REPLACE INTO state VALUES (?,?)",
+                [key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)]
+            )
+
+
+def stored_records(store, kind, ids, download, chunk_size=2000):
+    """
+    Records for a list of IDs, taken from the crawl store where possible.
+    Missing records are downloaded with download(id_list), which returns one
+    record (or None) per ID, in chunks that are stored as they complete (see
+    CrawlStore; None records are downloaded again by later calls).
+    Without a store, all records are downloaded at once.
+    """
+    if store is None:
+        return download(ids)
+    records = store.get(kind, ids)
+    missing = [_id for _id in dict.fromkeys(ids) if _id not in records]
+    if len(records):
+        s_out("Using %d stored records, downloading %d.\n" % (
+            len(ids) - len(missing), len(missing)
+        ))
+    for i in range(0, len(missing), chunk_size):
+        chunk = dict(zip(
+            missing[i:i + chunk_size], download(missing[i:i + chunk_size])
+        ))
+        store.put(kind, chunk)
+        records.update(chunk)
+    return [records[_id] for _id in ids]
+
+
+def records_by_id(records, ids):
+    """One record (or None) per ID from a list of records with '_id' keys."""
+    records = {r['_id']:r for r in records if r is not None and '_id' in r}
+    return [records.get(_id) for _id in ids]
+
+
 def get_raw_KEGG(kegg_comp_ids=[], kegg_rxn_ids=[], krest="http://rest.kegg.jp",
-    n_threads=128, test_limit=0):
+    n_threads=128, test_limit=0, store=None):
     """
     Downloads all KEGG compound (C) and reaction (R) records and formats them
     as MINE database compound or reaction entries. The final output is a tuple
     containing a compound dictionary and a reaction dictionary.
 
     Alternatively, downloads only a supplied list of compounds and reactions.
+
+    Records are kept in the CrawlStore store, if given, and records that are
+    already there are not downloaded again.
     """
 
     s_out("\nDownloading KEGG data via %s/...\n" % krest)
 
+    # Use the ID lists of a resumed crawl
+    if store is not None:
+        kegg_comp_ids = store.get_state('KEGG_comp_ids', kegg_comp_ids)
+        kegg_rxn_ids = store.get_state('KEGG_rxn_ids', kegg_rxn_ids)
+
     # Acquire list of KEGG compound IDs
     if not len(kegg_comp_ids):
+        kegg_comp_ids = []
         s_out("Downloading KEGG compound list...")
-        r = rget("/".join([krest,"list","compound"]))
+        r = cached_get("/".join([krest,"list","compound"]))
         if r.status_code == 200:
             for line in r.text.split("\n"):
                 if line == "": break # The end
@@ -165,8 +296,9 @@ def get_raw_KEGG(kegg_comp_ids=[], kegg_rxn_ids=[], krest="http://rest.kegg.jp",
 
     # Acquire list of KEGG reaction IDs
     if not len(kegg_rxn_ids):
+        kegg_rxn_ids = []
         s_out("Downloading KEGG reaction list...")
-        r = rget("/".join([krest,"list","reaction"]))
+        r = cached_get("/".join([krest,"list","reaction"]))
         if r.status_code == 200:
             for line in r.text.split("\n"):
                 if line == "": break # The end
@@ -182,10 +314,15 @@ def get_raw_KEGG(kegg_comp_ids=[], kegg_rxn_ids=[], krest="http://rest.kegg.jp",
         kegg_comp_ids = kegg_comp_ids[0:test_limit]
         kegg_rxn_ids = kegg_rxn_ids[0:test_limit]
 
+    if store is not None:
+        store.put_state('KEGG_comp_ids', kegg_comp_ids)
+        store.put_state('KEGG_rxn_ids', kegg_rxn_ids)
+
     # Download compounds (threaded)
     kegg_comp_dict = {}
     print("Downloading KEGG compounds...")
-    for comp in get_KEGG_comps(kegg_comp_ids):
+    for comp in stored_records(store, 'KEGG_comp', kegg_comp_ids, \
+    lambda ids: records_by_id(get_KEGG_comps(ids, krest=krest), ids)):
         if comp == None:
             continue
         try:
@@ -200,7 +337,8 @@ def get_raw_KEGG(kegg_comp_ids=[], kegg_rxn_ids=[], krest="http://rest.kegg.jp",
     # Download reactions (threaded)
     kegg_rxn_dict = {}
     print("Downloading KEGG reactions...")
-    for rxn in get_KEGG_rxns(kegg_rxn_ids):
+    for rxn in stored_records(store, 'KEGG_rxn', kegg_rxn_ids, \
+    lambda ids: records_by_id(get_KEGG_rxns(ids, krest=krest), ids)):
         if rxn == None:
             continue
         try:
@@ -221,6 +359,53 @@ def get_raw_KEGG(kegg_comp_ids=[], kegg_rxn_ids=[], krest="http://rest.kegg.jp",
     return (kegg_comp_dict, kegg_rxn_dict)
 
 
+def get_raw_KEGG_files(compound_file, reaction_file, mol_dir=None,
+    n_procs=mp.cpu_count()):
+    """
+    Offline alternative to get_raw_KEGG, reading all KEGG compounds and
+    reactions from local KEGG flat files (ligand/compound/compound and
+    ligand/reaction/reaction) and the compound SMILES from the molecule files
+    in mol_dir (ligand/compound/mol). The files are parsed in n_procs
+    processes. The output is the same tuple of a compound dictionary and a
+    reaction dictionary.
+    """
+
+    s_out("\nReading KEGG data from flat files...\n")
+
+    kegg_comp_dict = dict((comp['_id'], comp) for comp in \
+    read_KEGG_comps(compound_file, mol_dir, n_procs))
+    kegg_rxn_dict = dict((rxn['_id'], rxn) for rxn in \
+    read_KEGG_rxns(reaction_file, n_procs))
+
+    # Re-organize compound reaction listing, taking cofactor role into account
+    s_out("Organizing reaction lists...")
+    sort_KEGG_reactions(kegg_comp_dict, kegg_rxn_dict)
+    s_out(" Done.\n")
+
+    s_out("Read %d KEGG compounds and %d reactions.\n" % (
+        len(kegg_comp_dict), len(kegg_rxn_dict)
+    ))
+    return (kegg_comp_dict, kegg_rxn_dict)
+
+
+def configure_MINE(dump_index=None):
+    """
+    Sets up the MINE data source. By default, MINE data is downloaded from
+    the MINE server. With dump_index, the index of a local MINE database dump
+    (see mine_dump.py), MINE data is read from disk instead.
+    """
+    if dump_index is not None and not os.path.exists(dump_index):
+        raise ValueError("MINE dump index '%s' does not exist." % dump_index)
+    MINE['dump'] = dump_index
+
+
+def MINE_connection():
+    """A connection to the MINE data source and the database name."""
+    if MINE['dump'] is not None:
+        return (MineDump(MINE['dump']), MINE['db'])
+    return (mc.mineDatabaseServices(MINE['url']), MINE['db'])
+
+
 def quicksearch(con, db, query):
     """Wrapper for MineClient3 quick_search() with reconnect functionality."""
     n = 0
@@ -241,49 +426,51 @@ def quicksearch(con, db, query):
                 s_err("Warning: Connection attempt limit reached for '" + \
                 query + "'.\n")
                 return results
-            if n <= 12:
-                time.sleep(10)
-            if n > 12:
-                time.sleep(30)
+            time.sleep(host_controller(con.url).backoff_delay(n))
 
 
-def threaded_quicksearch(con, db, query_list):
-    """Threaded implementation of quicksearch."""
+def threaded_quicksearch(con, db, query_list, flatten=True):
+    """
+    Threaded implementation of quicksearch. Returns the results of all
+    queries in one list, or one list of results per query if flatten is
+    False.
+    """
     def worker():
         while True:
-            query = work.get()
-            if query is None:
+            item = work.get()
+            if item is None:
                 work.task_done()
                 break
-            output.put(quicksearch(con, db, query))
+            i, query = item
+            output.put((i, quicksearch(con, db, query)))
             work.task_done()
 
     work = queue.Queue()
     output = queue.Queue()
 
+    # The shared controller limits the number of searches in flight
+    controller = host_controller(con.url)
+
     threads = []
-    num_workers = 128
+    num_workers = min(controller.maximum, max(1, len(query_list)))
 
     for i in range(num_workers):
         t = threading.Thread(target=worker)
         t.start()
         threads.append(t)
 
-    for query in query_list:
-        work.put(query)
+    for item in enumerate(query_list):
+        work.put(item)
 
-    # Report progress
+    # Report progress and server metrics
     M = len(query_list)
-    p = Progress(design='pbct', max_val=M)
+    p = Progress(design='pct', max_val=M)
     while True:
+        n = M - work.qsize()
+        s_out("\r%s %s" % (p.to_string(n), controller.status()))
         if not work.qsize():
-            n = M - work.qsize()
-            p.write(n)
             break
-        else:
-            n = M - work.qsize()
-            p.write(n)
-            time.sleep(1)
+        time.sleep(1)
     print("")
 
     # Block until all work is done
@@ -295,12 +482,15 @@ def threaded_quicksearch(con, db, query_list):
     for t in threads:
         t.join()
 
-    # Get the results
+    # Get the results in query order
     results = []
 
     while not output.empty():
-        results.extend(output.get())
+        results.append(output.get())
+    results = [r for i, r in sorted(results, key=lambda x: x[0])]
 
+    if flatten:
+        return [x for r in results for x in r]
     return results
 
 
@@ -313,6 +503,7 @@ def getcomp(con, db, comp_id):
             break
         except mc.ServerError:
             results = None
+            break
         except:
             # Server not responding, try again
             n += 1
@@ -323,18 +514,23 @@ def getcomp(con, db, comp_id):
                 s_err("Warning: Connection attempt limit reached for '" + \
                 comp_id + "'.\n")
                 results = None
-            if n <= 12:
-                time.sleep(10)
-            if n > 12:
-                time.sleep(30)
+                break
+            time.sleep(host_controller(con.url).backoff_delay(n))
     try:
         results = results[0]
-    except IndexError or TypeError:
+    except (IndexError, TypeError):
         results = None
     if results == None:
         s_err("Warning: '" + comp_id + \
         "' could not be retrieved from the database.\n")
-    # Fix missing KEGG IDs
+    else:
+        fix_MINE_KEGG_ids(comp_id, results)
+    # Return compound record
+    return results
+
+
+def fix_MINE_KEGG_ids(comp_id, comp):
+    """Adds KEGG IDs that are missing from some MINE compound records."""
     mid_to_kegg = {
         "X71306b6c4efe11bc7c485fbc71932f3deb14fa2c":"C00080",
         "X08a914cde05039694ef0194d9ee79ff9a79dde33":"C00001"
@@ -342,50 +538,97 @@ def getcomp(con, db, comp_id):
     if comp_id in mid_to_kegg.keys():
         kegg_id = mid_to_kegg[comp_id]
         try:
-            results['DB_links']['KEGG'] = [kegg_id]
+            comp['DB_links']['KEGG'] = [kegg_id]
         except KeyError:
-            results['DB_links'] = {'KEGG':[kegg_id]}
-    # Return compound record
-    return results
+            comp['DB_links'] = {'KEGG':[kegg_id]}
+
+
+def get_MINE_batch(con, db, ids, get_one, method):
+    """
+    Downloads several MINE records with one call to con.method, matching
+    the records to ids by their '_id'. A failed batch is split in halves,
+    and single IDs are handed to get_one (getcomp or getrxn) with its
+    reconnect functionality. Returns one record (or None) per ID.
+    """
+    if len(ids) == 1:
+        return [get_one(con, db, ids[0])]
+    try:
+        results = getattr(con, method)(db, ids)
+    except:
+        # Isolate the failing IDs (or wait out the server) in smaller batches
+        return get_MINE_batch(con, db, ids[:len(ids)//2], get_one, method) + \
+        get_MINE_batch(con, db, ids[len(ids)//2:], get_one, method)
+    records = {}
+    for record in results or []:
+        try:
+            records[record['_id']] = record
+        except (KeyError, TypeError):
+            continue
+    for _id in ids:
+        if _id not in records:
+            s_err("Warning: '" + _id + \
+            "' could not be retrieved from the database.\n")
+    return [records.get(_id) for _id in ids]
+
+
+def getcomps(con, db, comp_ids):
+    """Batched getcomp, returning one compound record (or None) per ID."""
+    comps = get_MINE_batch(con, db, comp_ids, getcomp, 'get_comps')
+    for comp_id, comp in zip(comp_ids, comps):
+        if comp is not None:
+            fix_MINE_KEGG_ids(comp_id, comp)
+    return comps
 
 
-def threaded_getcomps(con, db, comp_id_list):
-    """Threaded implementation of getcomp."""
+def threaded_MINE_batches(con, db, id_list, get_batch, num_workers=16,
+    batch_size=None):
+    """
+    Applies get_batch (getcomps or getrxns) to batches of IDs in num_workers
+    threads, reporting progress. The batch size is tuned to give each worker
+    several batches, up to 100 IDs per batch. The shared controller of the
+    server decides how many of the workers have a call in flight. Returns one
+    record (or None) per ID, in the order of id_list.
+    """
     def worker():
         while True:
-            comp_id = work.get()
-            if comp_id is None:
+            item = work.get()
+            if item is None:
                 work.task_done()
                 break
-            output.put(getcomp(con, db, comp_id))
+            i, batch = item
+            output.put((i, get_batch(con, db, batch)))
+            done.put(len(batch))
             work.task_done()
 
+    if batch_size is None:
+        batch_size = max(1, min(100, -(-len(id_list) // (4 * num_workers))))
+
     work = queue.Queue()
     output = queue.Queue()
+    done = queue.Queue()
 
     threads = []
-    num_workers = 128
 
     for i in range(num_workers):
         t = threading.Thread(target=worker)
         t.start()
         threads.append(t)
 
-    for comp_id in comp_id_list:
-        work.put(comp_id)
+    for i in range(0, len(id_list), batch_size):
+        work.put((i, id_list[i:i + batch_size]))
 
-    # Report progress
-    M = len(comp_id_list)
-    p = Progress(design='pbct', max_val=M)
+    # Report progress and server metrics
+    controller = host_controller(con.url)
+    M = len(id_list)
+    p = Progress(design='pct', max_val=M)
+    n = 0
     while True:
-        if not work.qsize():
-            n = M - work.qsize()
-            p.write(n)
+        while not done.empty():
+            n += done.get()
+        s_out("\r%s %s" % (p.to_string(n), controller.status()))
+        if n == M:
             break
-        else:
-            n = M - work.qsize()
-            p.write(n)
-            time.sleep(1)
+        time.sleep(1)
     print("")
 
     # Block until all work is done
@@ -397,13 +640,20 @@ def threaded_getcomps(con, db, comp_id_list):
     for t in threads:
         t.join()
 
-    # Get the results
-    comps = []
+    # Get the results in ID order
+    records = []
 
     while not output.empty():
-        comps.append(output.get())
+        records.append(output.get())
 
-    return comps
+    return [x for i, r in sorted(records, key=lambda x: x[0]) for x in r]
+
+
+def threaded_getcomps(con, db, comp_id_list, num_workers=16, batch_size=None):
+    """Threaded and batched implementation of getcomp."""
+    return threaded_MINE_batches(
+        con, db, comp_id_list, getcomps, num_workers, batch_size
+    )
 
 
 def getrxn(con, db, rxn_id):
@@ -415,6 +665,7 @@ def getrxn(con, db, rxn_id):
             break
         except mc.ServerError:
             results = None
+            break
         except:
             # Server not responding, try again
             n += 1
@@ -425,13 +676,11 @@ def getrxn(con, db, rxn_id):
                 s_err("Warning: Connection attempt limit reached for '" + \
                 rxn_id + "'.\n")
                 results = None
-            if n <= 12:
-                time.sleep(10)
-            if n > 12:
-                time.sleep(30)
+                break
+            time.sleep(host_controller(con.url).backoff_delay(n))
     try:
         results = results[0]
-    except IndexError or TypeError:
+    except (IndexError, TypeError):
         results = None
     if results == None:
         s_err("Warning: '" + rxn_id + \
@@ -439,61 +688,16 @@ def getrxn(con, db, rxn_id):
     return results
 
 
-def threaded_getrxn(con, db, rxn_id_list):
-    """Threaded implementation of getrxn."""
-    def worker():
-        while True:
-            rxn_id = work.get()
-            if rxn_id is None:
-                work.task_done()
-                break
-            output.put(getrxn(con, db, rxn_id))
-            work.task_done()
-
-    work = queue.Queue()
-    output = queue.Queue()
-
-    threads = []
-    num_workers = 128
-
-    for i in range(num_workers):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-
-    for rxn_id in rxn_id_list:
-        work.put(rxn_id)
-
-    # Report progress
-    M = len(rxn_id_list)
-    p = Progress(design='pbct', max_val=M)
-    while True:
-        if not work.qsize():
-            n = M - work.qsize()
-            p.write(n)
-            break
-        else:
-            n = M - work.qsize()
-            p.write(n)
-            time.sleep(1)
-    print("")
-
-    # Block until all work is done
-    work.join()
-
-    # Stop workers
-    for i in range(num_workers):
-        work.put(None)
-    for t in threads:
-        t.join()
+def getrxns(con, db, rxn_ids):
+    """Batched getrxn, returning one reaction record (or None) per ID."""
+    return get_MINE_batch(con, db, rxn_ids, getrxn, 'get_rxns')
 
-    # Get the results
-    rxns = []
 
-    while not output.empty():
-        rxns.append(output.get())
-
-    return rxns
+def threaded_getrxn(con, db, rxn_id_list, num_workers=16, batch_size=None):
+    """Threaded and batched implementation of getrxn."""
+    return threaded_MINE_batches(
+        con, db, rxn_id_list, getrxns, num_workers, batch_size
+    )
 
 
 def read_compounds(filename):
@@ -510,15 +714,21 @@ def read_compounds(filename):
     return compounds
 
 
-def KEGG_to_MINE_id(kegg_ids):
-    """Translate KEGG IDs to MINE IDs."""
+def KEGG_to_MINE_id(kegg_ids, store=None):
+    """
+    Translate KEGG IDs to MINE IDs. Search results and compounds are kept in
+    the CrawlStore store, if given.
+    """
     s_out("\nTranslating from KEGG IDs to MINE IDs...\n")
-    server_url = "http://modelseed.org/services/mine-database"
-    con = mc.mineDatabaseServices(server_url)
-    db = "KEGGexp2"
+    con, db = MINE_connection()
     kegg_id_dict = {}
-    for kegg_comp in threaded_getcomps(con, db, [x['_id'] \
-    for x in threaded_quicksearch(con, db, kegg_ids)]):
+    search_results = stored_records(store, 'MINE_search', kegg_ids,
+        lambda ids: threaded_quicksearch(con, db, ids, flatten=False))
+    MINE_ids = [x['_id'] for r in search_results for x in r]
+    for kegg_comp in stored_records(store, 'MINE_comp', MINE_ids,
+        lambda ids: threaded_getcomps(con, db, ids)):
+        if kegg_comp is None:
+            continue
         for kegg_id in kegg_comp['DB_links']['KEGG']:
             kegg_id_dict[kegg_id] = kegg_comp['_id']
     for kegg_id in kegg_ids:
@@ -615,26 +825,36 @@ def extract_comp_reaction_ids(comp):
     return rxn_id_list
 
 
-def get_raw_MINE(comp_id_list, step_limit=10, comp_limit=100000, C_limit=25):
-    """Download connected reactions and compounds up to the limits."""
+def get_raw_MINE(comp_id_list, step_limit=10, comp_limit=100000, C_limit=25,
+    num_workers=16, batch_size=50, store=None):
+    """
+    Download connected reactions and compounds up to the limits.
+
+    The crawl is pipelined: a compound is expanded as soon as a reaction
+    reaches it, and reaction and compound downloads from different steps
+    overlap in num_workers threads, lowest step first. The step of each
+    compound is the length of the shortest reaction path from the starting
+    compounds, and a compound that is reached in fewer steps than before is
+    expanded again. The network is then assembled step by step, and within
+    a step in order of reaction ID, until it holds comp_limit compounds, so
+    step_limit and comp_limit mean the same as in a step-by-step expansion.
+    The downloads stop once the steps that can no longer change hold
+    comp_limit compounds.
+
+    Downloaded records are added to the CrawlStore store, if given, as each
+    batch completes. A resumed crawl replays the stored records locally and
+    only downloads what the interrupted crawl had not.
+    """
 
     # Set up connection
-    server_url = "http://modelseed.org/services/mine-database"
-    con = mc.mineDatabaseServices(server_url)
-    db = "KEGGexp2"
-
-    s_out("\nDownloading MINE data via %s/...\n\n" % server_url)
-
-    # Set up output dictionaries
-    comp_dict = {}
-    rxn_dict = {}
+    con, db = MINE_connection()
 
-    # Set up counters
-    steps = 0
-    comps = 0
+    s_out("\nDownloading MINE data via %s/...\n\n" % con.url)
 
     # First add the starting compounds
-    for comp in threaded_getcomps(con, db, comp_id_list):
+    start_comps = {}
+    for comp in stored_records(store, 'MINE_comp', comp_id_list,
+        lambda ids: threaded_getcomps(con, db, ids)):
         if comp == None:
             continue
         try:
@@ -643,133 +863,401 @@ def get_raw_MINE(comp_id_list, step_limit=10, comp_limit=100000, C_limit=25):
             s_err("Warning: '%s' is not a valid compound.\n" % str(comp))
             continue
         if not limit_carbon(comp, C_limit):
-            comp_dict[comp_id] = comp # Add compound to dict
-            comps += 1
+            start_comps[comp_id] = comp # Add compound to dict
         else:
             s_err("Warning: Starting compound '" + comp_id + \
             "' exceeds the C limit.\n")
 
-    s_out("\nStep %s finished at %s compounds.\n" % (str(steps), str(comps)))
+    s_out("\nStep 0 finished at %s compounds.\n\n" % str(len(start_comps)))
+
+    # Reached compounds and accepted reactions (with the IDs of their
+    # compounds), and their steps so far
+    reached = dict(start_comps)
+    accepted = {}
+    comp_steps = dict.fromkeys(start_comps, 0)
+    rxn_steps = {}
 
-    extended_comp_ids = set()
     rxn_exceeding_C_limit = set()
     comp_exceeding_C_limit = set()
-    comp_cache = {}
-
-    # Perform stepwise expansion of downloaded data
-    while steps < step_limit:
-        # A new step begins
-        steps += 1
-        print("")
-
-        # Get the unexplored compounds by subtracting
-        # explored from all that are stored
-        unextended_comp_ids = set(comp_dict.keys()) - extended_comp_ids
-
-        # Go through each unexplored compound and get a list
-        # of the reactions that need to be downloaded
-        rxn_ids_to_download = set()
-
-        for comp_id in unextended_comp_ids:
-            # New compounds are always in the dictionary
-            comp = comp_dict[comp_id]
-            # Get a list of the reactions that the compound is involved in
-            rxn_id_list = extract_comp_reaction_ids(comp)
-            # Go through each reaction
-            for rxn_id in rxn_id_list:
-                # Reactions that are not in the reaction dictionary
-                # and do not exceed the C limit will be downloaded
-                # and further explored
-                req1 = rxn_id not in rxn_dict.keys()
-                req2 = rxn_id not in rxn_exceeding_C_limit
-                if req1 and req2:
-                    rxn_ids_to_download.add(rxn_id)
-
-        # Download new rxns
-        new_rxns = threaded_getrxn(con, db, list(rxn_ids_to_download))
-        print("")
-
-        # Go through the downloaded reactions and get a list
-        # of compounds to download
-        comp_ids_to_download = set()
-
-        for rxn in new_rxns:
-            if rxn == None: continue
-            rxn_comp_ids = extract_reaction_comp_ids(rxn)
-            for rxn_comp_id in rxn_comp_ids:
-                # Compounds that are not in the reaction dictionary
-                # and do not exceed the C limit will be downloaded
-                # and further explored
-                req1 = rxn_comp_id not in comp_dict.keys()
-                req2 = rxn_comp_id not in comp_cache.keys()
-                req3 = rxn_comp_id not in comp_exceeding_C_limit
-                if req1 and req2 and req3:
-                    comp_ids_to_download.add(rxn_comp_id)
-
-        # Download new compounds
-        new_comps = threaded_getcomps(con, db, list(comp_ids_to_download))
-
-        # Expand the comp_cache with the new compounds
-        for comp in new_comps:
-            if comp == None: continue
-            try:
-                comp_id = comp['_id']
-            except KeyError:
-                s_err("Warning: Compound '%s' lacks an ID " % str(comp) + \
-                "and will be skipped.\n")
+    comp_cache = {} # Downloaded compounds (None if unavailable)
+    rxn_cache = {} # Downloaded reactions (None if unavailable)
+    comp_waiters = {} # Reactions waiting for a compound download
+    comp_queue = [] # Heap of (step, ID) of compounds to download
+    rxn_queue = [] # Heap of (step, ID) of reactions to download
+    requested = set() # IDs of downloaded or downloading records
+    in_flight = {} # Downloads with their kind, IDs and lowest step
+    events = deque(('expand', comp_id) for comp_id in reached)
+
+    # Start from the records of an interrupted crawl
+    if store is not None:
+        comp_cache.update(store.get('MINE_comp'))
+        rxn_cache.update(store.get('MINE_rxn'))
+        requested.update(comp_cache, rxn_cache)
+        for comp_id, comp in comp_cache.items():
+            if comp != None and limit_carbon(comp, C_limit):
+                comp_exceeding_C_limit.add(comp_id)
+        if rxn_cache:
+            s_out("Replaying %d stored compounds and %d reactions.\n" % (
+                len(comp_cache), len(rxn_cache)
+            ))
+
+    def process_events():
+        """Expands compounds and accepts reactions until blocked."""
+        while events:
+            event, _id = events.popleft()
+            if event == 'expand':
+                step = comp_steps[_id] + 1
+                if step > step_limit:
+                    continue
+                for rxn_id in extract_comp_reaction_ids(reached[_id]):
+                    if rxn_id in rxn_exceeding_C_limit:
+                        continue
+                    if step >= rxn_steps.get(rxn_id, step_limit + 1):
+                        continue
+                    rxn_steps[rxn_id] = step
+                    if rxn_id in rxn_cache:
+                        events.append(('consider', rxn_id))
+                    elif rxn_id not in requested:
+                        heapq.heappush(rxn_queue, (step, rxn_id))
                 continue
-            comp_cache[comp_id] = comp
-
-        # Go through each new reaction and its compounds
-        for rxn in new_rxns:
-            new_rxn_comp_ids = set()
-            if rxn == None: continue
-            try:
-                rxn_id = rxn['_id']
-            except KeyError:
-                s_err("Warning: Reaction '%s' lacks an ID " % str(rxn) + \
-                "and will be skipped.\n")
+            # Consider a downloaded reaction at its current step
+            rxn = rxn_cache[_id]
+            step = rxn_steps[_id]
+            if rxn == None or _id in rxn_exceeding_C_limit:
                 continue
             rxn_comp_ids = extract_reaction_comp_ids(rxn)
-            for rxn_comp_id in rxn_comp_ids:
-                if rxn_comp_id not in comp_dict.keys():
-                    # The compound has not been added to the compound dict
-                    try:
-                        rxn_comp = comp_cache[rxn_comp_id]
-                        if limit_carbon(rxn_comp, C_limit):
-                            # Both compound reaction exceed the C limit
-                            comp_exceeding_C_limit.add(rxn_comp_id)
-                            rxn_exceeding_C_limit.add(rxn_id)
-                            # We don't want to explore this reaction further
-                            break
-                        # The compound passed the C limit
-                        new_rxn_comp_ids.add(rxn_comp_id)
-                    except KeyError:
-                        # The compound was never downloaded
-                        continue
-            # We've made it through the compounds of the reaction
-            if rxn_id in rxn_exceeding_C_limit:
+            missing = [
+                c for c in rxn_comp_ids if c not in reached and \
+                c not in comp_cache
+            ]
+            if missing:
+                # Wait for the compounds to be downloaded
+                for comp_id in missing:
+                    comp_waiters.setdefault(comp_id, set()).add(_id)
+                    if comp_id not in requested:
+                        heapq.heappush(comp_queue, (step, comp_id))
                 continue
-            # The reaction did not exceed the C limit,
-            # so let's harvest the new compounds
-            # The reaction should also be placed in the reaction dictionary
-            rxn_dict[rxn_id] = rxn
-            for new_rxn_comp_id in new_rxn_comp_ids:
-                comp_dict[new_rxn_comp_id] = comp_cache[new_rxn_comp_id]
-                comps += 1
+            new_rxn_comp_ids = set()
+            for comp_id in rxn_comp_ids:
+                if comp_id in reached:
+                    continue
+                if comp_cache[comp_id] == None:
+                    # The compound could not be downloaded
+                    continue
+                if comp_id in comp_exceeding_C_limit:
+                    # Both compound and reaction exceed the C limit
+                    rxn_exceeding_C_limit.add(_id)
+                    break
+                new_rxn_comp_ids.add(comp_id)
+            if _id in rxn_exceeding_C_limit:
+                continue
+            # The reaction did not exceed the C limit, so harvest the new
+            # compounds, and explore them (again) if reached in fewer steps
+            for comp_id in rxn_comp_ids:
+                if comp_id in new_rxn_comp_ids:
+                    reached[comp_id] = comp_cache[comp_id]
+                elif step >= comp_steps.get(comp_id, 0):
+                    continue
+                comp_steps[comp_id] = step
+                events.append(('expand', comp_id))
+            accepted[_id] = [c for c in rxn_comp_ids if c in reached]
+
+    def open_step():
+        """The lowest step of the downloads and reactions still pending."""
+        steps = [q[0][0] for q in (comp_queue, rxn_queue) if q]
+        steps.extend(step for is_comp, batch, step in in_flight.values())
+        steps.extend(
+            rxn_steps[rxn_id] for waiting in comp_waiters.values() \
+            for rxn_id in waiting
+        )
+        return min(steps + [step_limit + 1])
+
+    def assemble(max_step):
+        """
+        The network of the accepted reactions up to max_step, added step by
+        step until there are comp_limit compounds, and the compound steps.
+        Also tells if the compound limit was reached.
+        """
+        comp_dict = dict(start_comps)
+        rxn_dict = {}
+        steps = dict.fromkeys(start_comps, 0)
+        for rxn_id in sorted(accepted, key=lambda r: (rxn_steps[r], r)):
+            step = rxn_steps[rxn_id]
+            if step > max_step:
+                break
+            rxn_dict[rxn_id] = rxn_cache[rxn_id]
+            for comp_id in accepted[rxn_id]:
+                if comp_id in comp_dict:
+                    continue
+                comp_dict[comp_id] = reached[comp_id]
+                steps[comp_id] = step
                 # Stop at compound limit here
-                if comps >= comp_limit:
-                    s_out("".join([
-                        "\nStep ", str(steps), " finished at ",
-                        str(comps), " compounds.\n"
-                    ]))
-                    print("\nDone.")
-                    return (comp_dict, rxn_dict)
-        # All reactions in the current step have been explored
-        extended_comp_ids = extended_comp_ids.union(unextended_comp_ids)
-        s_out("".join([
-            "\nStep ", str(steps), " finished at ", str(comps), " compounds.\n"
-        ]))
+                if len(comp_dict) >= comp_limit:
+                    return (comp_dict, rxn_dict, steps, True)
+        return (comp_dict, rxn_dict, steps, False)
+
+    def next_batch():
+        """The lowest-step compounds or reactions to download next."""
+        heap = min(
+            [q for q in (comp_queue, rxn_queue) if q],
+            key=lambda q: q[0][0]
+        )
+        batch_step = heap[0][0]
+        batch = []
+        while heap and len(batch) < batch_size:
+            step, _id = heapq.heappop(heap)
+            if _id not in requested:
+                requested.add(_id)
+                batch.append(_id)
+        return (heap is comp_queue, batch, batch_step)
+
+    # Download and explore in a pipeline
+    controller = host_controller(con.url)
+    executor = ThreadPoolExecutor(num_workers)
+    complete_step = 0
+    process_events()
+    while True:
+        # Steps below the lowest pending step can no longer change; stop if
+        # they already hold comp_limit compounds
+        step = open_step() - 1
+        if step > complete_step:
+            complete_step = step
+            if assemble(complete_step)[3]:
+                break
+        # Keep all workers busy
+        while len(in_flight) < num_workers and (comp_queue or rxn_queue):
+            is_comp, batch, batch_step = next_batch()
+            if batch:
+                get_batch = getcomps if is_comp else getrxns
+                in_flight[executor.submit(get_batch, con, db, batch)] = \
+                (is_comp, batch, batch_step)
+        if not in_flight:
+            break
+        finished, pending = wait(
+            list(in_flight), timeout=1, return_when=FIRST_COMPLETED
+        )
+        for future in finished:
+            is_comp, batch, batch_step = in_flight.pop(future)
+            records = future.result()
+            if store is not None:
+                store.put(
+                    'MINE_comp' if is_comp else 'MINE_rxn',
+                    dict(zip(batch, records))
+                )
+            for _id, record in zip(batch, records):
+                if is_comp:
+                    comp_cache[_id] = record
+                    if record != None and limit_carbon(record, C_limit):
+                        comp_exceeding_C_limit.add(_id)
+                    for rxn_id in comp_waiters.pop(_id, ()):
+                        events.append(('consider', rxn_id))
+                else:
+                    rxn_cache[_id] = record
+                    events.append(('consider', _id))
+        process_events()
+        s_out("\rStep %d reached at %d compounds and %d reactions %s" % (
+            max(comp_steps.values() or [0]), len(reached), len(accepted),
+            controller.status()
+        ))
+
+    # Cancel the downloads that are no longer needed, and wait for those
+    # that already started, so that none continue after the crawl
+    for future in in_flight:
+        future.cancel()
+    executor.shutdown(wait=True)
+
+    comp_dict, rxn_dict, steps = assemble(step_limit)[:3]
+
+    # Report the compounds per step
+    print("")
+    for step in range(1, step_limit + 1):
+        n = len([s for s in steps.values() if s <= step])
+        s_out("\nStep %d finished at %d compounds." % (step, n))
+    print("\n\nDone.")
+    return (comp_dict, rxn_dict)
+
+
+def reaction_steps(comp_ids, rxn_comp_ids):
+    """
+    Number of reaction steps from comp_ids to each compound that can be
+    reached through the reactions, in either direction. The reactions are
+    given as a dictionary of reaction IDs and compound ID lists.
+    """
+    comp_rxns = {}
+    for rxn_id in rxn_comp_ids:
+        for comp_id in rxn_comp_ids[rxn_id]:
+            comp_rxns.setdefault(comp_id, []).append(rxn_id)
+    steps = dict.fromkeys(comp_ids, 0)
+    layer = list(steps)
+    while layer:
+        next_layer = []
+        for comp_id in layer:
+            for rxn_id in comp_rxns.get(comp_id, []):
+                for new_comp_id in rxn_comp_ids[rxn_id]:
+                    if new_comp_id not in steps:
+                        steps[new_comp_id] = steps[comp_id] + 1
+                        next_layer.append(new_comp_id)
+        layer = next_layer
+    return steps
+
+
+def MINE_path_comp_ids(rxn, comps):
+    """
+    IDs of the compounds of a MINE reaction that paths can pass through.
+    Cofactors are left out: the 'X' compounds of MINE, and compounds that
+    may not list the reaction by their KEGG IDs (see allow_reaction_listing).
+    The compound records are looked up in the dictionary comps.
+    """
+    def kegg_id(comp_id):
+        try:
+            return comps[comp_id]['DB_links']['KEGG'][0]
+        except (KeyError, IndexError, TypeError):
+            return comp_id
+    kegg_rxn = dict(
+        (side, [[x[0], kegg_id(x[1])] for x in rxn.get(side, [])]) \
+        for side in ['Reactants', 'Products']
+    )
+    path_comp_ids = []
+    for comp_id in extract_reaction_comp_ids(rxn):
+        comp = comps.get(comp_id)
+        if comp == None or comp_id.startswith('X'):
+            continue
+        if allow_reaction_listing(dict(comp, _id=kegg_id(comp_id)), kegg_rxn):
+            path_comp_ids.append(comp_id)
+    return path_comp_ids
+
+
+def get_raw_MINE_targeted(comp_id_list, target_id_list, step_limit=10,
+    comp_limit=100000, C_limit=25, store=None):
+    """
+    Download the reactions and compounds on paths of at most step_limit
+    reaction steps from the starting compounds to the target compounds.
+
+    The network is expanded one step at a time from both ends, always from
+    the end with the smaller frontier, until the two expansions together
+    span step_limit steps or one of them runs out of compounds. Every
+    reaction on a path that is short enough has then been downloaded from
+    one end or the other. Reactions are followed in both directions (through
+    'Reactant_in' and 'Product_of'), and compounds exceeding C_limit are not
+    expanded through. Paths do not pass through cofactors (see
+    MINE_path_comp_ids), other than the starting and target compounds. The
+    download also stops at comp_limit compounds.
+
+    Only the reactions on short enough paths are returned, with all of their
+    compounds, as a compound dictionary and a reaction dictionary. Records
+    are kept in the CrawlStore store, if given.
+    """
+
+    # Set up connection
+    con, db = MINE_connection()
+
+    s_out("\nDownloading MINE data via %s/...\n\n" % con.url)
+
+    comp_cache = {} # Downloaded compounds (None if unavailable)
+    rxn_cache = {} # Downloaded reactions (None if unavailable)
+    rxn_comp_ids = {} # Compound IDs of usable reactions
+    rxn_path_ids = {} # Compound IDs that paths pass through
+    exceeding_C_limit = set()
+    end_ids = set(comp_id_list) | set(target_id_list)
+
+    def download_comps(comp_ids):
+        comp_ids = [c for c in dict.fromkeys(comp_ids) if c not in comp_cache]
+        for comp_id, comp in zip(comp_ids, stored_records(
+            store, 'MINE_comp', comp_ids,
+            lambda ids: threaded_getcomps(con, db, ids)
+        )):
+            comp_cache[comp_id] = comp
+            if comp != None and limit_carbon(comp, C_limit):
+                exceeding_C_limit.add(comp_id)
+
+    def download_rxns(rxn_ids):
+        rxn_ids = [r for r in dict.fromkeys(rxn_ids) if r not in rxn_cache]
+        rxn_cache.update(zip(rxn_ids, stored_records(
+            store, 'MINE_rxn', rxn_ids,
+            lambda ids: threaded_getrxn(con, db, ids)
+        )))
+        rxn_ids = [r for r in rxn_ids if rxn_cache[r] != None]
+        # Download the compounds, to tell which reactions can be used
+        download_comps([
+            c for r in rxn_ids for c in extract_reaction_comp_ids(rxn_cache[r])
+        ])
+        for rxn_id in rxn_ids:
+            comp_ids = [
+                c for c in extract_reaction_comp_ids(rxn_cache[rxn_id]) \
+                if comp_cache[c] != None
+            ]
+            if not any(c in exceeding_C_limit for c in comp_ids):
+                rxn_comp_ids[rxn_id] = comp_ids
+                path_ids = MINE_path_comp_ids(rxn_cache[rxn_id], comp_cache)
+                rxn_path_ids[rxn_id] = [
+                    c for c in comp_ids if c in end_ids or c in path_ids
+                ]
+
+    # Add the starting and target compounds
+    download_comps(list(comp_id_list) + list(target_id_list))
+    ends = []
+    for name, comp_ids in [('Starting', comp_id_list), \
+    ('Target', target_id_list)]:
+        end = set()
+        for comp_id in comp_ids:
+            if comp_cache[comp_id] == None:
+                continue
+            if comp_id in exceeding_C_limit:
+                s_err("Warning: %s compound '%s' exceeds the C limit.\n" % (
+                    name, comp_id
+                ))
+                continue
+            end.add(comp_id)
+        ends.append(end)
+    origins, targets = ends
+
+    # Expand from both ends, starting with the smaller frontier
+    reached = [dict.fromkeys(origins, 0), dict.fromkeys(targets, 0)]
+    frontiers = [set(origins), set(targets)]
+    radii = [0, 0]
+    while sum(radii) < step_limit and all(frontiers):
+        if len(comp_cache) >= comp_limit:
+            s_err("Warning: Compound limit reached.\n")
+            break
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        s_out("Expanding %d %s compounds...\n" % (
+            len(frontiers[side]), ['starting', 'target'][side]
+        ))
+        frontier_rxn_ids = [
+            r for c in frontiers[side] \
+            for r in extract_comp_reaction_ids(comp_cache[c])
+        ]
+        download_rxns(frontier_rxn_ids)
+        radii[side] += 1
+        new_frontier = set()
+        for rxn_id in frontier_rxn_ids:
+            for comp_id in rxn_path_ids.get(rxn_id, []):
+                if comp_id not in reached[side]:
+                    reached[side][comp_id] = radii[side]
+                    new_frontier.add(comp_id)
+        frontiers[side] = new_frontier
+        s_out("Expanded %d steps from the starting compounds and %d steps " \
+        "from the targets at %d compounds and %d reactions.\n\n" % (
+            radii[0], radii[1], len(comp_cache), len(rxn_cache)
+        ))
+
+    # Keep the reactions that lead from a compound close enough to the
+    # starting compounds to another compound close enough to the targets
+    from_origins = reaction_steps(origins, rxn_path_ids)
+    to_targets = reaction_steps(targets, rxn_path_ids)
+    comp_dict = dict((c, comp_cache[c]) for c in origins | targets)
+    rxn_dict = {}
+    for rxn_id, path_ids in rxn_path_ids.items():
+        if any(from_origins.get(a, step_limit) + 1 + \
+        to_targets.get(b, step_limit) <= step_limit \
+        for a in path_ids for b in path_ids if a != b):
+            rxn_dict[rxn_id] = rxn_cache[rxn_id]
+            for comp_id in rxn_comp_ids[rxn_id]:
+                comp_dict[comp_id] = comp_cache[comp_id]
+
+    s_out("Found %d compounds and %d reactions on paths to the targets.\n" % (
+        len(comp_dict), len(rxn_dict)
+    ))
     print("\nDone.")
     return (comp_dict, rxn_dict)
 
@@ -1671,15 +2159,16 @@ def add_MINE_rxns_to_KEGG_comps(comps, rxns):
     return new_comps
 
 
-def enhance_KEGG_with_MINE(KEGG_comp_dict, KEGG_rxn_dict):
-    """Enhance a raw KEGG reaction network with MINE reactions."""
+def enhance_KEGG_with_MINE(KEGG_comp_dict, KEGG_rxn_dict, store=None):
+    """
+    Enhance a raw KEGG reaction network with MINE reactions. Downloaded
+    records are kept in the CrawlStore store, if given.
+    """
 
     print("\nEnhancing KEGG reaction network data with MINE reactions...\n")
 
     # Set up MINE connection
-    server_url = "http://modelseed.org/services/mine-database"
-    con = mc.mineDatabaseServices(server_url)
-    db = "KEGGexp2"
+    con, db = MINE_connection()
 
     # Create a list of KEGG compound IDs
     KEGG_comp_ids = list(KEGG_comp_dict.keys())
@@ -1687,15 +2176,18 @@ def enhance_KEGG_with_MINE(KEGG_comp_dict, KEGG_rxn_dict):
     # Create a list of IDs for MINE compounds to download
     print("Identifying KEGG compounds in MINE...")
     MINE_comp_ids = set()
-    for MINE_query_result in threaded_quicksearch(con, db, KEGG_comp_ids):
-        try:
-            MINE_comp_ids.add(MINE_query_result['_id'])
-        except KeyError:
-            continue
+    for MINE_query_results in stored_records(store, 'MINE_search', \
+    KEGG_comp_ids, lambda ids: threaded_quicksearch(con, db, ids, False)):
+        for MINE_query_result in MINE_query_results:
+            try:
+                MINE_comp_ids.add(MINE_query_result['_id'])
+            except KeyError:
+                continue
 
     # Download the MINE compounds corresponding to KEGG IDs
     print("\nDownloading MINE compounds...")
-    MINE_comps = threaded_getcomps(con, db, list(MINE_comp_ids))
+    MINE_comps = stored_records(store, 'MINE_comp', list(MINE_comp_ids),
+        lambda ids: threaded_getcomps(con, db, ids))
     print("")
 
     # Create a list of IDs for MINE reactions to download
@@ -1711,7 +2203,8 @@ def enhance_KEGG_with_MINE(KEGG_comp_dict, KEGG_rxn_dict):
 
     # Download the MINE reactions listed for the MINE compounds
     s_out("Downloading MINE reactions...\n")
-    MINE_rxns = list(filter(None, threaded_getrxn(con, db, list(MINE_rxn_ids))))
+    MINE_rxns = list(filter(None, stored_records(store, 'MINE_rxn', \
+    list(MINE_rxn_ids), lambda ids: threaded_getrxn(con, db, ids))))
     #MINE_rxns = pickle.load(open('/ssd/common/db/mine/MINE_rxns.pickle', 'rb'))
 
     # Download the 'X' MINE compounds listed for the reactions
@@ -1724,7 +2217,8 @@ def enhance_KEGG_with_MINE(KEGG_comp_dict, KEGG_rxn_dict):
                 MINE_X_comp_ids.add(cid)
     s_out(" Done.\n")
     s_out("\nDownloading MINE cofactors...\n")
-    MINE_comps = MINE_comps + threaded_getcomps(con, db, list(MINE_X_comp_ids))
+    MINE_comps = MINE_comps + stored_records(store, 'MINE_comp', \
+    list(MINE_X_comp_ids), lambda ids: threaded_getcomps(con, db, ids))
 
     # Add ferredoxin
     add_ferredoxin(MINE_rxns, MINE_comps)
@@ -2057,7 +2551,10 @@ def add_ferredoxin(rxns, cpds):
 
 # Main code block
 def main(outfile_name, infile, mine, kegg, step_limit,
-    comp_limit, C_limit, enhance, eq_filter):
+    comp_limit, C_limit, enhance, eq_filter, cache_dir=None,
+    cache_max_age=None, offline=False, checkpoint_file=None, resume=False,
+    target_file=None, kegg_compound_file=None, kegg_reaction_file=None,
+    kegg_mol_dir=None, mine_dump=None):
 
     # Exit if a database choice has not been specified
     if not mine and not kegg:
@@ -2068,6 +2565,28 @@ def main(outfile_name, infile, mine, kegg, step_limit,
         )
         sys.exit(msg)
 
+    # KEGG flat files replace the KEGG download
+    if bool(kegg_compound_file) != bool(kegg_reaction_file):
+        msg = "\nPlease supply both a KEGG compound and a reaction flat file.\n"
+        sys.exit(msg)
+
+    # Read MINE data from a local dump instead of the server
+    if mine_dump and not os.path.exists(mine_dump):
+        sys.exit("\nThe MINE dump index '%s' does not exist.\n" % mine_dump)
+    configure_MINE(mine_dump)
+
+    # Set up the KEGG and MINE response cache
+    if offline and not cache_dir:
+        sys.exit("\nOffline mode requires a response cache (--cache).\n")
+    configure_cache(cache_dir, cache_max_age, offline)
+
+    # Set up the crawl checkpoint
+    if resume and not checkpoint_file:
+        sys.exit("\nResuming requires a crawl checkpoint (--checkpoint).\n")
+    store = None
+    if checkpoint_file:
+        store = CrawlStore(checkpoint_file, resume)
+
     # Get starting compounds
     if infile:
         start_kegg_ids = read_compounds(infile)
@@ -2077,18 +2596,31 @@ def main(outfile_name, infile, mine, kegg, step_limit,
     # Acquire raw KEGG dictionaries
     kegg_comp_dict = {} # Default
     kegg_rxn_dict = {} # Default
-    if kegg:
-        #kegg_file = '/ssd/common/db/kegg/KEGG_cpd_rxn.pickle'
-        #kegg_comp_dict, kegg_rxn_dict = pickle.load(open(kegg_file, 'rb'))
-        kegg_comp_dict, kegg_rxn_dict = get_raw_KEGG()
+    if kegg and kegg_compound_file:
+        kegg_comp_dict, kegg_rxn_dict = get_raw_KEGG_files(
+            kegg_compound_file, kegg_reaction_file, kegg_mol_dir
+        )
+    elif kegg:
+        kegg_comp_dict, kegg_rxn_dict = get_raw_KEGG(store=store)
 
     # Acquire raw MINE dictionaries
     start_ids = [] # Default
     mine_comp_dict = {} # Default
     mine_rxn_dict = {} # Default
     if mine and not enhance:
-        start_ids = list(set(KEGG_to_MINE_id(start_kegg_ids).values()))
-        raw_mine = get_raw_MINE(start_ids, step_limit, comp_limit, C_limit)
+        start_ids = sorted(set(KEGG_to_MINE_id(start_kegg_ids, store).values()))
+        if target_file:
+            # Download only the paths from the starting compounds to targets
+            target_ids = sorted(set(KEGG_to_MINE_id(
+                read_compounds(target_file), store
+            ).values()))
+            raw_mine = get_raw_MINE_targeted(
+                start_ids, target_ids, step_limit, comp_limit, C_limit, store
+            )
+        else:
+            raw_mine = get_raw_MINE(
+                start_ids, step_limit, comp_limit, C_limit, store=store
+            )
         mine_comp_dict = raw_mine[0]
         mine_rxn_dict = raw_mine[1]
         add_ferredoxin(mine_rxn_dict, mine_comp_dict)
@@ -2100,7 +2632,7 @@ def main(outfile_name, infile, mine, kegg, step_limit,
     # Perform KEGG enhancement
     if not mine and kegg and enhance:
         mine_comp_dict, mine_rxn_dict = enhance_KEGG_with_MINE(
-            mine_comp_dict, mine_rxn_dict
+            mine_comp_dict, mine_rxn_dict, store
         )
 
     # Filter to equilibrator compatible reactions
@@ -2153,6 +2685,11 @@ if __name__ == "__main__":
         '-i', '--infile',
         help='Read KEGG compound identifiers from text file.'
     )
+    parser.add_argument(
+        '-t', '--targets',
+        help='Read target KEGG compound identifiers from text file, and ' + \
+        'download only MINE reactions on paths to these.'
+    )
     parser.add_argument(
         '-M', '--mine', action='store_true',
         help='Use MINE for network construction.'
@@ -2181,8 +2718,51 @@ if __name__ == "__main__":
         '-E', '--equilibrator_filter', action='store_true',
         help='Remove equilibrator incompatible reactions.'
     )
+    parser.add_argument(
+        '--cache', metavar='DIR',
+        help='Cache KEGG and MINE responses in this directory.'
+    )
+    parser.add_argument(
+        '--cache_max_age', type=float, metavar='DAYS',
+        help='Download cached responses older than this again.'
+    )
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='Use only cached KEGG and MINE responses.'
+    )
+    parser.add_argument(
+        '--kegg_compound', metavar='FILE',
+        help='Read KEGG compounds from this flat file instead of ' + \
+        'downloading them (requires --kegg_reaction).'
+    )
+    parser.add_argument(
+        '--kegg_reaction', metavar='FILE',
+        help='Read KEGG reactions from this flat file instead of ' + \
+        'downloading them (requires --kegg_compound).'
+    )
+    parser.add_argument(
+        '--kegg_mol', metavar='DIR',
+        help='Read KEGG compound structures from the mol files in this ' + \
+        'directory.'
+    )
+    parser.add_argument(
+        '--mine_dump', metavar='INDEX',
+        help='Read MINE data from a local database dump, indexed with ' + \
+        'mine_dump.py, instead of the MINE server.'
+    )
+    parser.add_argument(
+        '--checkpoint', metavar='FILE',
+        help='Save downloaded KEGG and MINE records to this file.'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume an interrupted download from the checkpoint file.'
+    )
 
     args = parser.parse_args()
 
     main(args.outfile, args.infile, args.mine, args.kegg, args.r, \
-    args.c, args.C, args.enhance, args.equilibrator_filter)
+    args.c, args.C, args.enhance, args.equilibrator_filter, args.cache, \
+    args.cache_max_age, args.offline, args.checkpoint, args.resume, \
+    args.targets, args.kegg_compound, args.kegg_reaction, args.kegg_mol, \
+    args.mine_dump)
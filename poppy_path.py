@@ -733,6 +733,27 @@ def format_reaction_text(reaction, reverse=False):
     return " ".join([str(x) for x in rxn_elements])
 
 
+def warm_drG_cache(network, cache, pH=7.0, n_procs=1):
+    """Precompute the eQuilibrator drGs of all network reactions
+
+    The drGs are calculated by n_procs processes and stored in cache (see
+    poppy_rank.DrGCache) in batches, so an interrupted warm-up keeps its
+    progress. Reversed reactions share the entry of the forward reaction.
+    """
+    rxn_ids = sorted(set([
+        network.node[n]['mid'] for n in network.nodes() \
+        if network.node[n]['type'] in {'rf','rr'}
+    ]))
+    equations = [
+        format_reaction_text(network.graph['mine_data'][rxn_id])
+        for rxn_id in rxn_ids
+    ]
+    s_out("Warming drG cache for %d reactions..." % len(equations))
+    rank.create_drG_dict(equations, None, pH, cache, n_procs)
+    s_out(" Done.\n")
+    return len(equations)
+
+
 def format_pathway_text(network, pathways, target_node, pw_sep=True):
     """Create pathways record in text format"""
     pathway_lines = []
@@ -1087,7 +1108,8 @@ def disconnect_reactants_products(
 def main(infile_name, compound, ban_reac_file, ban_prod_file,
     start_comp_id_file, exact_comp_id, rxn_lim, depth, n_procs, sub_network_out,
     pathway_pickle, shallow, pathway_text, pathway_html, n_pw_out, c_min, c_max,
-    bounds, ratios, dfG_json, net_file, pH, T, R):
+    bounds, ratios, dfG_json, net_file, pH, T, R, drG_cache_file=None,
+    mdf_cache_file=None, top_n=None):
 
     # Default results are empty
     results = {}
@@ -1200,7 +1222,12 @@ def main(infile_name, compound, ban_reac_file, ban_prod_file,
             # Perform MDF
             mdf_dict = rank.pathways_to_mdf(
                 pw_rank, dfG_dict, ne_con, eq_con, n_procs, T, R, net_text,
-                c_max, c_min, pH
+                c_max, c_min, pH,
+                drG_cache=rank.DrGCache(drG_cache_file) if drG_cache_file \
+                          else None,
+                mdf_cache=rank.MDFCache(mdf_cache_file) if mdf_cache_file \
+                          else None,
+                top_n=top_n
             )
 
             # Create output directory structure
@@ -1284,6 +1311,34 @@ def main(infile_name, compound, ban_reac_file, ban_prod_file,
 
 
 if __name__ == "__main__":
+    # Precompute eQuilibrator drGs for all reactions in a network
+    if len(sys.argv) > 1 and sys.argv[1] == 'warm':
+        parser = argparse.ArgumentParser(prog='poppy_path.py warm')
+        parser.add_argument(
+            'infile',
+            help='Read reaction network pickle.'
+        )
+        parser.add_argument(
+            'drG_cache', type=str,
+            help='Store eQuilibrator drGs in this SQLite cache file.'
+        )
+        parser.add_argument(
+            '--pH', type=float, default=7.0,
+            help='Specify the pH for the thermodynamics calculations.'
+        )
+        parser.add_argument(
+            '-p', '--processes', type=int, default=1,
+            help='Number of parallel processes to run.'
+        )
+        args = parser.parse_args(sys.argv[2:])
+        s_out("\nLoading network pickle...")
+        network = pickle.load(open(args.infile, 'rb'))
+        s_out(" Done.\n")
+        warm_drG_cache(
+            network, rank.DrGCache(args.drG_cache), args.pH, args.processes
+        )
+        sys.exit()
+
     # Read arguments from the commandline
     parser = argparse.ArgumentParser()
 
@@ -1392,6 +1447,20 @@ if __name__ == "__main__":
         '-R', type=float, default=8.31e-3,
         help='Universal gas constant (kJ/(mol*K)).'
     )
+    parser.add_argument(
+        '--drG_cache', type=str, default=None,
+        help='Read and update eQuilibrator drGs in this SQLite cache file ' + \
+             '(precompute with "poppy_path.py warm").'
+    )
+    parser.add_argument(
+        '--mdf_cache', type=str, default=None,
+        help='Read and update pathway MDF values in this SQLite cache file.'
+    )
+    parser.add_argument(
+        '--top', type=int, default=None, metavar='N',
+        help='Only optimize pathways until the N best are known ' + \
+             '(see --n_html_pathways); other pathways are left out.'
+    )
 
     args = parser.parse_args()
 
@@ -1402,5 +1471,5 @@ if __name__ == "__main__":
         args.processes, args.sub_network, args.pathway_pickle, args.shallow,
         args.pathway_text, args.pathway_html, args.n_html_pathways, args.c_min,
         args.c_max, args.bounds, args.ratios, args.gibbs, args.model, args.pH,
-        args.T, args.R
+        args.T, args.R, args.drG_cache, args.mdf_cache, args.top
     )
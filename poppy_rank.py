@@ -4,15 +4,16 @@
 import sys
 import argparse
 import multiprocessing as mp
-import time
-from datetime import timedelta as delta
-import threading
 import re
 from itertools import product
 from decimal import Decimal
 import json
 import hashlib
+import os
+import sqlite3
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from equilibrator_api import ComponentContribution, Reaction, ReactionMatcher
 
 # Import scripts
@@ -81,6 +82,219 @@ def reaction_gibbs(equation, dfG_dict = None, pH = 7.0, eq_api=None):
         return round(eq_api.dG0_prime(rxn)[0], 1)
 
 
+def equation_matrix(equations, strip_compartments=True):
+    """Build a sparse stoichiometric matrix for a list of KEGG equations
+
+    Returns the list of compounds and a scipy.sparse.csr_matrix with one row
+    per equation and one column per compound (products positive, reactants
+    negative), as well as a matrix of the same shape with the number of times
+    each compound occurs in each equation. Compartment tags are removed from
+    the compound IDs unless strip_compartments is False.
+    """
+    rows = []
+    cols = []
+    vals = []
+    cpd_index = {}
+    for i, equation in enumerate(equations):
+        # Remove compartment tags from compound IDs
+        if strip_compartments:
+            equation = re.sub("_\[[a-z]{3}\]", "", equation)
+            equation = re.sub("_[a-z]{1}", "", equation)
+        s = parse_equation(equation)
+        for sign, side in [(-1, s[0]), (1, s[1])]:
+            for n, cpd in side:
+                rows.append(i)
+                cols.append(cpd_index.setdefault(cpd, len(cpd_index)))
+                vals.append(sign*n)
+    shape = (len(equations), len(cpd_index))
+    S = sparse.csr_matrix((vals, (rows, cols)), shape=shape, dtype=float)
+    occurrence = sparse.csr_matrix(
+        (np.ones(len(vals)), (rows, cols)), shape=shape
+    )
+    return list(cpd_index), S, occurrence
+
+
+def reaction_gibbs_vector(equations, dfG_dict):
+    """Calculate standard Gibbs reaction energies for many equations at once
+
+    Returns a dictionary of unique equations and their drGs, computed as one
+    sparse matrix-vector product. The drG is NaN when a dfG is missing.
+    """
+    equations = list(dict.fromkeys(equations))
+    compounds, S, occurrence = equation_matrix(equations)
+    dfGs = np.array(
+        [dfG_dict.get(cpd) for cpd in compounds], dtype=float
+    ).reshape(-1)
+    missing = np.isnan(dfGs)
+    drGs = S.dot(np.where(missing, 0, dfGs))
+    drGs[occurrence.dot(missing.astype(float)) > 0] = np.nan
+    # Round off floating point summation errors
+    return dict(zip(equations, np.round(drGs, 10)))
+
+
+def canonical_equation(equation):
+    """Return a canonical form of an equation and its orientation
+
+    Compartment tags are removed and the compounds on each side are sorted,
+    and the side that sorts first becomes the reactant side. The orientation
+    is 1 if the canonical form has the same direction as the equation and -1
+    if it is reversed.
+    """
+    equation = re.sub("_\[[a-z]{3}\]", "", equation)
+    equation = re.sub("_[a-z]{1}", "", equation)
+    sides = re.split(" +<?=>? +", equation.strip())
+    s = parse_equation(sides[0] + " <=> " + sides[1])
+    r, p = [
+        " + ".join([
+            c if n == 1 else "%d %s" % (n, c)
+            for c, n in sorted([(c, n) for n, c in side])
+        ])
+        for side in s
+    ]
+    if r <= p:
+        return r + " <=> " + p, 1
+    else:
+        return p + " <=> " + r, -1
+
+
+class DrGCache(object):
+    """Persistent cache of eQuilibrator standard reaction Gibbs energies
+
+    Values are stored in an SQLite database, keyed by canonical equation (see
+    canonical_equation), pH, ionic strength and temperature. Each process
+    opens its own connection, so one cache file can be shared by concurrent
+    runs and by the workers of a pool.
+    """
+
+    table = (
+        "drG (equation TEXT, pH REAL, ionic_strength REAL, T REAL, drG REAL, "
+        "PRIMARY KEY (equation, pH, ionic_strength, T))"
+    )
+
+    def __init__(self, path, timeout=600):
+        self.path = path
+        self.timeout = timeout
+        self._pid = None
+        self._con = None
+        self._connect().close()
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+        except sqlite3.OperationalError:
+            # Not supported on some network file systems; use the default
+            pass
+        with con:
+            con.execute("CREATE TABLE IF NOT EXISTS " + self.table)
+        return con
+
+    def connection(self):
+        # Connections can not be shared with forked processes
+        if self._pid != os.getpid():
+            self._con = self._connect()
+            self._pid = os.getpid()
+        return self._con
+
+    def get(self, equations, pH=7.0, ionic_strength=0.1, T=298.15):
+        """Return a dictionary with the cached drGs of canonical equations"""
+        equations = list(equations)
+        drGs = {}
+        con = self.connection()
+        for i in range(0, len(equations), 500):
+            batch = equations[i:i + 500]
+            drGs.update(con.execute(
+                "SELECT equation, drG FROM drG "
+                "WHERE pH=? AND ionic_strength=? AND T=? AND equation IN (%s)"
+                % ",".join("?"*len(batch)),
+                [pH, ionic_strength, T] + batch
+            ).fetchall())
+        return drGs
+
+    def put(self, drGs, pH=7.0, ionic_strength=0.1, T=298.15):
+        """Store a dictionary of canonical equations and drGs"""
+        with self.connection() as con:
+            con.executemany(
+                "INSERT OR REPLACE INTO drG VALUES (?,?,?,?,?)",
+                [(eq, pH, ionic_strength, T, drG) for eq, drG in drGs.items()]
+            )
+
+    def __getstate__(self):
+        return {'path':self.path, 'timeout':self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['timeout'])
+
+
+class MDFCache(DrGCache):
+    """Persistent cache of pathway MDF values
+
+    Values are stored in an SQLite database (which may be shared with a
+    DrGCache), keyed by pathway hash (see generate_pathway_hash) and by a
+    fingerprint of the other inputs of the optimization (see
+    mdf_fingerprint). Failed optimizations are stored as None. The pathway
+    hashes are full digests (see mdf_cache_key), not the display hashes of
+    generate_pathway_hash.
+    """
+
+    table = (
+        "mdf (pathway_hash TEXT, fingerprint TEXT, mdf REAL, "
+        "PRIMARY KEY (pathway_hash, fingerprint))"
+    )
+
+    def get(self, pathway_hashes, fingerprint):
+        """Return a dictionary with the cached MDF values of pathway hashes"""
+        pathway_hashes = list(pathway_hashes)
+        mdfs = {}
+        con = self.connection()
+        for i in range(0, len(pathway_hashes), 500):
+            batch = pathway_hashes[i:i + 500]
+            mdfs.update(con.execute(
+                "SELECT pathway_hash, mdf FROM mdf "
+                "WHERE fingerprint=? AND pathway_hash IN (%s)"
+                % ",".join("?"*len(batch)),
+                [fingerprint] + batch
+            ).fetchall())
+        return mdfs
+
+    def put(self, mdfs, fingerprint):
+        """Store a dictionary of pathway hashes and MDF values"""
+        with self.connection() as con:
+            con.executemany(
+                "INSERT OR REPLACE INTO mdf VALUES (?,?,?)",
+                [(h, fingerprint, v) for h, v in mdfs.items()]
+            )
+
+
+def mdf_fingerprint(ne_con, eq_con, network_text, x_max, x_min, T, R, pH,
+    dfGs=None):
+    """Returns an MD5 hexdigest of all MDF inputs other than the pathway"""
+    fingerprint = "\n//\n".join([
+        ne_con.to_csv(index=False),
+        eq_con.to_csv(index=False),
+        "\n".join(sorted(filter(None, network_text.split("\n")))),
+        repr([float(x) for x in [x_max, x_min, T, R, pH]]),
+        json.dumps(dfGs, sort_keys=True) if dfGs else "eQuilibrator"
+    ])
+    return hashlib.md5(fingerprint.encode()).hexdigest()
+
+
+def mdf_cache_key(pathway, network_rxns=()):
+    """Returns a SHA-256 hexdigest identifying the NEM problem of a pathway
+
+    Reactions are reduced to their equation, with the compounds on each side
+    sorted but compartments and direction kept, and to whether their ID is in
+    the background network, as pathway reactions that are also network
+    reactions do not have to be driven by B (see pathway_mdf_problem).
+    """
+    essence = []
+    for line in filter(None, pathway.split("\n")):
+        rxn_id, equation = line.split("\t")[:2]
+        sides = [sorted(side) for side in parse_equation(equation.strip())]
+        essence.append(repr((sides, rxn_id in network_rxns)))
+    return hashlib.sha256("\n".join(sorted(essence)).encode()).hexdigest()
+
+
 def read_pathways_text(pathways_text):
     """Read a pathways string and return it as a list"""
 
@@ -130,146 +344,436 @@ def drGs_for_pathway(pathway, drG_dict):
     return drGs
 
 
-def create_drG_dict(equations, dfG_dict = None, pH=7.0):
-    eq_api = ComponentContribution(pH=pH, ionic_strength=0.1)
-    return dict(zip(
-        equations, [reaction_gibbs(x, dfG_dict, pH, eq_api) for x in equations]
+# eQuilibrator API and pH of a create_drG_dict pool worker
+eq_api_worker = (None, 7.0)
+
+
+def init_eq_api_worker(pH):
+    """Initialise one ComponentContribution per pool worker"""
+    global eq_api_worker
+    eq_api_worker = (ComponentContribution(pH=pH, ionic_strength=0.1), pH)
+
+
+def eq_api_worker_gibbs(equation):
+    """Calculate standard Gibbs reaction energy in a pool worker"""
+    eq_api, pH = eq_api_worker
+    return equation, reaction_gibbs(equation, None, pH, eq_api)
+
+
+def create_drG_dict(equations, dfG_dict = None, pH=7.0, cache=None,
+                    n_procs=1, batch_size=100):
+    if dfG_dict:
+        return reaction_gibbs_vector(equations, dfG_dict)
+
+    # Evaluate each canonical equation only once (see canonical_equation)
+    canonical = {eq:canonical_equation(eq) for eq in equations}
+    unique = sorted(set(c[0] for c in canonical.values()))
+
+    # Look up the canonical equations in the cache (see DrGCache)
+    drGs = {}
+    if cache is not None:
+        drGs = cache.get(unique, pH)
+
+    # Calculate the missing drGs, storing them in batches
+    missing = [eq for eq in unique if eq not in drGs]
+    if missing:
+        if n_procs > 1 and len(missing) > 1:
+            pool = mp.Pool(
+                min(n_procs, len(missing)), init_eq_api_worker, (pH,)
+            )
+            results = pool.imap_unordered(
+                eq_api_worker_gibbs, missing,
+                max(1, min(batch_size, len(missing) // (4*n_procs)))
+            )
+        else:
+            pool = None
+            eq_api = ComponentContribution(pH=pH, ionic_strength=0.1)
+            results = (
+                (eq, reaction_gibbs(eq, None, pH, eq_api)) for eq in missing
+            )
+        try:
+            new_drGs = {}
+            for eq, drG in results:
+                new_drGs[eq] = drG
+                if cache is not None and len(new_drGs) == batch_size:
+                    cache.put(new_drGs, pH)
+                    drGs.update(new_drGs)
+                    new_drGs = {}
+            if cache is not None and new_drGs:
+                cache.put(new_drGs, pH)
+            drGs.update(new_drGs)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    return {
+        eq:(None if drGs[c] is None else o*drGs[c])
+        for eq, (c, o) in canonical.items()
+    }
+
+
+def network_mdf_block(network_text, eq_to_drG, ne_con, eq_con, x_max=0.1,
+    x_min=0.0000001, T=298.15, R=8.31e-3):
+    """Build the parts of the NEM problem that are shared by all pathways
+
+    Returns a dictionary with the background network stoichiometric matrix,
+    compound and reaction IDs, the reaction rows of the b vector, the log
+    concentration bounds of the network compounds and everything needed to
+    add the bounds and ratios of pathway compounds (see pathway_mdf_problem).
+    """
+    S_net = mdf.read_reactions(network_text)
+
+    # Concentration bounds; the first row of a compound is used (see mdf_b)
+    bounds = {}
+    for row in reversed(ne_con.index):
+        bounds[ne_con.loc[row, 'cpd_id']] = (
+            float(ne_con.loc[row, 'x_min']), float(ne_con.loc[row, 'x_max'])
+        )
+
+    # Reaction Gibbs energies
+    drGs = {}
+    for line in filter(None, network_text.split("\n")):
+        drGs[line.split("\t")[0]] = eq_to_drG[line.split("\t")[1]]
+
+    net = {
+        'S':np.array(S_net, dtype=float),
+        'cpds':list(S_net.index),
+        'cpd_pos':{cpd:i for i, cpd in enumerate(S_net.index)},
+        'rxns':list(S_net.columns),
+        'b_rxn':-np.array([drGs[r] for r in S_net.columns], dtype=float)/(R*T),
+        'bounds':bounds,
+        'x_max':x_max,
+        'x_min':x_min,
+        'T':T,
+        'R':R,
+        'eq_con':eq_con,
+        'ratios':[
+            (row, eq_con.loc[row, 'cpd_id_num'], eq_con.loc[row, 'cpd_id_den'],
+             np.log(eq_con.loc[row, 'ratio']))
+            for row in eq_con.index
+        ]
+    }
+    net['ln_max'], net['ln_min'] = log_bounds(net['cpds'], net)
+    return net
+
+
+def log_bounds(cpds, net):
+    """Log upper bound and negative log lower bound vectors (see mdf_b)"""
+    x = [net['bounds'].get(cpd, (net['x_min'], net['x_max'])) for cpd in cpds]
+    return (
+        np.log(np.array([v[1] for v in x], dtype=float)),
+        -np.log(np.array([v[0] for v in x], dtype=float))
+    )
+
+
+def pathway_mdf_problem(pathway, net, eq_to_drG):
+    """Add a pathway to the shared network block (see network_mdf_block)
+
+    Returns the stoichiometric matrix DataFrame, the c, A, b, A_eq and b_eq
+    of the NEM problem (see mdf.mdf) and the ratio constraints between its
+    compounds. The network compounds come first, followed by new pathway
+    compounds, and the pathway reactions precede the network reactions.
+    """
+    S_pat = mdf.read_reactions(pathway)
+    n_pat = S_pat.shape[1]
+    n_net = len(net['rxns'])
+
+    # Compounds; new pathway compounds are added after the network compounds
+    cpd_pos = net['cpd_pos']
+    new_cpds = [cpd for cpd in S_pat.index if cpd not in cpd_pos]
+    cpds = net['cpds'] + new_cpds
+    pat_rows = [
+        cpd_pos[cpd] if cpd in cpd_pos else len(cpd_pos) + new_cpds.index(cpd)
+        for cpd in S_pat.index
+    ]
+    m = len(cpds)
+
+    # Stoichiometric matrix with the network block in place
+    S = np.zeros((m, n_pat + n_net))
+    S[pat_rows, :n_pat] = np.array(S_pat, dtype=float)
+    S[:len(cpd_pos), n_pat:] = net['S']
+
+    # A matrix; only the pathway reactions have to be driven by B
+    net_rxns = set(net['rxns'])
+    w = np.array(
+        [0 if r in net_rxns else 1 for r in S_pat.columns] + [0]*n_net
+    )
+    I = np.eye(m)
+    Z = np.zeros((m, 1))
+    A = np.block([[S.T, w[:,np.newaxis]], [I, Z], [-I, Z]])
+
+    # b vector
+    drGs = {}
+    for line in filter(None, pathway.split("\n")):
+        drGs[line.split("\t")[0]] = eq_to_drG[line.split("\t")[1]]
+    T, R = net['T'], net['R']
+    ln_max, ln_min = log_bounds(new_cpds, net)
+    b = np.concatenate((
+        -np.array([drGs[r] for r in S_pat.columns], dtype=float)/(R*T),
+        net['b_rxn'],
+        net['ln_max'], ln_max,
+        net['ln_min'], ln_min
     ))
 
+    # c vector
+    c = np.zeros(m + 1)
+    c[-1] = 1
+
+    # Ratio constraints between compounds of the problem
+    pos = dict(cpd_pos)
+    pos.update({cpd:len(cpd_pos) + i for i, cpd in enumerate(new_cpds)})
+    ratios = [r for r in net['ratios'] if r[1] in pos and r[2] in pos]
+    if ratios:
+        A_eq = np.zeros((len(ratios), m + 1))
+        for k, (row, num, den, ln_ratio) in enumerate(ratios):
+            A_eq[k, pos[num]] += 1
+            A_eq[k, pos[den]] -= 1
+        b_eq = np.array([r[3] for r in ratios])
+        eq_con_f = net['eq_con'].loc[[r[0] for r in ratios]]
+    else:
+        A_eq = None
+        b_eq = None
+        eq_con_f = None
+
+    S = pd.DataFrame(S, index=cpds, columns=list(S_pat.columns) + net['rxns'])
+    return S, c, A, b, A_eq, b_eq, eq_con_f
+
+
+def mdf_upper_bounds(pathways, net, eq_to_drG, proton_name="C00080"):
+    """Calculate upper bounds for the MDF of pathways (kJ/mol)
+
+    The MDF of a pathway can not exceed the driving force of any of its
+    reactions at the most favourable concentrations within the bounds of the
+    network block (see network_mdf_block), -drG - RT*ln(Q_min). The smallest
+    such driving force is computed for all pathways with one sparse product.
+    Ratio constraints and the background network only lower the MDF. The
+    bound is infinite if it can not be computed.
+    """
+    # Index the unique equations of the reactions driven by B (see mdf_A)
+    net_rxns = set(net['rxns'])
+    eq_index = {}
+    pw_eqs = []
+    for pathway in pathways:
+        pw_eqs.append([
+            eq_index.setdefault(line.split("\t")[1], len(eq_index))
+            for line in filter(None, pathway.split("\n"))
+            if line.split("\t")[0] not in net_rxns
+        ])
+    equations = list(eq_index)
+
+    # Most favourable log reaction quotient of each equation
+    cpds, S, occurrence = equation_matrix(equations, False)
+    ln_max, ln_min = log_bounds(cpds, net)
+    is_proton = np.array([cpd == proton_name for cpd in cpds], dtype=bool)
+    ln_max[is_proton] = 0
+    ln_min[is_proton] = 0
+    ln_Q_min = S.maximum(0).dot(-ln_min) + S.minimum(0).dot(ln_max)
+    drGs = np.array([eq_to_drG[eq] for eq in equations], dtype=float)
+    rxn_bounds = -drGs - net['R']*net['T']*ln_Q_min
+    rxn_bounds[np.isnan(rxn_bounds)] = np.inf
+
+    # Smallest reaction bound of each pathway
+    pw_bounds = np.full(len(pw_eqs), np.inf)
+    pw_eqs_flat = np.array([i for eqs in pw_eqs for i in eqs], dtype=int)
+    has_eqs = np.array([len(eqs) > 0 for eqs in pw_eqs], dtype=bool)
+    if has_eqs.any():
+        starts = np.cumsum([0] + [len(eqs) for eqs in pw_eqs])[:-1]
+        pw_bounds[has_eqs] = np.minimum.reduceat(
+            rxn_bounds[pw_eqs_flat], starts[has_eqs]
+        )
+    return pw_bounds
+
+
+# Shared problem data of a pathways_to_mdf worker (see init_mdf_worker)
+mdf_worker = {}
+
+
+def init_mdf_worker(net, eq_to_drG, sensitivity=False, solver='scipy'):
+    """Store the data shared by all pathways once per worker process"""
+    mdf_worker.update({
+        'net':net, 'eq_to_drG':eq_to_drG, 'sensitivity':sensitivity,
+        'solver':solver
+    })
+
+
+def pathway_mdf_chunk(pw_chunk):
+    """Solve the NEM problems of a list of (index, pathway) tuples
+
+    Returns one (index, MDF, sensitivity table) tuple per pathway. The MDF is
+    None if the optimization failed, and the sensitivity table is None
+    unless requested and the optimization succeeded.
+    """
+    net = mdf_worker['net']
+    T, R = net['T'], net['R']
+    mdf_results = []
+    for pw_int, pathway in pw_chunk:
+
+        # Add the pathway to the network block
+        S, c, A, b, A_eq, b_eq, eq_con_f = pathway_mdf_problem(
+            pathway, net, mdf_worker['eq_to_drG']
+        )
+
+        # Run MDF optimization
+        mdf_result = mdf.mdf(c, A, b, A_eq, b_eq, solver=mdf_worker['solver'])
+
+        # Calculate shadow prices and allowable ranges
+        sens_table = None
+        if mdf_worker['sensitivity'] and mdf_result.success:
+            sens_table = mdf.sensitivity_table(S, mdf.mdf_sensitivity(
+                c, A, b, mdf_result.x, A_eq, b_eq
+            ), eq_con_f, T, R)
+
+        # Add a result to the list
+        if mdf_result.success:
+            mdf_results.append((pw_int, mdf_result.x[-1] * T * R, sens_table))
+        else:
+            mdf_results.append((pw_int, None, sens_table))
+    return mdf_results
+
 
 def pathways_to_mdf(pathways, dfGs, ne_con, eq_con, n_procs=4,
-    T=298.15, R=8.31e-3, network_text="", x_max=0.1, x_min=0.0000001, pH=7.0):
-    """Create a dictionary with pathways and their MDF values"""
+    T=298.15, R=8.31e-3, network_text="", x_max=0.1, x_min=0.0000001, pH=7.0,
+    sensitivity=False, solver='scipy', drG_cache=None, mdf_cache=None,
+    top_n=None):
+    """Create a dictionary with pathways and their MDF values
+
+    If sensitivity is True, a second dictionary with the shadow prices and
+    allowable ranges of each pathway (see mdf.sensitivity_table) is returned.
+    The LP solver backend is selected with solver (see mdf.solve_lp), and
+    eQuilibrator drGs are looked up in and added to drG_cache (see DrGCache).
+    MDF values of earlier runs are looked up in and added to mdf_cache (see
+    MDFCache); only the MDF values are cached, so all pathways are optimized
+    when sensitivity is True.
+
+    If top_n is specified, pathways are optimized in descending order of
+    their MDF upper bounds (see mdf_upper_bounds) until the bound drops below
+    the top_n-th highest MDF found. The top_n pathways are then exact, and
+    only the optimized pathways are returned.
+    """
+
+    # Only optimize the pathways that are not in the MDF cache
+    if mdf_cache is not None:
+        fingerprint = mdf_fingerprint(
+            ne_con, eq_con, network_text, x_max, x_min, T, R, pH, dfGs
+        )
+        network_rxns = set(
+            line.split("\t")[0]
+            for line in filter(None, network_text.split("\n"))
+        )
+        pw_hashes = {pw:mdf_cache_key(pw, network_rxns) for pw in pathways}
+        cached = {}
+        if not sensitivity:
+            cached = mdf_cache.get(set(pw_hashes.values()), fingerprint)
+        missing = [pw for pw in pathways if pw_hashes[pw] not in cached]
+        mdf_dict = {}
+        sens_dict = {}
+        if missing:
+            mdf_dict = pathways_to_mdf(
+                missing, dfGs, ne_con, eq_con, n_procs, T, R, network_text,
+                x_max, x_min, pH, sensitivity, solver, drG_cache, None, top_n
+            )
+            if sensitivity:
+                mdf_dict, sens_dict = mdf_dict
+            mdf_cache.put(
+                {pw_hashes[pw]:v for pw, v in mdf_dict.items()}, fingerprint
+            )
+        for pw in pathways:
+            if pw_hashes[pw] in cached:
+                mdf_dict[pw] = cached[pw_hashes[pw]]
+        if sensitivity:
+            return mdf_dict, sens_dict
+        return mdf_dict
 
     # Calculate reaction delta G's for all reactions (pathway and network)
     equations = []
-    for pathway in pathways:
-        equations = equations + \
-        [x.split("\t")[1] for x in filter(None, pathway.split("\n"))]
-    equations = equations + \
-    [x.split("\t")[1] for x in filter(None, network_text.split("\n"))]
+    for pathway in list(pathways) + [network_text]:
+        equations.extend(
+            [x.split("\t")[1] for x in filter(None, pathway.split("\n"))]
+        )
 
-    eq_to_drG = create_drG_dict(equations, dfGs, pH)
+    eq_to_drG = create_drG_dict(equations, dfGs, pH, drG_cache, n_procs)
 
-    # Create a stoichiometric matrix of the background network
-    S_net = mdf.read_reactions(network_text)
+    # Build the background network part of the problem once
+    net = network_mdf_block(
+        network_text, eq_to_drG, ne_con, eq_con, x_max, x_min, T, R
+    )
 
-    # Define the worker
-    def worker(eq_to_drG, S_net):
-        while True:
-            pw_int_chunk = work.get()
-            if pw_int_chunk is None:
-                break
-            mdf_results = []
-            for pathway, pw_int in [(pathways[n], n) for n in pw_int_chunk]:
-
-                # Construct standard reaction Gibbs energy dataframe
-                if network_text:
-                    pathway_and_network = pathway.strip() + "\n" + network_text.strip()
-                else:
-                    pathway_and_network = pathway
-                drGs_d = drGs_for_pathway(pathway_and_network, eq_to_drG)
-                drGs_t = "\n".join(['{}\t{}'.format(k,v) for k,v in drGs_d.items()])
-                drGs = mdf.read_reaction_drGs(drGs_t)
-
-                # Construct stoichiometric matrix
-                S_pat = mdf.read_reactions(pathway)
-                S = pd.concat([S_pat, S_net], axis={0,1}).fillna(0)
-
-                # Construct c vector
-                c = mdf.mdf_c(S)
-
-                # Construct A matrix
-                A = mdf.mdf_A(S, list(S_net.columns))
-
-                # Construct b vector
-                b = mdf.mdf_b(S, drGs, ne_con, x_max, x_min)
-
-                # Filter the ratio constraints to those relevant to S
-                eq_con_f = eq_con[eq_con['cpd_id_num'].isin(S.index)]
-                eq_con_f = eq_con_f[eq_con_f['cpd_id_den'].isin(S.index)]
-
-                # Construct A_eq matrix and b_eq vector if equality constraints exist
-                if not eq_con_f.empty:
-                    A_eq = mdf.mdf_A_eq(S, eq_con_f)
-                    b_eq = mdf.mdf_b_eq(eq_con_f)
-                else:
-                    A_eq = None
-                    b_eq = None
-
-                # Run MDF optimization
-                mdf_result = mdf.mdf(c, A, b, A_eq, b_eq)
-
-                # Add a result to the list
-                if mdf_result.success:
-                    mdf_results.append((pw_int, mdf_result.x[-1] * T * R))
-                else:
-                    mdf_results.append((pw_int, None))
+    # Start the worker processes
+    initargs = (net, eq_to_drG, sensitivity, solver)
+    if n_procs > 1 and len(pathways) > 1:
+        pool = mp.Pool(min(n_procs, len(pathways)), init_mdf_worker, initargs)
+    else:
+        pool = None
+        init_mdf_worker(*initargs)
+
+    output = []
+    p = Progress(design='cp', max_val=len(pathways))
+    s_out("\rPerforming pathway MDF analysis... %s" % p.to_string(0))
+
+    def solve(pw_items):
+        # Divide into chunks; several per process for load balancing
+        chunk_size = max(1, min(200, -(-len(pw_items) // (8*n_procs))))
+        pw_chunks = [
+            pw_items[i:i + chunk_size]
+            for i in range(0, len(pw_items), chunk_size)
+        ]
+        # Solve the chunks, reporting progress as they are returned; the
+        # network is only set up in the workers if there is a pool
+        if pool is not None:
+            results = pool.imap_unordered(pathway_mdf_chunk, pw_chunks)
+        else:
+            results = map(pathway_mdf_chunk, pw_chunks)
+        for mdf_results in results:
             output.extend(mdf_results)
-            with lock:
-                n_work_done.value += 1
-
-    # Set up reporter thread
-    def reporter():
-        n_work = len(pathways)
-        n_left = len(pathways)
-        p = Progress(design='cp', max_val=n_work)
-        while n_left > 0:
-            # Check progress
-            n_done = len(output)
-            n_left = n_work - n_done
-            s_out("\rPerforming pathway MDF analysis... %s" % p.to_string(n_done))
-            time.sleep(1)
-
-    with mp.Manager() as manager:
-        # Initialize Work queue in manager
-        work = manager.Queue()
-
-        for pw_int_chunk in chunks(list(range(len(pathways))), 200):
-            work.put(pw_int_chunk)
-
-        # Place stop signals on queue
-        for i in range(n_procs):
-            work.put(None)
-
-        n_work = work.qsize()
-
-        # Initialize output list in manager
-        output = manager.list()
-
-        # Initialize number of tasks done counter
-        n_work_done = mp.Value('i', 0)
-        lock = mp.Lock()
-
-        # Start reporter
-        reporter = threading.Thread(target=reporter)
-        reporter.start()
-
-        # Start processes
-        procs = []
-        for i in range(n_procs):
-            p = mp.Process(target=worker, args=(eq_to_drG, S_net))
-            procs.append(p)
-            p.start()
-
-        # Wait until all work is done
-        while n_work_done.value != n_work - n_procs:
-            time.sleep(1)
-
-        # Terminate the processes
-        for p in procs:
-            if p.is_alive():
-                p.terminate()
-
-        # Stop reporter
-        reporter.join()
-        print("")
-
-        # Construct MDF dictionary
-        mdf_dict = {}
-        for mdf_result in list(output):
-            mdf_dict[pathways[mdf_result[0]]] = mdf_result[1]
-        return mdf_dict
+            s_out(
+                "\rPerforming pathway MDF analysis... %s" % \
+                p.to_string(len(output))
+            )
+
+    try:
+        if top_n is None:
+            solve(list(enumerate(pathways)))
+        else:
+            # Solve in descending upper bound order until no pathway can
+            # enter the top
+            bounds = mdf_upper_bounds(pathways, net, eq_to_drG)
+            order = np.argsort(-bounds, kind='mergesort')
+            neg_bounds = -bounds[order]
+            batch_size = max(top_n, 4*n_procs)
+            top = []
+            k = 0
+            while k < len(order):
+                n_batch = batch_size
+                if len(top) == top_n:
+                    # Pathways with a bound below the top can be skipped
+                    n_batch = min(n_batch, np.searchsorted(
+                        neg_bounds[k:], -top[0], side='right'
+                    ))
+                    if n_batch == 0:
+                        break
+                n_done = len(output)
+                solve([(int(i), pathways[i]) for i in order[k:k + n_batch]])
+                k += n_batch
+                top = sorted(top + [
+                    r[1] for r in output[n_done:] if r[1] is not None
+                ])[-top_n:]
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+    print("")
+
+    # Construct MDF dictionary
+    mdf_dict = {}
+    sens_dict = {}
+    for mdf_result in output:
+        mdf_dict[pathways[mdf_result[0]]] = mdf_result[1]
+        sens_dict[pathways[mdf_result[0]]] = mdf_result[2]
+    if sensitivity:
+        return mdf_dict, sens_dict
+    return mdf_dict
 
 
 def format_output(mdf_dict):
@@ -314,9 +818,24 @@ def format_output(mdf_dict):
     return "\n".join(output) + "\n"
 
 
+def format_sensitivity(sens_dict):
+    """Combine pathway sensitivity tables into one tab-delimited text"""
+    tables = []
+    for pathway, sens_table in sens_dict.items():
+        if sens_table is None:
+            continue
+        sens_table = sens_table.copy()
+        sens_table.insert(0, 'pathway', generate_pathway_hash(pathway))
+        tables.append(sens_table)
+    if not tables:
+        return ""
+    return pd.concat(tables).to_csv(sep='\t', index=False, na_rep='NA')
+
+
 # Main code block
 def main(pathway_file, outfile, dfG_json, pH, ne_con_file, eq_con_file,
-         n_procs=1, T=298.15, R=8.31e-3):
+         n_procs=1, T=298.15, R=8.31e-3, sens_file=None, solver='scipy',
+         drG_cache_file=None, mdf_cache_file=None, top_n=None):
 
     print("")
 
@@ -344,9 +863,19 @@ def main(pathway_file, outfile, dfG_json, pH, ne_con_file, eq_con_file,
 
     # Perform MDF
     mdf_dict = pathways_to_mdf(
-        pathways, dfG_dict, ne_con, eq_con, n_procs, T, R, pH=pH
+        pathways, dfG_dict, ne_con, eq_con, n_procs, T, R, pH=pH,
+        sensitivity=bool(sens_file), solver=solver,
+        drG_cache=DrGCache(drG_cache_file) if drG_cache_file else None,
+        mdf_cache=MDFCache(mdf_cache_file) if mdf_cache_file else None,
+        top_n=top_n
     )
 
+    # Write shadow prices and allowable ranges
+    if sens_file:
+        mdf_dict, sens_dict = mdf_dict
+        with open(sens_file, 'w') as output_file:
+            output_file.write(format_sensitivity(sens_dict))
+
     # Format output
     output = format_output(mdf_dict)
 
@@ -399,6 +928,27 @@ if __name__ == "__main__":
         '--write_gibbs', action='store_true',
         help='Calculate and write drGs to outfile (first pathway only).'
     )
+    parser.add_argument(
+        '-s', '--sensitivity', type=str, default=None,
+        help='Write shadow prices and allowable ranges to this file.'
+    )
+    parser.add_argument(
+        '--solver', choices=mdf.LP_SOLVERS, default='scipy',
+        help='LP solver backend (see "mdf.py benchmark").'
+    )
+    parser.add_argument(
+        '--drG_cache', type=str, default=None,
+        help='Read and update eQuilibrator drGs in this SQLite cache file.'
+    )
+    parser.add_argument(
+        '--mdf_cache', type=str, default=None,
+        help='Read and update pathway MDF values in this SQLite cache file.'
+    )
+    parser.add_argument(
+        '--top', type=int, default=None, metavar='N',
+        help='Only optimize pathways until the N best are known; ' + \
+             'other pathways are left out of the output.'
+    )
     args = parser.parse_args()
 
     # Option to calculate and write a drG text file for the first pathway
@@ -413,7 +963,10 @@ if __name__ == "__main__":
         # Calculate reaction delta G's for all reactions
         equations = [x.split("\t")[1] for x in filter(None, pathways[0].split("\n"))]
 
-        eq_to_drG = create_drG_dict(equations, dfGs, args.pH)
+        eq_to_drG = create_drG_dict(
+            equations, dfGs, args.pH,
+            DrGCache(args.drG_cache) if args.drG_cache else None, args.processes
+        )
 
         # Calculate reaction delta Gs
         drGs_d = drGs_for_pathway(pathways[0], eq_to_drG)
@@ -429,4 +982,5 @@ if __name__ == "__main__":
 
     main(args.pathways, args.outfile, args.gibbs,
          args.pH, args.constraints, args.ratios,
-         args.processes, args.T, args.R)
+         args.processes, args.T, args.R, args.sensitivity, args.solver,
+         args.drG_cache, args.mdf_cache, args.top)
@@ -5,13 +5,13 @@
 # Import modules
 import re
 import sys
-import time
-import queue
-import threading
-from time import sleep
+import asyncio
 from requests import get as rget
 from rdkit import Chem
 
+# Import scripts
+from fetch_engine import run_fetch, run_shared_fetch, host_controller
+
 # Define functions
 def sWrite(string):
     sys.stdout.write(string)
@@ -28,78 +28,50 @@ def kegg_get(kegg_id, server="http://rest.kegg.jp"):
     Downloads the raw REST text entry for the provided KEGG ID,
     via the KEGG rest API @ http://rest.kegg.jp/
     """
-    # Construct query
-    rest_address = "/".join([server,"get",kegg_id])
-    # Set up con_attempts counter
-    con_attempts = 0
-    # Try connecting
-    while con_attempts < 5:
-        con_attempts += 1
-        r = rget(rest_address)
-        if r.status_code == 200:
-            return r.text
-        else:
-            # Server not returning a result, try again
-            time.sleep(2)
-    # The connection attempt limit was reached
+    return run_shared_fetch(fetch_kegg, kegg_id, server)
+
+
+async def fetch_kegg(fetcher, kegg_id, server="http://rest.kegg.jp"):
+    """Asynchronous kegg_get using an AsyncFetcher."""
+    r = await fetcher.get("/".join([server,"get",kegg_id]))
+    if r is not None and r.status_code == 200:
+        return r.text
+    # The entry does not exist or the server did not respond
     sError("Warning: Unable to download KEGG data for '%s'.\n" % str(kegg_id))
     return None
 
 
 def threaded_kegg_get(queries):
-    """Threaded implementation of kegg_get."""
+    """Concurrent implementation of kegg_get."""
+
+    async def fetch_all(fetcher):
+        results = {}
+        async def fetch(query):
+            results[query] = await fetch_kegg(fetcher, query)
+
+        task = asyncio.ensure_future(
+            asyncio.gather(*[fetch(query) for query in queries])
+        )
 
-    def worker():
+        # Report on progress
         while True:
-            query = work.get()
-            if query is None:
+            if len(queries) == 0:
+                progress = 100.0
+            else:
+                progress = float(len(results) / len(queries) * 100)
+            sys.stdout.write("\rQuerying KEGG... %0.1f%% %s" % (
+                progress, host_controller("http://rest.kegg.jp").status()
+            ))
+            sys.stdout.flush()
+            if task.done():
+                print("")
                 break
-            result = kegg_get(query)
-            output.put((query, result))
-            work.task_done()
-
-    # Initialise queues
-    work = queue.Queue()
-    output = queue.Queue()
-
-    for query in queries:
-        work.put(query)
-
-    # Start threads
-    threads = []
-    for i in range(16):
-        t = threading.Thread(target=worker)
-        t.start()
-        threads.append(t)
-
-    # Report on progress
-    while True:
-        if len(queries) == 0:
-            progress = 100.0
-        else:
-            progress = float(output.qsize() / len(queries) * 100)
-        sys.stdout.write("\rQuerying KEGG... %0.1f%%" % progress)
-        sys.stdout.flush()
-        if output.qsize() == len(queries):
-            print("")
-            break
-        sleep(0.5)
+            await asyncio.wait([task], timeout=0.5)
 
-    # Join work queue
-    work.join()
+        task.result()
+        return results
 
-    # Stop workers
-    for i in range(len(threads)):
-        work.put(None)
-    for t in threads:
-        t.join()
-
-    # Get results
-    results = {}
-    while not output.empty():
-        result = output.get()
-        results[result[0]] = result[1]
-    return results
+    return run_fetch(fetch_all, max_connections=16)
 
 
 def create_kegg_dict(kegg_text):
@@ -136,23 +108,16 @@ def kegg_smiles(kegg_id, server="http://rest.kegg.jp"):
         return None
     # Set up the query
     rest_address = "/".join([server,"get","cpd:"+kegg_id,"mol"])
-    # Set up con_attempts counter
-    con_attempts = 0
-    # Try connecting
-    while con_attempts < 5:
-        con_attempts += 1
-        r = rget(rest_address)
-        if r.status_code == 200:
-            try:
-                mol = Chem.MolFromMolBlock(r.text)
-                smiles = Chem.MolToSmiles(mol)
-                return smiles
-            except:
-                sError("\nWarning: SMILES could not be produced for KEGG ID '%s'.\n" % str(kegg_id))
-                return None
-        else:
-            time.sleep(2)
-    # The connection attempt limit was reached
+    r = run_shared_fetch(lambda fetcher: fetcher.get(rest_address))
+    if r is not None and r.status_code == 200:
+        try:
+            mol = Chem.MolFromMolBlock(r.text)
+            smiles = Chem.MolToSmiles(mol)
+            return smiles
+        except:
+            sError("\nWarning: SMILES could not be produced for KEGG ID '%s'.\n" % str(kegg_id))
+            return None
+    # The entry does not exist or the server did not respond
     sError("\nWarning: Unable to download molecule data for '%s'.\n" % str(kegg_id))
     return None
 
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Add repository root to the path
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Import testing utilities
+import time
+import asyncio
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Import the script to be tested
+from fetch_engine import *
+
+# Local keep-alive server that fails the first request to '/flaky' paths
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@pytest.fixture
+def local_server():
+    log = {'paths':[], 'clients':set(), 'active':0, 'max_active':0}
+    lock = threading.Lock()
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_GET(self):
+            with lock:
+                flaky = self.path.startswith("/flaky") and \
+                self.path not in log['paths']
+                log['paths'].append(self.path)
+                log['clients'].add(self.client_address)
+                log['active'] += 1
+                log['max_active'] = max(log['max_active'], log['active'])
+            time.sleep(0.05)
+            with lock:
+                log['active'] -= 1
+            body = self.path.encode()
+            self.send_response(503 if flaky else 200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_port, log
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+# Define tests
+def test_async_fetcher(local_server):
+    url, log = local_server
+
+    async def fetch(fetcher):
+        urls = [url + "/%d" % i for i in range(40)] + [url + "/flaky"]
+        return await asyncio.gather(*[fetcher.get(u) for u in urls])
+
+    responses = run_fetch(fetch, max_connections=8, per_host=4)
+    assert [r.text for r in responses[:40]] == ["/%d" % i for i in range(40)]
+
+    # The failed request is retried
+    assert responses[40].status_code == 200
+    assert log['paths'].count("/flaky") == 2
+
+    # In-flight requests are limited per host, over reused connections
+    assert log['max_active'] <= 4
+    assert len(log['clients']) <= 8
+
+
+def test_async_fetcher_external_release(local_server):
+    url, log = local_server
+    controller = host_controller(url)
+
+    # Other fetchers or MINE client threads hold all slots for a while
+    held = 0
+    while controller.try_acquire():
+        held += 1
+    def release():
+        time.sleep(0.2)
+        for i in range(held):
+            controller.release()
+    threading.Thread(target=release).start()
+
+    # Their releases wake the waiting request
+    async def fetch(fetcher):
+        return await fetcher.get(url + "/waiting")
+    responses = []
+    thread = threading.Thread(
+        target=lambda: responses.append(run_fetch(fetch)), daemon=True
+    )
+    thread.start()
+    thread.join(10)
+    assert [r.text for r in responses] == ["/waiting"]
+    assert controller.listeners == []
+
+
+def test_async_fetcher_aimd(local_server):
+    url, log = local_server
+    controller = host_controller(url, initial=2, maximum=12,
+        latency_factor=10.0)
+
+    async def fetch(fetcher):
+        urls = [url + "/%d" % i for i in range(120)]
+        return await asyncio.gather(*[fetcher.get(u) for u in urls])
+
+    # Concurrency rises above the initial limit while requests succeed
+    responses = run_fetch(fetch, max_connections=16)
+    assert all(r.status_code == 200 for r in responses)
+    assert controller.limit > 2
+    assert log['max_active'] > 2
+
+    # An error cuts the limit, and with it the number of free slots
+    limit = controller.limit
+    controller.last_decrease = 0
+    controller.acquire()
+    controller.release(0.05, False)
+    assert controller.limit == max(1, limit / 2)
+    held = 0
+    while controller.try_acquire():
+        held += 1
+    assert held == int(controller.limit)
+    for i in range(held):
+        controller.release()
+
+
+def test_run_shared_fetch(local_server):
+    url, log = local_server
+    async def fetch(fetcher, path):
+        r = await fetcher.get(url + path)
+        return (fetcher, r.text)
+
+    # Synchronous calls, also from other threads, reuse one fetcher and its
+    # connection
+    results = [run_shared_fetch(fetch, "/%d" % i) for i in range(3)]
+    thread = threading.Thread(
+        target=lambda: results.append(run_shared_fetch(fetch, "/3"))
+    )
+    thread.start()
+    thread.join()
+    assert [text for fetcher, text in results] == ["/%d" % i for i in range(4)]
+    assert len(set(fetcher for fetcher, text in results)) == 1
+    assert len(log['clients']) == 1
+
+
+def test_async_fetcher_parse():
+    async def parse(fetcher):
+        return await asyncio.gather(*[
+            fetcher.parse(pow, i, 2) for i in range(5)
+        ])
+    assert run_fetch(parse) == [0, 1, 4, 9, 16]
+
+
+def test_async_fetcher_unreachable():
+    async def fetch(fetcher):
+        return await fetcher.get("http://127.0.0.1:9/unreachable")
+    assert run_fetch(fetch, retries=2) is None
+
+
+def test_concurrency_controller():
+    controller = ConcurrencyController(initial=4, maximum=6, backoff=0.5)
+
+    # Slots are limited to the current limit
+    assert all(controller.try_acquire() for i in range(4))
+    assert not controller.try_acquire()
+
+    # Fast successes raise the limit additively while all slots are in use
+    controller.release(0.1, True)
+    assert controller.limit == 4.25
+    for i in range(3):
+        controller.release(0.1, True)
+    assert controller.limit == 4.25
+
+    # Requests below the limit leave it unchanged
+    for i in range(20):
+        controller.acquire()
+        controller.release(0.1, True)
+    assert controller.limit == 4.25
+
+    # Rounds that fill all slots raise it up to the maximum
+    for i in range(10):
+        n = int(controller.limit)
+        for j in range(n):
+            controller.acquire()
+        for j in range(n):
+            controller.release(0.1, True)
+    assert controller.limit == 6
+
+    # An error halves the limit, once per round trip
+    controller.acquire()
+    controller.release(0.1, False)
+    assert controller.limit == 3
+    controller.acquire()
+    controller.release(0.1, False)
+    assert controller.limit == 3
+
+    # Slow requests count as congestion
+    controller.last_decrease = 0
+    controller.acquire()
+    controller.release(1.0, True)
+    assert controller.limit == 1.5
+
+    # Requests that did not reach the server leave the limit unchanged
+    controller.acquire()
+    controller.release()
+    assert controller.limit == 1.5
+
+    metrics = controller.metrics()
+    assert metrics['requests'] == 74
+    assert metrics['errors'] == 2
+    assert metrics['in_flight'] == 0
+    assert metrics['limit'] == 1
+    assert abs(metrics['error_rate'] - 2 / 74) < 1e-9
+    assert "conn" in controller.status()
+
+    # Backoff delays are jittered and capped
+    delays = [controller.backoff_delay(3) for i in range(100)]
+    assert max(delays) <= 4 and min(delays) >= 0
+    assert len(set(delays)) > 1
+    assert controller.backoff_delay(100) <= controller.max_backoff
+
+
+def test_host_controller():
+    controller = host_controller("http://example.org/a")
+    assert host_controller("http://example.org/b") is controller
+    assert host_controller("http://example.com/a") is not controller
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Add repository root to the path
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Import testing utilities
+import time
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Import the script to be tested
+from http_cache import *
+
+# Local server answering with a request counter
+@pytest.fixture
+def counting_server():
+    requests = []
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self, body=b""):
+            requests.append((self.command, self.path, body))
+            status = 404 if self.path == "/missing" else 200
+            if self.path == "/error":
+                status = 500
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain")
+            self.end_headers()
+            self.wfile.write(("%s %d" % (self.path, len(requests))).encode())
+        def do_GET(self):
+            self.respond()
+        def do_POST(self):
+            self.respond(self.rfile.read(int(self.headers['Content-Length'])))
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_port, requests
+    server.shutdown()
+    thread.join()
+    configure_cache()
+
+# Define tests
+def test_cached_get(counting_server, tmpdir):
+    url, requests = counting_server
+    cache_dir = str(tmpdir.join("cache"))
+
+    # Without a cache directory, every request reaches the server
+    assert cached_get(url + "/a").text == "/a 1"
+    assert cached_get(url + "/a").text == "/a 2"
+
+    # Responses are stored compressed under their content address
+    configure_cache(cache_dir)
+    r = cached_get(url + "/a")
+    assert r.text == "/a 3"
+    assert not r.from_cache
+    key = request_key("GET", url + "/a")
+    assert os.path.exists(cache_path(key))
+    r = cached_get(url + "/a")
+    assert r.text == "/a 3"
+    assert r.from_cache
+    assert r.status_code == 200
+    assert r.headers['Content-Type'] == "text/plain"
+    assert len(requests) == 3
+
+    # Missing entries are cached, server errors are not
+    assert cached_get(url + "/missing").status_code == 404
+    assert cached_get(url + "/missing").status_code == 404
+    assert cached_get(url + "/error").status_code == 500
+    assert cached_get(url + "/error").status_code == 500
+    assert len(requests) == 6
+
+    # Expired responses are downloaded again
+    old = time.time() - 2 * 86400
+    os.utime(cache_path(key), (old, old))
+    configure_cache(cache_dir, max_age=1)
+    assert cached_get(url + "/a").text == "/a 7"
+    assert cached_get(url + "/a").text == "/a 7"
+
+    # Corrupt files count as misses
+    with open(cache_path(key), 'wb') as f:
+        f.write(b"garbage")
+    assert cached_get(url + "/a").text == "/a 8"
+
+
+def test_cached_post(counting_server, tmpdir):
+    url, requests = counting_server
+    configure_cache(str(tmpdir))
+
+    # The key data identifies the request, not the body
+    assert cached_post(url, "x", data="1").text == "/ 1"
+    assert cached_post(url, "x", data="2").text == "/ 1"
+    assert cached_post(url, "y", data="1").text == "/ 2"
+    assert cached_post(url, data="1").text == "/ 3"
+    assert cached_post(url, data="1").text == "/ 3"
+    assert requests[0] == ("POST", "/", b"1")
+    assert len(requests) == 3
+
+
+def test_offline(counting_server, tmpdir):
+    url, requests = counting_server
+    with pytest.raises(ValueError):
+        configure_cache(offline=True)
+
+    configure_cache(str(tmpdir))
+    cached_get(url + "/a")
+
+    # Offline mode ignores the maximum age and never contacts the server
+    configure_cache(str(tmpdir), max_age=0, offline=True)
+    r = cached_get(url + "/a")
+    assert r.text == "/a 1"
+    assert not offline_miss(r)
+    r = cached_get(url + "/b")
+    assert r.status_code == 504
+    assert offline_miss(r)
+    assert len(requests) == 1
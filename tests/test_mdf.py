@@ -2,6 +2,7 @@
 
 # Add repository root to the path
 import os, sys
+import pytest
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 
 # Import the script to be tested
@@ -338,6 +339,428 @@ def test_mdf():
     assert mdf_result.success # # Optimization terminated successfully
     assert mdf_result.status == 0 # Optimization terminated successfully
     assert abs(mdf_result.x[-1]*8.31e-3*298.15 - 0.4417) / 0.4417 < 0.05
+    # Presolve eliminates the fixed concentrations without changing the MDF
+    presolve_result = mdf(c, A, b, presolve=True)
+    assert presolve_result.success
+    assert abs(presolve_result.x[-1] - mdf_result.x[-1]) < 1e-6
+    np.testing.assert_array_almost_equal(
+        np.exp(presolve_result.x[[3,4,8,7,9,6]]),
+        [5e-4, 5e-3, 5e-3, 5e-4, 5e-3, 1]
+    )
+
+
+def test_mdf_presolve():
+    RT = 8.31e-3 * 298.15
+    S = read_reactions("\n".join([
+        "R1\tA + X <=> B + Y",
+        "R2\tB + W <=> C",
+        "R3\tW <=> Z",
+        "R4\tC <=> D"
+    ]))
+    drGs = read_reaction_drGs("R1\t-5\nR2\t2\nR3\t-5\nR4\t-10\n")
+    constraints = read_constraints("W\t0.001\t0.001\nZ\t0.002\t0.002\n")
+    ratios = read_ratio_constraints("X\tY\t10\n")
+    c = mdf_c(S)
+    A = mdf_A(S, ['R3'])
+    b = mdf_b(S, drGs, constraints)
+    A_eq = mdf_A_eq(S, ratios)
+    b_eq = mdf_b_eq(ratios)
+    P = mdf_presolve(A, b, A_eq, b_eq)
+    assert not P['infeasible']
+    # W and Z are fixed and X is expressed through Y; A, B, C, D, Y and B remain
+    assert P['M'].shape == (S.shape[0] + 1, 6)
+    # R3 has a constant driving force and is removed
+    assert P['A'].shape == (3, 6)
+    # Presolved and full optimization yield the same MDF and a feasible point
+    full = mdf(c, A, b, A_eq, b_eq)
+    reduced = mdf(c, A, b, A_eq, b_eq, presolve=True)
+    assert reduced.success
+    assert abs(full.x[-1] - reduced.x[-1]) * RT < 1e-6
+    assert np.all(np.asarray(A).dot(reduced.x) <= b + 1e-9)
+    np.testing.assert_array_almost_equal(
+        np.asarray(A_eq).dot(reduced.x), b_eq
+    )
+    # The constant network reaction R3 is infeasible when it is too uphill
+    drGs = read_reaction_drGs("R1\t-5\nR2\t2\nR3\t10\nR4\t-10\n")
+    b = mdf_b(S, drGs, constraints)
+    assert mdf_presolve(A, b, A_eq, b_eq)['infeasible']
+    assert not mdf(c, A, b, A_eq, b_eq, presolve=True).success
+    # Contradicting ratio and fixed concentrations are detected
+    ratios = read_ratio_constraints("W\tZ\t1\n")
+    A_eq = mdf_A_eq(S, ratios)
+    b_eq = mdf_b_eq(ratios)
+    assert mdf_presolve(A, b, A_eq, b_eq)['infeasible']
+
+
+def test_mdf_direction_search():
+    S = read_reactions("\n".join([
+        "R1\tA + X <=> B + Y",
+        "R2\tB + C <=> D + Z",
+        "R3\tD + X <=> E + C + Y",
+        "R4\tE <=> A"
+    ]))
+    drGs = read_reaction_drGs("R1\t-15\nR2\t20\nR3\t-10\nR4\t3\n")
+    constraints = read_constraints("C\t0.0001\t0.002\nX\t0.001\t0.001\n")
+    for net_rxns in [[], ['R4']]:
+        # Enumerate all directions
+        all_mdf = multi_mdf(S, drGs, constraints, net_rxns=net_rxns,
+                            all_directions=True)
+        all_mdf = all_mdf[all_mdf.success == 1]
+        dir_labels = ['dir_R1','dir_R2','dir_R3','dir_R4']
+        c = mdf_c(S)
+        A = mdf_A(S, net_rxns)
+        b = mdf_b(S, drGs, constraints)
+        # The best direction has the highest MDF of all directions
+        best = mdf_direction_search(c, A, b)
+        assert len(best) == 1
+        assert abs(best[0][1].x[-1]*8.31e-3*298.15 - all_mdf.MDF.max()) < 1e-4
+        # All directions with a positive MDF are found
+        feasible = mdf_direction_search(c, A, b, find_all=True)
+        exp_feasible = set(
+            tuple(x) for x in all_mdf[all_mdf.MDF > 1e-6][dir_labels].values
+        )
+        assert set(tuple(d) for d, r in feasible) == exp_feasible
+        # multi_mdf reports one row for the best direction
+        best_mdf = multi_mdf(S, drGs, constraints, net_rxns=net_rxns,
+                             direction_search='best')
+        assert best_mdf.shape[0] == 1
+        assert list(best_mdf[dir_labels].iloc[0,:]) == best[0][0]
+        assert abs(best_mdf.MDF.iloc[0] - all_mdf.MDF.max()) < 1e-4
+
+
+def test_mdf_direction_search_deep(monkeypatch):
+    # Every relaxation has the same solution, so the search fixes one
+    # reaction per level down to a leaf as deep as there are reactions
+    n_rxn = 3000
+    S = read_reactions("\n".join("R%d\tA <=> B" % i for i in range(n_rxn)))
+    drGs = read_reaction_drGs("".join("R%d\t0\n" % i for i in range(n_rxn)))
+    c = mdf_c(S)
+    A = mdf_A(S)
+    b = mdf_b(S, drGs, read_constraints(""))
+    def relaxation_mdf(c, A, b, A_eq=None, b_eq=None, presolve=False,
+                       solver='scipy'):
+        return optimize.OptimizeResult(x=np.array([0, 0, 1]), success=True)
+    monkeypatch.setattr(sys.modules['mdf'], 'mdf', relaxation_mdf)
+    best = mdf_direction_search(c, A, b)
+    assert len(best) == 1
+    assert best[0][0] == [1]*n_rxn
+
+
+def test_mdf_sensitivity():
+    S = read_reactions("\n".join([
+        "R1\tA + X <=> B + Y",
+        "R2\tB + C <=> D + Z",
+        "R3\tD + X <=> E + C + Y",
+        "R4\tE <=> A"
+    ]))
+    drGs = read_reaction_drGs("R1\t-15\nR2\t-5\nR3\t-10\nR4\t-3\n")
+    constraints = read_constraints("C\t0.0001\t0.002\nX\t0.001\t0.001\n")
+    ratio_constraints = read_ratio_constraints("Y\tZ\t2\n")
+    c = mdf_c(S)
+    A = mdf_A(S)
+    b = np.asarray(mdf_b(S, drGs, constraints)).flatten()
+    A_eq = mdf_A_eq(S, ratio_constraints)
+    b_eq = mdf_b_eq(ratio_constraints)
+    mdf_result = mdf(c, A, b, A_eq, b_eq)
+    sens = mdf_sensitivity(c, A, b, mdf_result.x, A_eq, b_eq)
+    # Within the allowable range the MDF changes by the shadow price
+    for i in range(len(b)):
+        lo, hi = sens['range_ub'][i]
+        for bound in [lo, hi]:
+            delta = 0.5*(np.clip(bound, b[i] - 2, b[i] + 2) - b[i])
+            b_mod = b.copy()
+            b_mod[i] += delta
+            mdf_mod = mdf(c, A, b_mod, A_eq, b_eq)
+            assert abs(
+                mdf_mod.x[-1] - mdf_result.x[-1] - sens['shadow_ub'][i]*delta
+            ) < 1e-5
+    delta = 0.1
+    mdf_mod = mdf(c, A, b, A_eq, b_eq + delta)
+    assert abs(
+        mdf_mod.x[-1] - mdf_result.x[-1] - sens['shadow_eq'][0]*delta
+    ) < 1e-5
+    # Shadow prices are reported per reaction, compound and ratio
+    sens_df = sensitivity_table(S, sens, ratio_constraints)
+    assert list(sens_df.constraint) == ['drG']*4 + ['xmax']*8 + ['xmin']*8 + \
+                                       ['ratio']
+    assert list(sens_df.id)[-1] == 'Y_Z'
+    # multi_mdf adds the same values as columns
+    mdf_table = multi_mdf(S, drGs, constraints, ratio_constraints,
+                          sensitivity=True)
+    for row in sens_df.itertuples():
+        label = row.constraint + '_' + row.id
+        if row.constraint == 'ratio':
+            label = 'ratio_' + row.id
+        assert abs(
+            mdf_table['sp_' + label].iloc[0] - row.shadow_price
+        ) < 1e-5
+    # A table that does not match the columns is an error
+    labels = list(mdf_table.columns)
+    with pytest.raises(ValueError):
+        mdf_output_row(
+            S, drGs, None, ratio_constraints, [1]*4, mdf_result, labels,
+            sensitivity=True, sens_table=sens_df.iloc[:-1]
+        )
+
+
+def test_adaptive_sweep():
+    # Step function on a 2D grid; only the step is resolved
+    evaluate = lambda point: int(point[0] + point[1] > 12)
+    differ = lambda r_1, r_2: r_1 != r_2
+    results = adaptive_sweep(evaluate, differ, [17, 9])
+    assert len(results) < 17*9
+    for (i, j), value in results.items():
+        assert value == evaluate((i, j))
+    # Every pair of grid neighbours across the step has been evaluated
+    for i in range(17):
+        assert (i, 12 - i) in results or not 0 <= 12 - i < 9
+    # A single point is evaluated as is
+    assert adaptive_sweep(evaluate, differ, [1, 1]) == {(0, 0): 0}
+
+
+def test_multi_mdf_adaptive():
+    S = read_reactions("R1\tA + B <=> C\nR2\tC <=> D\nR3\tD <=> E\n")
+    drGs = read_reaction_drGs("R1\t-5\nR2\t-10\nR3\t-3\n")
+    constraints = read_constraints("A\t0.00001\t0.01\t9\tlog\n")
+    ratio_constraints = read_ratio_constraints("C\tE\t0.01\t100\t9\tlog\n")
+    full = multi_mdf(S, drGs, constraints, ratio_constraints)
+    adaptive = multi_mdf(S, drGs, constraints, ratio_constraints,
+                         adaptive_tol=0.01)
+    assert adaptive.shape[0] < full.shape[0]
+    assert list(adaptive.columns) == list(full.columns)
+    # The evaluated grid points are identical to those of the full sweep
+    merged = pd.merge(adaptive, full, on=['ratio_C_E', 'c_A'])
+    assert merged.shape[0] == adaptive.shape[0]
+    assert (merged.MDF_x - merged.MDF_y).abs().max() < 1e-6
+    assert abs(adaptive.MDF.max() - full.MDF.max()) < 1e-6
+
+
+def test_merge_shards(tmpdir, monkeypatch):
+    S = read_reactions("R1\tA + B <=> C\nR2\tC <=> D\n")
+    drGs = read_reaction_drGs("R1\tX\t5\nR2\tX\t-2\nR1\tY\t-1\nR2\tY\t-2\n")
+    constraints = read_constraints("A\t0.001\t0.003\t3\nC\t0.001\t0.01\t2\tlog")
+    write_csv = lambda table, path: table.to_csv(
+        path, na_rep='NA', index=False, float_format='%.10f'
+    )
+    full = multi_mdf(S, drGs, constraints, all_directions=True)
+    write_csv(full, str(tmpdir.join('full.csv')))
+    # Shards only build the frames of their own sweep points
+    points = []
+    def counted_sweep_frames(ratio_constraints, constraints, point):
+        points.append(point)
+        return sweep_frames(ratio_constraints, constraints, point)
+    monkeypatch.setattr(
+        sys.modules['mdf'], 'sweep_frames', counted_sweep_frames
+    )
+    shard_files = []
+    for i in range(3):
+        del points[:]
+        shard = multi_mdf(S, drGs, constraints, all_directions=True,
+                          shard=(i, 3))
+        assert list(shard.columns) == ['point'] + list(full.columns)
+        assert len(points) == shard.shape[0] == 16
+        shard_files.append(str(tmpdir.join('shard_%d.csv' % i)))
+        write_csv(shard, shard_files[-1])
+    merge_shards(shard_files[::-1], str(tmpdir.join('merged.csv')))
+    assert tmpdir.join('merged.csv').read() == tmpdir.join('full.csv').read()
+    assert parse_shard("1/3") == (1, 3)
+    with pytest.raises(ValueError):
+        parse_shard("3/3")
+
+
+def test_columnar_output(tmpdir):
+    S = read_reactions("R1\tA + B <=> C\nR2\tC <=> D\n")
+    drGs = read_reaction_drGs("R1\tX\t5\nR2\tX\t-2\nR1\tY\t-1\nR2\tY\t-2\n")
+    constraints = read_constraints("A\t0.001\t0.001\nB\t0.001\t0.003\t3")
+    ratio_constraints = read_ratio_constraints("A\tB\t0.3\t1\t3\n")
+    full = multi_mdf(S, drGs, constraints, ratio_constraints,
+                     all_directions=True, presolve=True)
+    assert 0 < full.success.sum() < full.shape[0]
+    full.to_csv(str(tmpdir.join('full.csv')), na_rep='NA', index=False,
+                float_format='%.10f')
+    # Stream the rows in chunks of two
+    writer = ColumnarWriter(str(tmpdir.join('mdf.npz')))
+    assert multi_mdf(S, drGs, constraints, ratio_constraints,
+                     all_directions=True, presolve=True,
+                     chunk_writer=writer, chunk_size=2) is None
+    writer.close()
+    columnar = read_columnar(str(tmpdir.join('mdf.npz')))
+    assert list(columnar.columns) == list(full.columns)
+    assert columnar.shape == full.shape
+    # The csv conversion is identical to the csv of the full table
+    columnar_to_csv(str(tmpdir.join('mdf.npz')), str(tmpdir.join('mdf.csv')),
+                    chunk_size=5)
+    assert tmpdir.join('mdf.csv').read() == tmpdir.join('full.csv').read()
+
+
+def test_empty_output(tmpdir):
+    S = read_reactions("R1\tA + B <=> C\nR2\tC <=> D\n")
+    drGs = read_reaction_drGs("R1\t5\nR2\t-2\n")
+    constraints = read_constraints("A\t0.001\t0.003\t2\n")
+    write_csv = lambda table, path: table.to_csv(
+        path, na_rep='NA', index=False, float_format='%.10f'
+    )
+    # The third shard of two sweep points has no rows
+    shard_files = []
+    for i in range(3):
+        shard = multi_mdf(S, drGs, constraints, shard=(i, 3))
+        shard_files.append(str(tmpdir.join('shard_%d.csv' % i)))
+        write_csv(shard, shard_files[-1])
+    assert shard.shape[0] == 0
+    writer = ColumnarWriter(str(tmpdir.join('shard_2.npz')))
+    assert multi_mdf(S, drGs, constraints, shard=(2, 3),
+                     chunk_writer=writer) is None
+    writer.close()
+    columnar = read_columnar(str(tmpdir.join('shard_2.npz')))
+    assert list(columnar.columns) == list(shard.columns)
+    assert columnar.shape[0] == 0
+    # Without rows, the csv conversion only has the header
+    columnar_to_csv(
+        str(tmpdir.join('shard_2.npz')), str(tmpdir.join('columnar.csv'))
+    )
+    assert tmpdir.join('columnar.csv').read() == \
+    tmpdir.join('shard_2.csv').read()
+    # Shards without rows add nothing, and empty shard files are skipped
+    tmpdir.join('empty.csv').write("")
+    write_csv(multi_mdf(S, drGs, constraints), str(tmpdir.join('full.csv')))
+    merge_shards(
+        shard_files + [str(tmpdir.join('empty.csv'))],
+        str(tmpdir.join('merged.csv'))
+    )
+    assert tmpdir.join('merged.csv').read() == tmpdir.join('full.csv').read()
+    # A file without column labels gives an empty csv file
+    ColumnarWriter(str(tmpdir.join('empty.npz'))).close()
+    columnar_to_csv(
+        str(tmpdir.join('empty.npz')), str(tmpdir.join('empty_npz.csv'))
+    )
+    assert tmpdir.join('empty_npz.csv').read() == ""
+
+
+def test_multi_mdf_pathways(tmpdir):
+    S = read_reactions("\n".join([
+        "R1\tA + X <=> B + Y",
+        "R2\tB + C <=> D + Z",
+        "R3\tD + X <=> E + C + Y",
+        "R4\tE <=> A",
+        "R5\tA + Y <=> F + X"
+    ]))
+    drGs = read_reaction_drGs(
+        "R1\t-15\nR2\t-5\nR3\t-10\nR4\t-3\nR5\t-2\n"
+    )
+    constraints = read_constraints("C\t0.0001\t0.002\t3\nX\t0.001\t0.001\n")
+    tmpdir.join('pathways.txt').write(">P1\nR1\nR2\n\n>P2\nR3\n>P3\nR4\nR1\n")
+    pathways = read_pathway_lists(str(tmpdir.join('pathways.txt')))
+    assert list(pathways.items()) == [
+        ('P1', ['R1', 'R2']), ('P2', ['R3']), ('P3', ['R4', 'R1'])
+    ]
+    tmpdir.mkdir('pathways')
+    for pw_id, pw_rxns in pathways.items():
+        tmpdir.join('pathways', pw_id + '.txt').write("\n".join(pw_rxns))
+    assert read_pathway_lists(str(tmpdir.join('pathways'))) == pathways
+    # Batch NEM rows are those of separate NEM runs of the model (the
+    # reactions of no pathway) and one pathway, with their compounds
+    batch = multi_mdf(S, drGs, constraints, pathways=pathways)
+    assert list(batch.pathway.unique()) == ['P1', 'P2', 'P3']
+    for pw_id, pw_rxns in pathways.items():
+        rxns = [x for x in S.columns if x == 'R5' or x in pw_rxns]
+        cpds = [x for x in S.index if S.loc[x, rxns].any()]
+        single = multi_mdf(
+            S.loc[cpds, rxns], drGs[drGs.rxn_id.isin(rxns)], constraints,
+            net_rxns=['R5']
+        )
+        pw_rows = batch[batch.pathway == pw_id]
+        np.testing.assert_array_almost_equal(
+            pw_rows[single.columns].values.astype(float),
+            single.values.astype(float)
+        )
+        # Reactions of the other pathways are not part of the run
+        other = [x for x in S.columns if x not in rxns]
+        assert (pw_rows[['dir_' + x for x in other]] == 0).all().all()
+        assert pw_rows[['drGopt_' + x for x in other]].isnull().all().all()
+        # Compounds of the other pathways have no concentrations
+        other = [x for x in S.index if x not in cpds]
+        assert pw_rows[['c_' + x for x in other]].isnull().all().all()
+    # Compounds in ratios with run compounds are part of the run
+    ratio_constraints = read_ratio_constraints("B\tZ\t2\n")
+    batch = multi_mdf(
+        S, drGs, constraints, ratio_constraints, pathways=pathways,
+        sensitivity=True
+    )
+    rows = batch.set_index('pathway')
+    assert rows.loc['P2', ['c_B', 'c_Z']].isnull().all().all()
+    assert np.isnan(rows.loc['P2', 'sp_ratio_B_Z']).all()
+    p3 = rows.loc['P3']
+    assert np.allclose(p3.c_B / p3.c_Z, 2)
+    assert p3.c_C.isnull().all() and p3.sp_ratio_B_Z.notnull().all()
+
+
+def test_main_pathways_parallel(tmpdir):
+    tmpdir.join('reactions.txt').write("\n".join([
+        "R1\tA + X <=> B + Y",
+        "R2\tB + C <=> D + Z",
+        "R3\tD + X <=> E + C + Y",
+        "R4\tE <=> A",
+        "R5\tA + Y <=> F + X"
+    ]))
+    tmpdir.join('drGs.txt').write("R1\t-15\nR2\t-5\nR3\t-10\nR4\t-3\nR5\t-2\n")
+    tmpdir.join('constraints.txt').write("C\t0.0001\t0.002\t3\n")
+    tmpdir.join('pathways.txt').write(
+        ">P3\nR3\n>P1\nR1\nR2\n>P2\nR4\n>P4\nR2\nR3\n>P5\nR1\n"
+    )
+    def run(outfile, n_procs):
+        main(
+            str(tmpdir.join('reactions.txt')), str(tmpdir.join('drGs.txt')),
+            str(tmpdir.join(outfile)), str(tmpdir.join('constraints.txt')),
+            None, None, False, pathways_path=str(tmpdir.join('pathways.txt')),
+            n_procs=n_procs
+        )
+    # Groups of pathways are written as they are returned by the workers
+    run('serial.csv', 1)
+    run('parallel.csv', 2)
+    run('parallel.npz', 2)
+    columnar_to_csv(
+        str(tmpdir.join('parallel.npz')), str(tmpdir.join('columnar.csv'))
+    )
+    for outfile in ['parallel.csv', 'columnar.csv']:
+        assert tmpdir.join(outfile).read() == tmpdir.join('serial.csv').read()
+
+
+def test_mdf_solvers():
+    S = read_reactions("\n".join([
+        "R1\tA + X <=> B + Y",
+        "R2\tB + C <=> D + Z",
+        "R3\tD + X <=> E + C + Y",
+        "R4\tE <=> A"
+    ]))
+    drGs = read_reaction_drGs("R1\t-15\nR2\t-5\nR3\t-10\nR4\t-3\n")
+    constraints = read_constraints("C\t0.0001\t0.002\nX\t0.001\t0.001\n")
+    ratio_constraints = read_ratio_constraints("Y\tZ\t2\n")
+    c = mdf_c(S)
+    A = mdf_A(S)
+    b = mdf_b(S, drGs, constraints)
+    A_eq = mdf_A_eq(S, ratio_constraints)
+    b_eq = mdf_b_eq(ratio_constraints)
+    expected = mdf(c, A, b, A_eq, b_eq).x[-1]
+    solvers = LP_SOLVERS
+    try:
+        import pulp
+    except ImportError:
+        solvers = [solver for solver in LP_SOLVERS if solver != 'cbc']
+    for solver in solvers:
+        mdf_result = mdf(c, A, b, A_eq, b_eq, solver=solver)
+        assert mdf_result.success
+        assert abs(mdf_result.x[-1] - expected) < 1e-6
+        # Same result with presolve
+        mdf_result = mdf(c, A, b, A_eq, b_eq, True, solver)
+        assert abs(mdf_result.x[-1] - expected) < 1e-6
+        # An upper bound for C below its lower bound is infeasible
+        b_inf = np.asarray(b, dtype=float).flatten()
+        b_inf[S.shape[1] + S.index.get_loc('C')] = np.log(0.00001)
+        mdf_result = mdf(c, A, b_inf, A_eq, b_eq, True, solver)
+        assert not mdf_result.success
+        assert mdf_result.status == 2
+    with pytest.raises(ValueError):
+        mdf(c, A, b, A_eq, b_eq, solver='simplex')
 
 
 def test_ratio_range():
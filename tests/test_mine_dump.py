@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Add repository root to the path
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Import testing utilities
+import gzip
+import json
+import struct
+import threading
+import pytest
+
+# Import the script to be tested
+from mine_dump import *
+
+# Minimal BSON encoder for dump files
+def bson_encode(doc):
+    body = b""
+    for key, value in doc.items():
+        name = key.encode() + b"\x00"
+        if isinstance(value, bool):
+            body += b"\x08" + name + (b"\x01" if value else b"\x00")
+        elif isinstance(value, int):
+            body += b"\x12" + name + struct.pack("<q", value)
+        elif isinstance(value, float):
+            body += b"\x01" + name + struct.pack("<d", value)
+        elif isinstance(value, str):
+            s = value.encode() + b"\x00"
+            body += b"\x02" + name + struct.pack("<i", len(s)) + s
+        elif isinstance(value, dict):
+            body += b"\x03" + name + bson_encode(value)
+        elif isinstance(value, list):
+            body += b"\x04" + name + bson_encode(
+                {str(i):v for i, v in enumerate(value)}
+            )
+        elif value is None:
+            body += b"\x0a" + name
+    return struct.pack("<i", len(body) + 5) + body + b"\x00"
+
+COMPS = [
+    {"_id":"Cf1", "MINE_id":1, "Names":["Water", "H2O"], "Formula":"H2O",
+     "Inchikey":"XLYOFNOQVPJJNP-UHFFFAOYSA-N", "SMILES":"O", "Generation":0,
+     "DB_links":{"KEGG":["C00001"]}, "Reactant_in":["Rx1"], "Mass":18.01},
+    {"_id":"Cf2", "MINE_id":2, "Names":["Methane"], "Formula":"CH4",
+     "DB_links":{"KEGG":["C00002", "C00003"]}, "Product_of":["Rx1"],
+     "Expected":True, "Pathway":None},
+    {"_id":"Xf3", "Names":["water"]}
+]
+RXNS = [
+    {"_id":"Rx1", "Operators":["1.1.1.a"], "Reactants":[[1, "Cf1"]],
+     "Products":[[1, "Cf2"]]}
+]
+
+@pytest.fixture(params=['json', 'bson'])
+def dump_index(request, tmpdir):
+    if request.param == 'json':
+        comp_file = str(tmpdir.join("compounds.json.gz"))
+        with gzip.open(comp_file, 'wt') as f:
+            for comp in COMPS:
+                # mongoexport writes 64-bit integers in extended JSON
+                comp = dict(comp, **{
+                    k:{"$numberLong":str(v)} for k, v in comp.items() \
+                    if k == 'MINE_id'
+                })
+                f.write(json.dumps(comp) + "\n")
+        rxn_file = str(tmpdir.join("reactions.json"))
+        with open(rxn_file, 'w') as f:
+            f.write("\n".join(json.dumps(r) for r in RXNS) + "\n\n")
+    else:
+        comp_file = str(tmpdir.join("compounds.bson"))
+        with open(comp_file, 'wb') as f:
+            f.write(b"".join(bson_encode(c) for c in COMPS))
+        rxn_file = str(tmpdir.join("reactions.bson.gz"))
+        with gzip.open(rxn_file, 'wb') as f:
+            f.write(b"".join(bson_encode(r) for r in RXNS))
+    index = str(tmpdir.join("mine.sqlite"))
+    MineDump(index).build([comp_file], [rxn_file], batch_size=2)
+    return index
+
+# Define tests
+def test_read_dump(dump_index, tmpdir):
+    files = [str(f) for f in tmpdir.listdir() if "compounds" in str(f)]
+    assert list(read_dump(files[0])) == COMPS
+
+
+def test_get_comps_rxns(dump_index):
+    con = MineDump(dump_index)
+    assert con.get_comps("KEGGexp2", ["Cf2", "Cmissing", "Cf1"]) == \
+    [COMPS[1], COMPS[0]]
+    assert con.get_rxns("KEGGexp2", ["Rx1"]) == RXNS
+    assert con.get_rxns("KEGGexp2", []) == []
+
+    # Each thread uses its own connection
+    results = []
+    threads = [threading.Thread(
+        target=lambda: results.append(con.get_comps("KEGGexp2", ["Xf3"]))
+    ) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [[COMPS[2]]] * 4
+
+
+def test_quick_search(dump_index):
+    con = MineDump(dump_index)
+    water = {k:v for k, v in COMPS[0].items() if k in QUICK_SEARCH_FIELDS}
+    assert con.quick_search("KEGGexp2", "C00001") == [water]
+    assert con.quick_search("KEGGexp2", "C00003") == \
+    [{"_id":"Cf2", "MINE_id":2, "Names":["Methane"], "Formula":"CH4"}]
+    assert con.quick_search("KEGGexp2", "1") == [water]
+    assert con.quick_search("KEGGexp2", "XLYOFNOQVPJJNP-UHFFFAOYSA-N") == \
+    [water]
+    assert con.quick_search("KEGGexp2", "WATER") == \
+    [water, {"_id":"Xf3", "Names":["water"]}]
+    assert con.quick_search("KEGGexp2", "C00009") == []
+
+
+def test_bson_document():
+    doc = {"a":1, "b":[1.5, "x", {"c":None}], "d":False}
+    assert bson_document(bson_encode(doc)) == (doc, len(bson_encode(doc)))
+    # ObjectIds are read as hexadecimal strings
+    oid = b"\x07_id\x00" + bytes(range(12))
+    data = struct.pack("<i", len(oid) + 5) + oid + b"\x00"
+    assert bson_document(data)[0] == {"_id":bytes(range(12)).hex()}
+    with pytest.raises(ValueError):
+        bson_document(b"\x0c\x00\x00\x00\x13a\x00\x00\x00\x00\x00\x00")
@@ -4,9 +4,74 @@
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 
+# Import testing utilities
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
 # Import the script to be tested
 from poppy_KEGG_helpers import *
 
+# Local stand-in for the KEGG rest API
+def KEGG_mol(element):
+    return "\n".join([
+        "", "  KEGG      999999", "",
+        "  1  0  0  0  0  0  0  0  0  0999 V2000",
+        "    0.0000    0.0000    0.0000 %-3s 0  0  0  0  0  0  0  0  0  0  0  0"
+        % element,
+        "M  END", ""
+    ])
+
+KEGG_STAND_IN = {
+    "cpd:C00001":"\n".join([
+        "ENTRY       C00001                      Compound",
+        "NAME        H2O;", "            Water",
+        "FORMULA     H2O", "REACTION    R00001 R00002", "///", ""
+    ]),
+    "cpd:C00002":"\n".join([
+        "ENTRY       C00002                      Compound",
+        "NAME        Methane", "FORMULA     CH4", "///", ""
+    ]),
+    "cpd:C00003":"\n".join([
+        "ENTRY       C00003                      Compound",
+        "NAME        Protein", "///", ""
+    ]),
+    "rn:R00001":"\n".join([
+        "ENTRY       R00001                      Reaction",
+        "EQUATION    C00002 + 2 C00001 <=> C00003", "ENZYME      1.1.1.1",
+        "///", ""
+    ]),
+    "cpd:C00001/mol":KEGG_mol("O"),
+    "cpd:C00002/mol":KEGG_mol("C")
+}
+
+
+@pytest.fixture
+def kegg_stand_in():
+    requests = []
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            path = self.path.split("/")
+            option = "/" + path[3] if len(path) > 3 else ""
+            entries = [
+                KEGG_STAND_IN[q + option] for q in path[2].split("+")
+                if q + option in KEGG_STAND_IN
+            ]
+            if option:
+                entries = [e + "$$$$\n" for e in entries]
+            self.send_response(200 if entries else 404)
+            self.end_headers()
+            self.wfile.write("".join(entries).encode())
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_port, requests
+    server.shutdown()
+    thread.join()
+
 # Define functions
 def test_get_KEGG_text(capsys):
     kegg1 = "R01393"
@@ -170,3 +235,105 @@ def test_get_KEGG_rxns():
     for rxn in rxns_2:
         assert rxn in rxns_1
     assert get_KEGG_rxns(["R99999"]) == []
+
+
+def test_get_KEGG_texts(kegg_stand_in, capsys):
+    krest, requests = kegg_stand_in
+    ids = ["C00001", "C00002", "C00009", "R00001"]
+    texts = get_KEGG_texts(ids, krest)
+    assert texts == {
+        "C00001":KEGG_STAND_IN["cpd:C00001"],
+        "C00002":KEGG_STAND_IN["cpd:C00002"],
+        "R00001":KEGG_STAND_IN["rn:R00001"]
+    }
+    assert requests == ["/get/cpd:C00001+cpd:C00002+cpd:C00009+rn:R00001"]
+    out, err = capsys.readouterr()
+    assert err == "Warning: Unable to download KEGG data for 'C00009'.\n"
+    assert len(get_KEGG_texts(ids, krest, batch_size=2)) == 3
+    assert len(requests) == 3
+
+
+def test_get_KEGG_mol_smiles_bulk(kegg_stand_in, capsys):
+    krest, requests = kegg_stand_in
+    smiles = get_KEGG_mol_smiles_bulk(["C00001", "C00003", "C00002"], krest)
+    assert smiles == {"C00001":"O", "C00002":"C"}
+    # The batch is split to find the compound without a molecule
+    assert requests[0] == "/get/cpd:C00001+cpd:C00003+cpd:C00002/mol"
+    out, err = capsys.readouterr()
+    assert err == "\nWarning: Unable to download molecule data for 'C00003'.\n"
+
+
+def test_get_KEGG_comps_bulk(kegg_stand_in):
+    krest, requests = kegg_stand_in
+    comps = get_KEGG_comps(["C00001", "C00002", "C00003"], krest=krest)
+    assert sorted(comps, key=lambda c: c['_id']) == [
+        {"_id":"C00001", "DB_links":{"KEGG":["C00001"]}, "SMILES":"O",
+         "Names":["H2O", "Water"], "Formula":"H2O",
+         "Reactions":["R00001", "R00002"]},
+        {"_id":"C00002", "DB_links":{"KEGG":["C00002"]}, "SMILES":"C",
+         "Names":["Methane"], "Formula":"CH4"},
+        {"_id":"C00003", "DB_links":{"KEGG":["C00003"]}, "Names":["Protein"]}
+    ]
+    rxns = get_KEGG_rxns(["R00001"], krest=krest)
+    assert rxns == [{
+        "_id":"R00001", "Operators":["1.1.1.1"],
+        "Reactants":[[1, "C00002"], [2, "C00001"]], "Products":[[1, "C00003"]],
+        "RPair":{}
+    }]
+
+
+def test_get_KEGG_comps_cached(kegg_stand_in, tmpdir):
+    from http_cache import configure_cache
+    krest, requests = kegg_stand_in
+    ids = ["C00001", "C00002", "C00003"]
+    try:
+        configure_cache(str(tmpdir))
+        comps = get_KEGG_comps(ids, krest=krest)
+        get_KEGG_text("C00001", krest)
+        n_requests = len(requests)
+        # A rebuild is answered from the cache, also without the server
+        configure_cache(str(tmpdir), offline=True)
+        assert get_KEGG_comps(ids, krest=krest) == comps
+        assert get_KEGG_text("C00001", krest) == KEGG_STAND_IN["cpd:C00001"]
+        assert get_KEGG_text("C00009", krest) == None
+        assert len(requests) == n_requests
+    finally:
+        configure_cache()
+
+
+def test_read_KEGG_flat_files(tmpdir):
+    import gzip
+    compound_file = str(tmpdir.join("compound.gz"))
+    with gzip.open(compound_file, 'wt') as f:
+        for cpd in ["cpd:C00001", "cpd:C00002", "cpd:C00003"]:
+            f.write(KEGG_STAND_IN[cpd])
+    reaction_file = tmpdir.join("reaction")
+    reaction_file.write(KEGG_STAND_IN["rn:R00001"])
+    mol_dir = tmpdir.mkdir("mol")
+    mol_dir.join("C00001.mol").write(KEGG_STAND_IN["cpd:C00001/mol"])
+    mol_dir.join("C00002.mol").write(KEGG_STAND_IN["cpd:C00002/mol"])
+
+    assert list(KEGG_flat_records(str(reaction_file))) == \
+    [KEGG_STAND_IN["rn:R00001"]]
+
+    # The records are formatted as when downloaded
+    for n_procs in [1, 2]:
+        comps = read_KEGG_comps(compound_file, str(mol_dir), n_procs, 2)
+        assert comps == [
+            {"_id":"C00001", "DB_links":{"KEGG":["C00001"]}, "SMILES":"O",
+             "Names":["H2O", "Water"], "Formula":"H2O",
+             "Reactions":["R00001", "R00002"]},
+            {"_id":"C00002", "DB_links":{"KEGG":["C00002"]}, "SMILES":"C",
+             "Names":["Methane"], "Formula":"CH4"},
+            {"_id":"C00003", "DB_links":{"KEGG":["C00003"]},
+             "Names":["Protein"]}
+        ]
+        rxns = read_KEGG_rxns(str(reaction_file), n_procs)
+        assert rxns == [{
+            "_id":"R00001", "Operators":["1.1.1.1"],
+            "Reactants":[[1, "C00002"], [2, "C00001"]],
+            "Products":[[1, "C00003"]], "RPair":{}
+        }]
+
+    # Without molecule files, there are no SMILES
+    assert "SMILES" not in read_KEGG_comps(compound_file)[0]
@@ -4,6 +4,14 @@
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 
+# Import testing utilities
+import json
+import time
+import threading
+import pytest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
 # Import the script to be tested
 from poppy_create import *
 
@@ -2094,3 +2102,326 @@ def test_add_ferredoxin():
         assert rxn in exp_rxn_list
     for rxn in exp_rxn_list:
         assert rxn in rxn_list
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def mine_stand_in():
+    # Local JSON-RPC stand-in for the MINE API; 'Cbad' breaks any batch
+    calls = []
+    records = {"C%d" % i:{"_id":"C%d" % i, "Formula":"C%dH2" % i} \
+    for i in range(50)}
+    records["Cbad"] = {"_id":"Cbad"}
+    records["R1"] = {"_id":"R1", "Operators":["1.1.1.a"]}
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_POST(self):
+            call = json.loads(
+                self.rfile.read(int(self.headers['Content-Length'])).decode()
+            )
+            db, ids = call['params']
+            calls.append((call['method'].split(".")[1], ids))
+            if "Cbad" in ids and len(ids) > 1:
+                body = json.dumps({"error":{
+                    "name":"JSONRPCError", "code":-32603, "message":"Bad"
+                }})
+                self.send_response(500)
+            else:
+                found = [records[_id] for _id in ids if _id in records]
+                body = json.dumps({"result":[found]})
+                self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode())
+        def log_message(self, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_port, calls
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_getcomps_batched(mine_stand_in, capsys):
+    url, calls = mine_stand_in
+    con = mc.mineDatabaseServices(url)
+    db = "KEGGexp2"
+
+    # Records are matched to IDs, missing records are None
+    comp_ids = ["C3", "C1", "C_missing", "C2"]
+    comps = getcomps(con, db, comp_ids)
+    assert [c['_id'] if c else None for c in comps] == \
+    ["C3", "C1", None, "C2"]
+    assert calls == [("get_comps", comp_ids)]
+    out, err = capsys.readouterr()
+    assert err == "Warning: 'C_missing' could not be retrieved" + \
+    " from the database.\n"
+
+    # A failing batch is split until the failing ID is isolated
+    del calls[:]
+    comps = getcomps(con, db, ["C1", "C2", "C3", "Cbad"])
+    assert [c['_id'] for c in comps] == ["C1", "C2", "C3", "Cbad"]
+    assert calls == [
+        ("get_comps", ["C1", "C2", "C3", "Cbad"]),
+        ("get_comps", ["C1", "C2"]), ("get_comps", ["C3", "Cbad"]),
+        ("get_comps", ["C3"]), ("get_comps", ["Cbad"])
+    ]
+
+    # Threaded downloads use few, large batches
+    del calls[:]
+    comp_ids = ["C%d" % i for i in range(50)]
+    comps = threaded_getcomps(con, db, comp_ids, num_workers=2)
+    assert sorted(c['_id'] for c in comps) == sorted(comp_ids)
+    assert len(calls) == 8
+    rxns = threaded_getrxn(con, db, ["R1", "R2"])
+    assert sorted(filter(None, rxns), key=str) == [
+        {"_id":"R1", "Operators":["1.1.1.a"]}
+    ]
+
+
+def test_crawl_store(tmpdir):
+    path = str(tmpdir.join("crawl.sqlite"))
+    store = CrawlStore(path)
+    store.put('MINE_comp', {"C1":{"_id":"C1"}, "C2":None})
+    store.put('MINE_rxn', {"R1":{"_id":"R1"}})
+    store.put_state('KEGG_comp_ids', ["C00001", "C00002"])
+    # Records that could not be downloaded are not stored
+    assert store.get('MINE_comp') == {"C1":{"_id":"C1"}}
+    assert store.get('MINE_comp', ["C1", "C2", "C3"]) == {"C1":{"_id":"C1"}}
+    assert store.get_state('KEGG_comp_ids') == ["C00001", "C00002"]
+    assert store.get_state('KEGG_rxn_ids', []) == []
+
+    # Resuming keeps the records, starting over discards them
+    assert CrawlStore(path, resume=True).get('MINE_rxn') == \
+    {"R1":{"_id":"R1"}}
+    store = CrawlStore(path)
+    assert store.get('MINE_rxn') == {}
+    assert store.get_state('KEGG_comp_ids') is None
+
+
+def test_stored_records(tmpdir):
+    downloads = []
+    def download(ids):
+        downloads.append(ids)
+        return [{"_id":x} if x != "C3" else None for x in ids]
+
+    # Without a store, everything is downloaded
+    assert stored_records(None, 'MINE_comp', ["C1"], download) == \
+    [{"_id":"C1"}]
+
+    # Downloads are stored in chunks, and only missing records are downloaded
+    store = CrawlStore(str(tmpdir.join("crawl.sqlite")))
+    store.put('MINE_comp', {"C2":{"_id":"C2"}})
+    del downloads[:]
+    records = stored_records(
+        store, 'MINE_comp', ["C1", "C2", "C3", "C4", "C1"], download, 2
+    )
+    assert records == [{"_id":"C1"}, {"_id":"C2"}, None, {"_id":"C4"},
+    {"_id":"C1"}]
+    assert downloads == [["C1", "C3"], ["C4"]]
+    # Only the records that could not be downloaded are downloaded again
+    del downloads[:]
+    assert stored_records(store, 'MINE_comp', ["C3", "C4"], download) == \
+    [None, {"_id":"C4"}]
+    assert downloads == [["C3"]]
+
+    assert records_by_id([{"_id":"C2"}, None, {"_id":"C1"}], \
+    ["C1", "C2", "C3"]) == [{"_id":"C1"}, {"_id":"C2"}, None]
+
+
+def test_get_raw_MINE_pipelined(monkeypatch):
+    # Cs -Rslow- Cx -Rd- Cy -Re- Cz, with a fast detour Cs -Ra- Ca -Rb- Cb
+    # -Rc- Cx; and Ct -Rslow2- Cp, Ct -Rf- Cq -Rg- Ce1 + Ce2 + Ce3 -Rslow3-
+    # Cw
+    rxn_comps = {
+        "Rslow":(["Cs"], ["Cx"]), "Rd":(["Cx"], ["Cy"]), "Re":(["Cy"], ["Cz"]),
+        "Ra":(["Cs"], ["Ca"]), "Rb":(["Ca"], ["Cb"]), "Rc":(["Cb"], ["Cx"]),
+        "Rslow2":(["Ct"], ["Cp"]), "Rf":(["Ct"], ["Cq"]),
+        "Rg":(["Cq"], ["Ce1", "Ce2", "Ce3"]), "Rslow3":(["Ce1"], ["Cw"])
+    }
+    comps = {}
+    rxns = {}
+    for rxn_id, (reactants, products) in rxn_comps.items():
+        rxns[rxn_id] = {
+            "_id":rxn_id, "Reactants":[[1, c] for c in reactants],
+            "Products":[[1, c] for c in products]
+        }
+        for c in reactants + products:
+            comps.setdefault(c, {
+                "_id":c, "Formula":"C2H4", "Reactant_in":[], "Product_of":[]
+            })
+        for c in reactants:
+            comps[c]["Reactant_in"].append(rxn_id)
+        for c in products:
+            comps[c]["Product_of"].append(rxn_id)
+    finished = []
+    class StandIn():
+        url = "http://mine.stand-in"
+        def get_comps(self, db, ids):
+            finished.extend(ids)
+            return [comps[x] for x in ids]
+        def get_rxns(self, db, ids):
+            # The direct reactions are downloaded last
+            if any(x.startswith("Rslow") for x in ids):
+                time.sleep(2 if "Rslow3" in ids else 1)
+            finished.extend(ids)
+            return [rxns[x] for x in ids]
+    monkeypatch.setattr(mc, "mineDatabaseServices", lambda url: StandIn())
+    crawl = lambda start, *limits: get_raw_MINE(
+        [start], *limits, num_workers=4, batch_size=1
+    )
+
+    # Cx is reached in three steps first, and expanded again when it is
+    # reached in one step
+    comp_dict, rxn_dict = crawl("Cs", 3)
+    assert sorted(comp_dict) == ["Ca", "Cb", "Cs", "Cx", "Cy", "Cz"]
+    assert sorted(rxn_dict) == ["Ra", "Rb", "Rc", "Rd", "Re", "Rslow"]
+
+    # Compounds are kept up to their shortest number of steps
+    comp_dict, rxn_dict = crawl("Cs", 2)
+    assert sorted(comp_dict) == ["Ca", "Cb", "Cs", "Cx", "Cy"]
+    assert sorted(rxn_dict) == ["Ra", "Rb", "Rc", "Rd", "Rslow"]
+
+    # The compound limit is applied in step order, so the second step only
+    # adds one compound, even though it was downloaded before the first step
+    comp_dict, rxn_dict = crawl("Ct", 10, 4)
+    assert sorted(comp_dict) == ["Ce1", "Cp", "Cq", "Ct"]
+    assert sorted(rxn_dict) == ["Rf", "Rg", "Rslow2"]
+
+    # No downloads continue after the crawl, although Rslow3 was still being
+    # downloaded when the limit was reached
+    n_finished = len(finished)
+    time.sleep(1.5)
+    assert len(finished) == n_finished
+
+
+def test_get_raw_MINE_resume(monkeypatch, tmpdir):
+    # C1 -R1- C2 -R2- C3, where C2 can not be downloaded at first
+    rxns = {
+        "R1":{"_id":"R1", "Reactants":[[1, "C1"]], "Products":[[1, "C2"]]},
+        "R2":{"_id":"R2", "Reactants":[[1, "C2"]], "Products":[[1, "C3"]]}
+    }
+    comps = {
+        "C1":{"_id":"C1", "Formula":"C2H4", "Reactant_in":["R1"]},
+        "C2":{"_id":"C2", "Formula":"C2H4", "Product_of":["R1"],
+              "Reactant_in":["R2"]},
+        "C3":{"_id":"C3", "Formula":"C2H4", "Product_of":["R2"]}
+    }
+    downloads = []
+    class StandIn():
+        url = "http://mine.stand-in"
+        failing = {"C2"}
+        def get_comps(self, db, ids):
+            downloads.extend(ids)
+            return [comps[x] for x in ids if x not in self.failing]
+        def get_rxns(self, db, ids):
+            downloads.extend(ids)
+            return [rxns[x] for x in ids]
+    server = StandIn()
+    monkeypatch.setattr(mc, "mineDatabaseServices", lambda url: server)
+    path = str(tmpdir.join("crawl.sqlite"))
+
+    # The failed download cuts the network short
+    comp_dict, rxn_dict = get_raw_MINE(["C1"], 2, store=CrawlStore(path))
+    assert sorted(comp_dict) == ["C1"]
+
+    # On resume, only the failed compound and what lies beyond it are
+    # downloaded
+    server.failing = set()
+    del downloads[:]
+    comp_dict, rxn_dict = get_raw_MINE(
+        ["C1"], 2, store=CrawlStore(path, resume=True)
+    )
+    assert sorted(comp_dict) == ["C1", "C2", "C3"]
+    assert sorted(rxn_dict) == ["R1", "R2"]
+    assert sorted(downloads) == ["C2", "C3", "R2"]
+
+
+def test_get_raw_MINE_targeted(monkeypatch):
+    # C1 -R1- C2 -R2- C3 -R3- C4, with a dead end C2 -R4- C5 -R5- C6 and a
+    # shortcut C1 -R6- C7 -R7- C4 through a compound exceeding the C limit;
+    # the cofactors Xa/Xb (MINE 'X' compounds), ATP/ADP and water are shared
+    # with reactions of C8 to C12, but are not on paths
+    rxn_comps = {
+        "R1":(["C1"], ["C2"]), "R2":(["C2"], ["C3"]), "R3":(["C3"], ["C4"]),
+        "R4":(["C2"], ["C5"]), "R5":(["C5"], ["C6"]), "R6":(["C1"], ["C7"]),
+        "R7":(["C7"], ["C4"]), "R8":(["C1", "Xa"], ["C8", "Xb"]),
+        "R9":(["C9", "Xb"], ["C4", "Xa"]),
+        "R10":(["C2", "Catp"], ["C10", "Cadp"]),
+        "R11":(["C11", "Cadp"], ["C4", "Catp"]),
+        "R12":(["C1"], ["C12", "Cw"]), "R13":(["Cw", "C9"], ["C4"])
+    }
+    comps = {}
+    rxns = {}
+    for rxn_id, (reactants, products) in rxn_comps.items():
+        rxns[rxn_id] = {
+            "_id":rxn_id, "Reactants":[[1, c] for c in reactants],
+            "Products":[[1, c] for c in products]
+        }
+        for c in reactants + products:
+            comps.setdefault(c, {
+                "_id":c, "Formula":"C2H4", "Reactant_in":[], "Product_of":[]
+            })
+        for c in reactants:
+            comps[c]["Reactant_in"].append(rxn_id)
+        for c in products:
+            comps[c]["Product_of"].append(rxn_id)
+    comps["C7"]["Formula"] = "C30H2"
+    comps["Cw"]["Formula"] = "H2O"
+    comps["Catp"]["DB_links"] = {"KEGG":["C00002"]}
+    comps["Cadp"]["DB_links"] = {"KEGG":["C00008"]}
+    downloaded = []
+    class StandIn():
+        url = "http://mine.stand-in"
+        def get_comps(self, db, ids):
+            downloaded.extend(ids)
+            return [comps[x] for x in ids]
+        def get_rxns(self, db, ids):
+            downloaded.extend(ids)
+            return [rxns[x] for x in ids]
+    monkeypatch.setattr(mc, "mineDatabaseServices", lambda url: StandIn())
+
+    comp_dict, rxn_dict = get_raw_MINE_targeted(["C1"], ["C4"], 3)
+    assert sorted(rxn_dict) == ["R1", "R2", "R3"]
+    assert sorted(comp_dict) == ["C1", "C2", "C3", "C4"]
+
+    # The dead end is not explored beyond the meeting point
+    assert "R5" not in downloaded
+    assert "C6" not in downloaded
+
+    # There are no paths of two steps
+    comp_dict, rxn_dict = get_raw_MINE_targeted(["C1"], ["C4"], 2)
+    assert rxn_dict == {}
+    assert sorted(comp_dict) == ["C1", "C4"]
+
+
+def test_MINE_dump(tmpdir):
+    # A local MINE dump answers in place of the MINE server
+    comps = [
+        {"_id":"Ca", "Formula":"C2H6O", "DB_links":{"KEGG":["C00469"]},
+         "Reactant_in":["Rab"]},
+        {"_id":"Cb", "Formula":"C2H4O", "Product_of":["Rab"]}
+    ]
+    rxns = [{"_id":"Rab", "Reactants":[[1, "Ca"]], "Products":[[1, "Cb"]]}]
+    for name, records in [("comps.json", comps), ("rxns.json", rxns)]:
+        tmpdir.join(name).write("\n".join(json.dumps(r) for r in records))
+    index = str(tmpdir.join("mine.sqlite"))
+    MineDump(index).build(
+        [str(tmpdir.join("comps.json"))], [str(tmpdir.join("rxns.json"))]
+    )
+    with pytest.raises(ValueError):
+        configure_MINE(str(tmpdir.join("missing.sqlite")))
+    try:
+        configure_MINE(index)
+        assert KEGG_to_MINE_id(["C00469"]) == {"C00469":"Ca"}
+        assert get_raw_MINE(["Ca"], 1) == (
+            {"Ca":comps[0], "Cb":comps[1]}, {"Rab":rxns[0]}
+        )
+    finally:
+        configure_MINE()
@@ -184,6 +184,58 @@ def test_create_drG_dict():
     drGs = [-1.6, -12.6, 18.5, -43.3, -35.5]
     expected_output = dict(zip(equations, drGs))
     assert create_drG_dict(equations, pH=8.4) == expected_output
+    # Duplicates and reordered equations are evaluated once, in parallel
+    equations = equations + ["C00447 = C00279 + C00111", equations[0]]
+    expected_output["C00447 = C00279 + C00111"] = 12.6
+    assert create_drG_dict(equations, pH=8.4, n_procs=2) == expected_output
+
+def test_canonical_equation():
+    assert canonical_equation("C00002 + C00001 <=> C00008") == \
+        ("C00001 + C00002 <=> C00008", 1)
+    assert canonical_equation("C00008 <=> C00002 + C00001") == \
+        ("C00001 + C00002 <=> C00008", -1)
+    assert canonical_equation("C00001_c + C00002_[cyt] = 2 C00008") == \
+        ("2 C00008 <=> C00001 + C00002", -1)
+
+
+def test_drG_cache(tmpdir):
+    cache_file = str(tmpdir.join('drG.sqlite'))
+    cache = DrGCache(cache_file)
+    cache.put({"A <=> B":-1.5, "B <=> C":None}, 7.0)
+    assert cache.get(["A <=> B", "B <=> C", "C <=> D"], 7.0) == \
+        {"A <=> B":-1.5, "B <=> C":None}
+    assert cache.get(["A <=> B"], 8.0) == {}
+    # Cached values are used in both directions
+    drGs = create_drG_dict(["B <=> A", "A <=> B"], cache=DrGCache(cache_file))
+    assert drGs == {"B <=> A":1.5, "A <=> B":-1.5}
+
+
+def test_reaction_gibbs_vector():
+    equations = [
+        "C01182 + C00011 + C00001 <=> 2 C00197",
+        "A <=> B",
+        "C00197_c <=> C00011_[cyt] + C00001",
+        "C01182 + C00011 + C00001 <=> 2 C00197"
+    ]
+    dfG_dict = {
+        "C01182":-2124.3,
+        "C00011":-386.0,
+        "C00001":-157.6,
+        "C00197":-1348.1,
+        "A":None,
+        "B":1.2
+        }
+    drGs = reaction_gibbs_vector(equations, dfG_dict)
+    assert len(drGs) == 3
+    assert drGs[equations[0]] == -28.3
+    assert np.isnan(drGs[equations[1]])
+    assert_almost_equal(drGs[equations[2]], 804.5)
+    # Same values as reaction_gibbs
+    for equation in equations:
+        if reaction_gibbs(equation, dfG_dict) is not None:
+            assert drGs[equation] == reaction_gibbs(equation, dfG_dict)
+    assert create_drG_dict(equations, dfG_dict).keys() == drGs.keys()
+
 
 def test_pathways_to_mdf():
     pathways = [
@@ -262,6 +314,115 @@ def test_pathways_to_mdf():
     assert_almost_equal(exp_mdf, mdf_dict[pathways[0]])
 
 
+def test_mdf_cache(tmpdir):
+    pathways = [
+        "\n".join(["R1\tC1 + C2 <=> C3 + C4",
+                   "R2\tC3 <=> C5"]),
+        "\n".join(["R0\tZ1 <=> Z2"])
+    ]
+    dfG_dict = {"C1":-1, "C2":-1, "C3":-1, "C4":-1, "C5":-1, "Z1":-1, "Z2":-1}
+    ne_con = mdf.read_constraints("Z1\t0.1\t0.1\nZ2\t0.2\t0.2")
+    eq_con = mdf.read_ratio_constraints("Z1\tZ2\t1")
+    cache_file = str(tmpdir.join('mdf.sqlite'))
+    mdf_dict = pathways_to_mdf(
+        pathways, dfG_dict, ne_con, eq_con, n_procs=1,
+        mdf_cache=MDFCache(cache_file)
+    )
+    assert mdf_dict == pathways_to_mdf(pathways, dfG_dict, ne_con, eq_con, 1)
+    # Both the MDF and the failed optimization are cached
+    fingerprint = mdf_fingerprint(
+        ne_con, eq_con, "", 0.1, 0.0000001, 298.15, 8.31e-3, 7.0, dfG_dict
+    )
+    pw_hashes = [mdf_cache_key(pw) for pw in pathways]
+    cache = MDFCache(cache_file)
+    assert cache.get(pw_hashes, fingerprint) == {
+        pw_hashes[0]:mdf_dict[pathways[0]], pw_hashes[1]:None
+    }
+    # Cached values are used for the same inputs only
+    cache.put({pw_hashes[0]:100.0}, fingerprint)
+    assert pathways_to_mdf(
+        pathways, dfG_dict, ne_con, eq_con, n_procs=1, mdf_cache=cache
+    )[pathways[0]] == 100.0
+    assert pathways_to_mdf(
+        pathways, dfG_dict, ne_con, eq_con, n_procs=1, x_max=0.01,
+        mdf_cache=cache
+    )[pathways[0]] != 100.0
+
+
+def test_mdf_cache_key():
+    pw = 'A\tC1 <=> C2\nB\tC1 <=> C3\nC\tC2 + C3 <=> C4'
+    key = mdf_cache_key(pw)
+    assert key == mdf_cache_key('D\tC1 <=> C3\nE\tC1 <=> C2\nF\tC3 + C2 <=> C4')
+    assert len(key) == 64
+    # Direction, compartments and network membership are part of the key
+    assert key != mdf_cache_key(pw.replace('C1 <=> C2', 'C2 <=> C1'))
+    assert key != mdf_cache_key(pw.replace('C1 <=> C2', 'C1_c <=> C2'))
+    assert key != mdf_cache_key(pw, {'A'})
+    assert key == mdf_cache_key(pw, {'D'})
+
+
+def test_mdf_upper_bounds():
+    pathways = [
+        "R1\tC1 <=> C2\nR2\tC2 <=> C3",
+        "R3\tC1 <=> 2 C4\nR4\tC4 + C00080 <=> C3",
+        "R5\tC5 <=> C6"
+    ]
+    eq_to_drG = {
+        "C1 <=> C2":-10, "C2 <=> C3":-5, "C1 <=> 2 C4":-20,
+        "C4 + C00080 <=> C3":-10, "C5 <=> C6":-1
+    }
+    ne_con = mdf.read_constraints("C1\t0.001\t0.001\nC3\t0.0001\t0.01")
+    eq_con = mdf.read_ratio_constraints("")
+    net = network_mdf_block("R5\tC5 <=> C6", eq_to_drG, ne_con, eq_con)
+    RT = 298.15*8.31e-3
+    bounds = mdf_upper_bounds(pathways, net, eq_to_drG)
+    # Q_min = 1e-7/1e-3 for R1 and 1e-4/0.1 for R2
+    assert_almost_equal(bounds[0], min(10 - RT*np.log(1e-4), 5 - RT*np.log(1e-3)))
+    # Q_min = 1e-14/1e-3 for R3 and 1e-4/0.1 for R4 (protons are ignored)
+    assert_almost_equal(bounds[1], min(20 - RT*np.log(1e-11), 10 - RT*np.log(1e-3)))
+    # Network reactions are not driven by B
+    assert bounds[2] == np.inf
+    # The bounds are upper bounds of the MDF
+    for pathway, bound in zip(pathways[:2], bounds):
+        S, c, A, b, A_eq, b_eq, eq_con_f = pathway_mdf_problem(
+            pathway, net, eq_to_drG
+        )
+        assert mdf.mdf(c, A, b).x[-1]*RT <= bound + 1e-6
+
+
+def test_pathways_to_mdf_top_n():
+    pathways = ["R%d\tC%d <=> C%d" % (i, i, i + 1) for i in range(1, 21)]
+    dfG_dict = {"C%d" % i:-i*(i % 7) for i in range(1, 22)}
+    ne_con = mdf.read_constraints("")
+    eq_con = mdf.read_ratio_constraints("")
+    mdf_dict = pathways_to_mdf(pathways, dfG_dict, ne_con, eq_con, n_procs=1)
+    top_dict = pathways_to_mdf(
+        pathways, dfG_dict, ne_con, eq_con, n_procs=1, top_n=3
+    )
+    assert len(top_dict) < len(mdf_dict)
+    assert sorted(top_dict.values())[-3:] == sorted(mdf_dict.values())[-3:]
+
+
+def test_pathways_to_mdf_top_n_parallel():
+    pathways = [
+        "R%d\tC%d <=> C%d\nS%d\tC%d <=> C%d" % (i, i, i + 1, i, i + 1, i + 2)
+        for i in range(1, 10)
+    ]
+    dfG_dict = {"C%d" % i:-10*i for i in range(1, 12)}
+    ne_con = mdf.read_constraints("")
+    eq_con = mdf.read_ratio_constraints("")
+    mdf_dict = pathways_to_mdf(pathways, dfG_dict, ne_con, eq_con, n_procs=1)
+    # Late batches of one pathway are also solved by the workers, without
+    # the problem data left over in this process
+    mdf_worker.clear()
+    top_dict = pathways_to_mdf(
+        pathways, dfG_dict, ne_con, eq_con, n_procs=2, top_n=1
+    )
+    assert max(top_dict.values()) == max(mdf_dict.values())
+    for pw, value in top_dict.items():
+        assert_almost_equal(value, mdf_dict[pw])
+
+
 def test_format_output():
 
     P1 = "\n".join([